@@ -0,0 +1,244 @@
+"""跨品牌转换分配：将同一门店内期初、期末的剩余量配对成转换流量
+
+所有策略都以"按门店排序的扁平数组"为输入，一次处理全部门店：
+    start_store/start_value：期初剩余量所属门店编码及数值（按门店升序）
+    end_store/end_value：期末剩余量所属门店编码及数值（按门店升序）
+返回 (配对, 期初余量, 期末余量)：
+    配对为 (期初下标, 期末下标, 流量)，余量为 (下标, 流量)
+
+剩余量含负值（退货大于销售）的门店不适用区间重叠法，由allocate改按逐门店循环的规则配对。
+"""
+import numpy as np
+import pandas as pd
+
+# 界面显示名称
+ALLOCATION_LABELS = {
+    'random': '随机匹配',
+    'proportional': '按比例分配',
+    'greedy': '大额优先',
+    'sequential': '顺序匹配',
+}
+
+
+def _fill_in_order(start_store, start_value, end_store, end_value):
+    """按数组顺序将每个门店的期初剩余量与期末剩余量逐段配对（区间重叠法）
+
+    两侧剩余量按门店内顺序各自累加成区间，区间重叠部分即为配对流量，
+    超出另一侧总量的部分为余量。整体为一次排序，O(n log n)。
+    """
+    n_start = len(start_store)
+    n_end = len(end_store)
+    # 门店内累计值即各段区间的右端点
+    start_cum = pd.Series(start_value).groupby(start_store).cumsum().to_numpy()
+    end_cum = pd.Series(end_value).groupby(end_store).cumsum().to_numpy()
+    stores = np.unique(np.concatenate([start_store, end_store]))
+
+    # 事件点：每个门店的原点 + 两侧所有区间右端点
+    pos = np.concatenate([np.zeros(len(stores)), start_cum, end_cum])
+    store = np.concatenate([stores, start_store, end_store])
+    is_start = np.concatenate([np.zeros(len(stores), dtype=np.int64),
+                               np.ones(n_start, dtype=np.int64),
+                               np.zeros(n_end, dtype=np.int64)])
+    is_end = np.concatenate([np.zeros(len(stores) + n_start, dtype=np.int64),
+                             np.ones(n_end, dtype=np.int64)])
+    is_origin = np.concatenate([np.zeros(len(stores), dtype=np.int64),
+                                np.ones(n_start + n_end, dtype=np.int64)])
+    order = np.lexsort((is_origin, pos, store))
+    pos, store, is_start, is_end = pos[order], store[order], is_start[order], is_end[order]
+
+    # 每个事件点之后所处的期初/期末区间序号（门店内）
+    first = np.ones(len(store), dtype=bool)
+    first[1:] = store[1:] != store[:-1]
+    group_id = np.cumsum(first) - 1
+    start_seen = np.cumsum(is_start)
+    end_seen = np.cumsum(is_end)
+    start_idx = start_seen - (start_seen - is_start)[first][group_id]
+    end_idx = end_seen - (end_seen - is_end)[first][group_id]
+
+    # 相邻事件点构成的线段
+    same_store = store[1:] == store[:-1]
+    length = pos[1:] - pos[:-1]
+    seg_store = store[:-1]
+    seg_start = start_idx[:-1]
+    seg_end = end_idx[:-1]
+    valid = same_store & (length > 0)
+
+    start_count = np.bincount(np.searchsorted(stores, start_store), minlength=len(stores))
+    end_count = np.bincount(np.searchsorted(stores, end_store), minlength=len(stores))
+    start_offset = np.cumsum(start_count) - start_count
+    end_offset = np.cumsum(end_count) - end_count
+    seg_pos = np.searchsorted(stores, seg_store)
+    has_start = seg_start < start_count[seg_pos]
+    has_end = seg_end < end_count[seg_pos]
+
+    global_start = start_offset[seg_pos] + seg_start
+    global_end = end_offset[seg_pos] + seg_end
+
+    pair = valid & has_start & has_end
+    start_left = valid & has_start & ~has_end
+    end_left = valid & ~has_start & has_end
+    return (
+        (global_start[pair], global_end[pair], length[pair]),
+        (global_start[start_left], length[start_left]),
+        (global_end[end_left], length[end_left]),
+    )
+
+
+def _fill_reordered(start_order, end_order, start_store, start_value, end_store, end_value):
+    """按给定的门店内顺序配对，并把结果下标映射回原数组"""
+    pairs, start_left, end_left = _fill_in_order(
+        start_store[start_order], start_value[start_order],
+        end_store[end_order], end_value[end_order],
+    )
+    return (
+        (start_order[pairs[0]], end_order[pairs[1]], pairs[2]),
+        (start_order[start_left[0]], start_left[1]),
+        (end_order[end_left[0]], end_left[1]),
+    )
+
+
+def allocate_sequential(start_store, start_value, end_store, end_value, rng=None):
+    """顺序匹配：期初、期末剩余量都按品牌顺序依次配对"""
+    return _fill_in_order(start_store, start_value, end_store, end_value)
+
+
+def allocate_random(start_store, start_value, end_store, end_value, rng=None):
+    """随机匹配：期初按品牌顺序，期末剩余量在门店内随机打乱后依次配对"""
+    rng = rng if rng is not None else np.random.default_rng()
+    start_order = np.arange(len(start_store))
+    end_order = np.lexsort((rng.random(len(end_store)), end_store))
+    return _fill_reordered(start_order, end_order, start_store, start_value, end_store, end_value)
+
+
+def allocate_greedy(start_store, start_value, end_store, end_value, rng=None):
+    """大额优先：两侧剩余量在门店内按数值降序依次配对"""
+    start_order = np.lexsort((-start_value, start_store))
+    end_order = np.lexsort((-end_value, end_store))
+    return _fill_reordered(start_order, end_order, start_store, start_value, end_store, end_value)
+
+
+def allocate_proportional(start_store, start_value, end_store, end_value, rng=None):
+    """按比例分配：门店内期初 × 期末剩余量的外积按 max(期初总量, 期末总量) 缩放
+
+    flow[i, j] = start[i] * end[j] / max(S, E)，较小一侧被完全分配，
+    较大一侧按比例留下余量。输出规模为每个门店的 k_start × k_end。
+    流量为比例值，不取整为整数单位（整数单位计算对该策略只作用于输入），守恒按浮点相对误差核对。
+    """
+    stores = np.unique(np.concatenate([start_store, end_store]))
+    start_pos = np.searchsorted(stores, start_store)
+    end_pos = np.searchsorted(stores, end_store)
+    start_total = np.bincount(start_pos, weights=start_value, minlength=len(stores))
+    end_total = np.bincount(end_pos, weights=end_value, minlength=len(stores))
+    scale = np.maximum(start_total, end_total)
+    scale[scale == 0] = 1.0
+
+    # 批量生成所有门店的 (期初, 期末) 笛卡尔积下标
+    end_count = np.bincount(end_pos, minlength=len(stores))
+    end_offset = np.cumsum(end_count) - end_count
+    repeat = end_count[start_pos]
+    pair_start = np.repeat(np.arange(len(start_store)), repeat)
+    within = np.arange(repeat.sum()) - np.repeat(np.cumsum(repeat) - repeat, repeat)
+    pair_end = end_offset[start_pos][pair_start] + within
+    pair_flow = start_value[pair_start] * end_value[pair_end] / scale[start_pos][pair_start]
+
+    start_left = start_value * (scale - end_total)[start_pos] / scale[start_pos]
+    end_left = end_value * (scale - start_total)[end_pos] / scale[end_pos]
+    keep_pair = pair_flow > 0
+    keep_start = start_left > 0
+    keep_end = end_left > 0
+    return (
+        (pair_start[keep_pair], pair_end[keep_pair], pair_flow[keep_pair]),
+        (np.flatnonzero(keep_start), start_left[keep_start]),
+        (np.flatnonzero(keep_end), end_left[keep_end]),
+    )
+
+
+def _fill_loop(start_store, start_value, end_store, end_value, rng=None):
+    """逐门店循环配对（原始实现的规则），用于剩余量含负值的门店
+
+    每次取期初第一项与期末一项（rng为None时取第一项，否则随机选择），流量为两者较小值，
+    两侧都减去该流量，等于流量的一侧移出列表；负值同样按较小值配对，流量守恒与原始循环一致。
+    """
+    pair_start, pair_end, pair_flow = [], [], []
+    start_bounds = np.flatnonzero(np.r_[True, start_store[1:] != start_store[:-1], True])
+    end_bounds = np.flatnonzero(np.r_[True, end_store[1:] != end_store[:-1], True])
+    start_groups = {start_store[lo]: (lo, hi) for lo, hi in zip(start_bounds[:-1], start_bounds[1:])}
+    end_groups = {end_store[lo]: (lo, hi) for lo, hi in zip(end_bounds[:-1], end_bounds[1:])}
+    start_left, end_left = [], []
+    for store in np.unique(np.concatenate([start_store, end_store])):
+        lo, hi = start_groups.get(store, (0, 0))
+        start_remaining = [[i, start_value[i]] for i in range(lo, hi)]
+        lo, hi = end_groups.get(store, (0, 0))
+        end_remaining = [[j, end_value[j]] for j in range(lo, hi)]
+        while start_remaining and end_remaining:
+            idx = 0 if rng is None else int(rng.integers(len(end_remaining)))
+            (i, val1), (j, val2) = start_remaining[0], end_remaining[idx]
+            flow = min(val1, val2)
+            pair_start.append(i)
+            pair_end.append(j)
+            pair_flow.append(flow)
+            if val1 == flow:
+                start_remaining.pop(0)
+            else:
+                start_remaining[0][1] = val1 - flow
+            if val2 == flow:
+                end_remaining.pop(idx)
+            else:
+                end_remaining[idx][1] = val2 - flow
+        start_left += start_remaining
+        end_left += end_remaining
+
+    def unzip(items):
+        return (np.array([i for i, _ in items], dtype=np.int64),
+                np.array([value for _, value in items], dtype=np.float64))
+
+    return (
+        (np.array(pair_start, dtype=np.int64), np.array(pair_end, dtype=np.int64),
+         np.array(pair_flow, dtype=np.float64)),
+        unzip(start_left),
+        unzip(end_left),
+    )
+
+
+ALLOCATORS = {
+    'random': allocate_random,
+    'proportional': allocate_proportional,
+    'greedy': allocate_greedy,
+    'sequential': allocate_sequential,
+}
+
+
+def register_allocator(name, func, label=None):
+    """注册自定义分配策略，func签名与内置策略一致"""
+    ALLOCATORS[name] = func
+    ALLOCATION_LABELS[name] = label or name
+
+
+def allocate(start_store, start_value, end_store, end_value, strategy='sequential', seed=None):
+    """按指定策略分配所有门店的跨品牌转换流量；seed固定时结果可复现"""
+    if strategy not in ALLOCATORS:
+        raise ValueError(f"未知的分配策略: {strategy}")
+    rng = np.random.default_rng(seed)
+    start_store, start_value = np.asarray(start_store), np.asarray(start_value, dtype=float)
+    end_store, end_value = np.asarray(end_store), np.asarray(end_value, dtype=float)
+    negative = np.union1d(start_store[start_value < 0], end_store[end_value < 0])
+    if not len(negative):
+        return ALLOCATORS[strategy](start_store, start_value, end_store, end_value, rng=rng)
+
+    # 含负值的门店按逐门店循环配对（random策略随机选择期末一项），其余门店按所选策略
+    start_loop = np.isin(start_store, negative)
+    end_loop = np.isin(end_store, negative)
+    pairs, start_left, end_left = ([], [], []), ([], []), ([], [])
+    for in_loop, allocator in ((False, ALLOCATORS[strategy]), (True, _fill_loop)):
+        start_rows = np.flatnonzero(start_loop == in_loop)
+        end_rows = np.flatnonzero(end_loop == in_loop)
+        (pair_start, pair_end, pair_flow), start_rest, end_rest = allocator(
+            start_store[start_rows], start_value[start_rows], end_store[end_rows], end_value[end_rows],
+            rng=rng if not in_loop or strategy == 'random' else None,
+        )
+        for parts, arrays in ((pairs, (start_rows[pair_start], end_rows[pair_end], pair_flow)),
+                              (start_left, (start_rows[start_rest[0]], start_rest[1])),
+                              (end_left, (end_rows[end_rest[0]], end_rest[1]))):
+            for part, array in zip(parts, arrays):
+                part.append(array)
+    return tuple(tuple(np.concatenate(part) for part in parts) for parts in (pairs, start_left, end_left))
@@ -0,0 +1,303 @@
+"""基准测试：用合成面板数据测量各阶段耗时、吞吐量和峰值内存，并核对各计算引擎的流量
+
+示例：
+    python benchmark.py                                  # 1万/10万/100万门店
+    python benchmark.py --stores 10000 --workers 2 --json bench.json
+
+每个规模依次运行 列式转换 -> 读取清洗 -> 全粒度汇总 -> Top N -> 流向 -> 汇总 -> 占比表
+-> 品牌报告 -> 桑基图；随后用同一份数据分别以向量化、多进程、期间立方体（缓存）
+以及逐门店循环（仅小规模）计算流向，核对各节点的流入、流出总量是否一致
+（sequential策略下逐条链接也应一致）。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from allocator import ALLOCATION_LABELS
+from brands import process_brands
+from diagnostics import PipelineProfiler
+from flow_engine import FLOW_DECIMALS, FLOW_RTOL, flow_decimals, flows_from_totals
+from ingest import scan_columnar, write_columnar
+from parallel import compute_flows_parallel
+from period_cube import cube_from_totals
+from pipeline import (SankeyChart, aggregate_flows, brand_report, full_brand_totals, load_clean_data,
+                      percentage_table, sankey_spec, top_n_totals)
+from synthetic import VALUE_DECIMALS, synthetic_panel
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+# 逐门店循环很慢，只在不超过该门店数时运行
+REFERENCE_MAX_STORES = 10_000
+
+
+def _brand_values(group, period):
+    return group[group['Q'] == period].groupby('brand_processed', observed=True)['Value U'].sum()
+
+
+def reference_flows(df, start_period, end_period, strategy='sequential', seed=None):
+    """逐门店循环计算流向（原始实现，浮点计算不取整），作为核对向量化引擎的基准
+
+    sequential策略按剩余列表顺序配对，random策略用random.choice随机选择期末品牌。
+    与引擎在FLOW_RTOL内一致；计算单位或取整有误时核对失败。
+    """
+    rng = random.Random(seed)
+    flow_results = []
+
+    for _, group in df.groupby('Passport_id', observed=True):
+        has_start = start_period in group['Q'].values
+        has_end = end_period in group['Q'].values
+
+        # 场景1：只有期末 -> 期初_新增门店
+        if not has_start and has_end:
+            brand_data = _brand_values(group, end_period)
+            for brand, value in brand_data.items():
+                flow_results.append(("期初_新增门店", f"期末_{brand}", value))
+            continue
+
+        # 场景2：只有期初 -> 期末_门店流失
+        if has_start and not has_end:
+            brand_data = _brand_values(group, start_period)
+            for brand, value in brand_data.items():
+                flow_results.append((f"期初_{brand}", "期末_门店流失", value))
+            continue
+
+        if not (has_start and has_end):
+            continue
+
+        # 场景3：相同品牌优先匹配，再配对不同品牌的剩余量
+        start_dict = _brand_values(group, start_period).to_dict()
+        end_dict = _brand_values(group, end_period).to_dict()
+        remaining_start = start_dict.copy()
+        remaining_end = end_dict.copy()
+        for brand in set(start_dict) & set(end_dict):
+            flow = min(start_dict[brand], end_dict[brand])
+            flow_results.append((f"期初_{brand}", f"期末_{brand}", flow))
+            remaining_start[brand] -= flow
+            remaining_end[brand] -= flow
+            if remaining_start[brand] == 0:
+                del remaining_start[brand]
+            if remaining_end[brand] == 0:
+                del remaining_end[brand]
+
+        start_remaining = list(remaining_start.items())
+        end_remaining = list(remaining_end.items())
+        while start_remaining and end_remaining:
+            brand1, val1 = start_remaining[0]
+            idx = 0 if strategy == 'sequential' else rng.randrange(len(end_remaining))
+            brand2, val2 = end_remaining[idx]
+            flow = min(val1, val2)
+            flow_results.append((f"期初_{brand1}", f"期末_{brand2}", flow))
+            if val1 == flow:
+                start_remaining.pop(0)
+            else:
+                start_remaining[0] = (brand1, val1 - flow)
+            if val2 == flow:
+                end_remaining.pop(idx)
+            else:
+                end_remaining[idx] = (brand2, val2 - flow)
+
+        for brand, value in start_remaining:
+            flow_results.append((f"期初_{brand}", "期末_品类流失", value))
+        for brand, value in end_remaining:
+            flow_results.append(("期初_新增品类", f"期末_{brand}", value))
+
+    return pd.DataFrame(flow_results, columns=['起始点', '目标点', '流量'])
+
+
+def _totals_by(labeled, columns):
+    return labeled.groupby(columns)['流量'].sum().sort_index()
+
+
+def compare_flows(expected, actual, compare_links):
+    """比较两份带标签流向表：各节点流出/流入总量（以及可选的逐条链接总量），返回最大相对误差"""
+    keys = [['起始点'], ['目标点']] + ([['起始点', '目标点']] if compare_links else [])
+    worst = 0.0
+    for columns in keys:
+        left, right = _totals_by(expected, columns).align(_totals_by(actual, columns), fill_value=0.0)
+        scale = max(float(left.abs().max() or 0.0), 1.0)
+        worst = max(worst, float((left - right).abs().max() or 0.0) / scale)
+    return worst
+
+
+def run_size(n_stores, args, workdir):
+    """在一个规模上运行各阶段并核对引擎结果，返回结果字典"""
+    profiler = PipelineProfiler(trace_memory=args.trace_memory)
+    stage = profiler.stage
+
+    with stage("generate") as record:
+        panel = synthetic_panel(n_stores=n_stores, n_brands=args.brands, n_quarters=args.quarters,
+                                brands_per_store=args.brands_per_store, brand_churn=args.brand_churn,
+                                store_churn=args.store_churn, rows_per_brand=args.rows_per_brand,
+                                seed=args.seed)
+        record.rows = len(panel)
+    rows = len(panel)
+
+    columnar_file = os.path.join(workdir, f"panel_{n_stores}.feather")
+    with stage("columnar") as record:
+        write_columnar(panel, columnar_file)
+        record.rows = rows
+    del panel
+
+    with stage("scan") as record:
+        periods, raw_brand_totals = scan_columnar(columnar_file)
+        record.rows = rows
+    start_period, end_period = periods[0], periods[1]
+
+    with stage("clean") as record:
+        df = load_clean_data(columnar_file, periods)
+        record.rows = len(df)
+
+    with stage("totals") as record:
+        full_totals, full_nodes = full_brand_totals(df, periods)
+        record.rows = sum(len(period_totals) for period_totals in full_totals.values())
+
+    with stage("top_n") as record:
+        totals, nodes, top_brands = top_n_totals(full_totals, full_nodes, raw_brand_totals, args.top_n)
+        record.rows = sum(len(period_totals) for period_totals in totals.values())
+
+    # 合成数据以分为单位，计算单位应选择VALUE_DECIMALS位小数
+    values = np.concatenate([totals[start_period].to_numpy(), totals[end_period].to_numpy()])
+    unit_decimals = flow_decimals(values)
+    unit_ok = FLOW_DECIMALS is None or unit_decimals == max(FLOW_DECIMALS, VALUE_DECIMALS)
+
+    with stage("flows") as record:
+        flow_table = flows_from_totals(totals[start_period], totals[end_period], nodes,
+                                       strategy=args.strategy, seed=args.seed)
+        record.rows = len(flow_table.flows)
+
+    with stage("aggregate") as record:
+        aggregated_df, source_flow, target_flow = aggregate_flows(flow_table.flows)
+        record.rows = len(flow_table.flows)
+
+    with stage("percentage") as record:
+        percentage_df = percentage_table(aggregated_df, source_flow, target_flow, nodes)
+        record.rows = len(percentage_df)
+
+    with stage("report") as record:
+        brand_report(percentage_df, source_flow, target_flow, nodes)
+        record.rows = len(percentage_df)
+
+    with stage("figure") as record:
+        spec, _, _ = sankey_spec(aggregated_df, source_flow, target_flow, nodes, title="benchmark",
+                                 min_link_share=args.min_link_share, max_links=args.max_links)
+        SankeyChart(spec)
+        record.rows = len(spec['data'][0]['link']['value'])
+
+    # 各引擎使用同一份Top N数据
+    engines = {'vectorized': flow_table}
+    with stage("engine_parallel") as record:
+        processed = process_brands(df, top_brands)
+        engines['parallel'] = compute_flows_parallel(processed, start_period, end_period,
+                                                     strategy=args.strategy, seed=args.seed,
+                                                     workers=args.workers)
+        record.rows = len(processed)
+    with stage("engine_cube") as record:
+        cube = cube_from_totals(totals, nodes, periods, mode='consecutive',
+                                strategy=args.strategy, seed=args.seed)
+        engines['cube'] = cube.flows(start_period, end_period)
+        record.rows = sum(len(period_totals) for period_totals in totals.values())
+
+    labeled = {name: table.labeled() for name, table in engines.items()}
+    if n_stores <= args.reference_max_stores:
+        with stage("engine_reference") as record:
+            reference_df = processed[processed['Q'].isin([start_period, end_period])].copy()
+            labeled['reference'] = reference_flows(reference_df, start_period, end_period,
+                                                   strategy=args.strategy, seed=args.seed)
+            record.rows = len(reference_df)
+        baseline = 'reference'
+    else:
+        baseline = 'vectorized'
+
+    # random策略下各引擎的跨品牌配对不同，只核对节点总量
+    compare_links = args.strategy == 'sequential'
+    checks = {}
+    for name, table in labeled.items():
+        if name == baseline:
+            continue
+        error = compare_flows(labeled[baseline], table, compare_links)
+        checks[name] = {'baseline': baseline, 'max_rel_error': error, 'ok': error <= args.tolerance}
+
+    stages = profiler.to_records()
+    for record in stages:
+        seconds = record['seconds']
+        record['rows_per_second'] = round(record['rows'] / seconds) if record['rows'] and seconds else None
+    return {
+        'stores': n_stores,
+        'rows': rows,
+        'periods': [start_period, end_period],
+        'stages': stages,
+        'checks': checks,
+        'unit': {'decimals': unit_decimals, 'ok': unit_ok},
+        'reconciliation': flow_table.reconciliation.to_dict(),
+    }
+
+
+def print_result(result, file=sys.stdout):
+    print(f"\n门店数 {result['stores']:,}  行数 {result['rows']:,}  "
+          f"期间 {result['periods'][0]} -> {result['periods'][1]}", file=file)
+    print(f"{'阶段':<18}{'耗时(s)':>10}{'行数':>12}{'行/秒':>14}{'峰值RSS(MB)':>14}", file=file)
+    for record in result['stages']:
+        throughput = record['rows_per_second']
+        print(f"{record['stage']:<18}{record['seconds']:>10.3f}{record['rows'] or 0:>12,}"
+              f"{throughput or 0:>14,}{record['peak_rss_mb'] or 0:>14.1f}", file=file)
+    for name, check in result['checks'].items():
+        status = "一致" if check['ok'] else "不一致"
+        print(f"{name} vs {check['baseline']}: {status}（最大相对误差 {check['max_rel_error']:.2e}）", file=file)
+    unit = result['unit']
+    print(f"计算单位: {unit['decimals']}位小数（{'正确' if unit['ok'] else '错误'}）", file=file)
+    reconciliation = result['reconciliation']
+    print(f"流量核对: 期初 {reconciliation['start_total']:,.2f} / 流出 {reconciliation['outflow']:,.2f}，"
+          f"期末 {reconciliation['end_total']:,.2f} / 流入 {reconciliation['inflow']:,.2f}，"
+          f"链接 {reconciliation['links']:,}（清理 {reconciliation['dropped']:,}）", file=file)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="桑基图流程基准测试（合成面板数据）")
+    parser.add_argument("--stores", nargs="+", type=int, default=DEFAULT_SIZES, help="门店数（可多个规模）")
+    parser.add_argument("--brands", type=int, default=30, help="品牌数")
+    parser.add_argument("--quarters", type=int, default=4, help="期间数")
+    parser.add_argument("--brands-per-store", type=int, default=3, help="每个门店经营的品牌数")
+    parser.add_argument("--brand-churn", type=float, default=0.1, help="每期品牌替换概率")
+    parser.add_argument("--store-churn", type=float, default=0.05, help="每期门店开店/关店概率")
+    parser.add_argument("--rows-per-brand", type=int, default=1, help="每个（门店，品牌，期间）的明细行数")
+    parser.add_argument("--top-n", type=int, default=10, help="保留Top N品牌数量")
+    parser.add_argument("--strategy", choices=list(ALLOCATION_LABELS), default="sequential",
+                        help="品牌转换分配方式（sequential时逐条链接核对）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--workers", type=int, default=2, help="多进程引擎的进程数")
+    parser.add_argument("--min-link-share", type=float, default=0.0, help="桑基图链接最小占比")
+    parser.add_argument("--max-links", type=int, default=500, help="桑基图最多链接数")
+    parser.add_argument("--reference-max-stores", type=int, default=REFERENCE_MAX_STORES,
+                        help="不超过该门店数时运行逐门店循环核对")
+    parser.add_argument("--tolerance", type=float, default=FLOW_RTOL, help="核对允许的最大相对误差")
+    parser.add_argument("--trace-memory", action="store_true", help="用tracemalloc记录各阶段内存分配峰值")
+    parser.add_argument("--json", default=None, help="结果写入JSON文件")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.quarters < 2:
+        build_parser().error("--quarters 至少为2")
+    results = []
+    with tempfile.TemporaryDirectory(prefix="sankey_bench_") as workdir:
+        for n_stores in args.stores:
+            result = run_size(n_stores, args, workdir)
+            print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump({'config': vars(args), 'results': results}, output, ensure_ascii=False, indent=2)
+    ok = all(check['ok'] for result in results for check in result['checks'].values())
+    ok = ok and all(result['unit']['ok'] for result in results)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""品牌处理：清洗品牌名称，保留Top N品牌，其余归为'其他品牌'
+
+清洗只对去重后的品牌取值做一次，再通过分类编码映射回每一行；
+可选的品牌别名字典把拼写变体合并为标准名称，保存在JSON文件中，跨上传文件复用。
+"""
+import difflib
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from nodes import OTHER_BRAND_NAME
+
+try:
+    from thefuzz import fuzz, process
+except ImportError:  # 没有thefuzz时用difflib计算名称相似度
+    fuzz = process = None
+
+try:
+    import jieba
+except ImportError:  # 没有jieba时中文名称按字符比较
+    jieba = None
+
+# 品牌别名字典文件：{变体名称: 标准名称}（均为清洗后的名称）
+ALIAS_FILE = os.environ.get("SANKEY_BRAND_ALIASES", "brand_aliases.json")
+
+
+def normalize_names(names):
+    """品牌名称 -> 清洗后的名称（去首尾空格、转小写），缺失值保持缺失"""
+    return pd.Index(names, dtype=object).str.strip().str.lower()
+
+
+def apply_aliases(names, aliases=None):
+    """按别名字典把清洗后的名称替换为标准名称（names通常为去重后的取值）"""
+    names = pd.Index(names, dtype=object)
+    if not aliases:
+        return names
+    return pd.Index([aliases.get(name, name) for name in names], dtype=object)
+
+
+def clean_brand_totals(raw_brand_totals, aliases=None):
+    """原始品牌名称 -> Value U合计 汇总为 清洗后（并合并别名后）的品牌 -> Value U合计"""
+    names = apply_aliases(normalize_names(raw_brand_totals.index), aliases)
+    return raw_brand_totals.groupby(names.to_numpy()).sum().rename_axis('brand_clean')
+
+
+def select_top_brands(raw_brand_totals, top_n, aliases=None):
+    """按全期金额选出Top N品牌（清洗后的名称）
+
+    raw_brand_totals为原始品牌名称 -> Value U合计（见ingest.scan_columnar）。
+    """
+    brand_values = clean_brand_totals(raw_brand_totals, aliases).reset_index(name='Value U')
+    brand_values_sorted = brand_values.sort_values('Value U', ascending=False)
+    return brand_values_sorted.head(top_n)['brand_clean'].tolist()
+
+
+def clean_brands(df):
+    """添加brand_clean列：清洗后的全粒度品牌（分类类型，类别按名称排序）
+
+    只清洗去重后的品牌取值，再按分类编码映射回每一行；
+    缺失的品牌直接记为'其他品牌'，与Top N归类的结果一致。
+    """
+    df = df.copy()
+    values = df['brand']
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    codes = values.cat.codes.to_numpy()
+    cleaned = normalize_names(values.cat.categories)
+    # 只保留实际出现的取值（与逐行清洗后取唯一值一致）
+    present = np.bincount(codes[codes >= 0], minlength=len(cleaned)) > 0
+    names = set(cleaned[present])
+    if (codes < 0).any():
+        names.add(OTHER_BRAND_NAME)
+    categories = pd.Index(sorted(names), dtype=object)
+    lookup = np.append(categories.get_indexer(cleaned), categories.get_indexer([OTHER_BRAND_NAME]))
+    df['brand_clean'] = pd.Categorical.from_codes(lookup[codes], categories)
+    return df
+
+
+def top_brand_mapping(brands, top_brands, aliases=None):
+    """全粒度品牌 -> Top N品牌的编码映射
+
+    返回 (映射数组, Top N品牌类别)：映射数组第i项为brands[i]合并别名、归类后在类别中的编码。
+    """
+    categories = pd.Index(sorted(set(top_brands) | {OTHER_BRAND_NAME}), dtype=object)
+    brands = apply_aliases(brands, aliases)
+    mapped = brands.where(brands.isin(top_brands), OTHER_BRAND_NAME)
+    return categories.get_indexer(mapped), categories
+
+
+def process_brands(df, top_brands, aliases=None):
+    """添加brand_clean和brand_processed列（分类类型，类别按名称排序）
+
+    已有brand_clean分类列时不再清洗，只按编码映射归类。
+    """
+    if 'brand_clean' in df.columns and isinstance(df['brand_clean'].dtype, pd.CategoricalDtype):
+        df = df.copy()
+    else:
+        df = clean_brands(df)
+    mapping, categories = top_brand_mapping(df['brand_clean'].cat.categories, top_brands, aliases)
+    codes = df['brand_clean'].cat.codes.to_numpy()
+    df['brand_processed'] = pd.Categorical.from_codes(mapping[codes], categories)
+    return df
+
+
+def resolve_aliases(aliases):
+    """清洗别名字典：名称统一清洗，展开链式别名（a->b->c 记为 a->c），去掉指向自身和成环的项"""
+    cleaned = {}
+    for variant, canonical in aliases.items():
+        variant, canonical = normalize_names([variant, canonical])
+        if variant != canonical:
+            cleaned[variant] = canonical
+    resolved = {}
+    for variant, canonical in cleaned.items():
+        seen = {variant}
+        while canonical in cleaned and canonical not in seen:
+            seen.add(canonical)
+            canonical = cleaned[canonical]
+        if canonical not in seen:
+            resolved[variant] = canonical
+    return resolved
+
+
+def load_aliases(path=ALIAS_FILE):
+    """读取品牌别名字典，文件不存在时为空字典"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as source:
+        return resolve_aliases(json.load(source))
+
+
+def save_aliases(aliases, path=ALIAS_FILE):
+    """保存品牌别名字典（先写临时文件再替换），返回清洗后的字典"""
+    aliases = resolve_aliases(aliases)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as output:
+        json.dump(dict(sorted(aliases.items())), output, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return aliases
+
+
+def alias_fingerprint(aliases):
+    """别名字典的摘要，用作缓存键的一部分；没有别名时为空字符串"""
+    if not aliases:
+        return ""
+    payload = json.dumps(sorted(aliases.items()), ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def _comparable(name):
+    # 中文名称先分词，使词序不同的写法也能匹配
+    if jieba is not None:
+        return " ".join(token for token in jieba.lcut(name) if token.strip())
+    return name
+
+
+def _digits(name):
+    return re.findall(r"\d+", name)
+
+
+def _best_match(name, canonicals, threshold):
+    if not canonicals:
+        return None
+    if process is not None:
+        match = process.extractOne(name, canonicals, scorer=fuzz.token_sort_ratio, score_cutoff=threshold)
+        return match[0] if match else None
+    matches = difflib.get_close_matches(name, canonicals, n=1, cutoff=threshold / 100)
+    return matches[0] if matches else None
+
+
+def suggest_aliases(raw_brand_totals, threshold=90, aliases=None):
+    """按名称相似度为拼写变体生成别名建议：{变体名称: 标准名称}
+
+    品牌按金额从大到小处理，与已有标准名称的相似度不低于threshold（0-100）时
+    合并到该名称，否则自身成为标准名称；'其他品牌'不参与合并。
+    名称中的数字不同（如规格、型号）时视为不同品牌。
+    """
+    brand_values = clean_brand_totals(raw_brand_totals, aliases).sort_values(ascending=False)
+    canonicals = {}
+    suggestions = {}
+    for name in brand_values.index:
+        if name == OTHER_BRAND_NAME or not name:
+            continue
+        comparable = _comparable(name)
+        candidates = [candidate for candidate in canonicals if _digits(candidate) == _digits(comparable)]
+        match = _best_match(comparable, candidates, threshold)
+        if match is None:
+            canonicals[comparable] = name
+        else:
+            suggestions[name] = canonicals[match]
+    return suggestions
@@ -0,0 +1,262 @@
+"""有界LRU缓存：避免Streamlit每次重跑都重新解析上传文件和计算流向
+
+SHARED_STORE为进程内所有会话共享的结果缓存：键为文件内容哈希加计算参数（按内容寻址），
+多个会话上传同一文件、使用相同参数时共用同一份数据和流向结果。
+"""
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def estimate_size(value):
+    """估算缓存对象占用的内存字节数"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value.values())
+    # FlowTable等自带nbytes的结果对象
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """按最近使用顺序淘汰的缓存，同时限制条目数和总字节数"""
+
+    def __init__(self, max_entries=8, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._items:
+                self.total_bytes -= self._items.pop(key)[1]
+            # 单个对象超过上限时不缓存
+            if self.max_bytes is not None and size > self.max_bytes:
+                evicted = [(key, value)]
+            else:
+                self._items[key] = (value, size)
+                self.total_bytes += size
+                evicted = self._evict()
+        self._on_evict(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, size = self._items.pop(key)
+            self.total_bytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+    def _evict(self):
+        evicted = []
+        while self._items and (
+            len(self._items) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            key, (value, size) = self._items.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append((key, value))
+        return evicted
+
+    def _on_evict(self, evicted):
+        """淘汰出内存的条目（在锁外调用）"""
+
+
+# 共享缓存的内存上限、条目数和可选的磁盘溢出目录
+SHARED_CACHE_BYTES = int(os.environ.get("SANKEY_CACHE_BYTES", str(4 * 1024 ** 3)))
+SHARED_CACHE_ENTRIES = int(os.environ.get("SANKEY_CACHE_ENTRIES", "256"))
+CACHE_SPILL_DIR = os.environ.get("SANKEY_CACHE_DIR") or None
+CACHE_SPILL_BYTES = int(os.environ.get("SANKEY_CACHE_DISK_BYTES", str(20 * 1024 ** 3)))
+# 结果格式或计算规则变化时递增，磁盘上的旧结果不再命中
+CACHE_VERSION = 3
+
+
+def key_digest(key):
+    """缓存键 -> 内容地址（磁盘文件名）"""
+    return hashlib.sha256(repr((CACHE_VERSION, key)).encode("utf-8")).hexdigest()
+
+
+class SharedStore(LRUCache):
+    """进程内共享的结果缓存：全局内存上限，按LRU淘汰，可选溢出到本地磁盘
+
+    淘汰出内存的结果写入spill_dir（pickle，文件名为键的摘要），再次读取时从磁盘载入；
+    无法序列化的对象（如持有分区文件的数据集）直接丢弃。磁盘占用超过spill_bytes时删除最早的文件。
+    """
+
+    def __init__(self, max_entries=SHARED_CACHE_ENTRIES, max_bytes=SHARED_CACHE_BYTES,
+                 spill_dir=CACHE_SPILL_DIR, spill_bytes=CACHE_SPILL_BYTES):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes)
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key_digest(key)}.pkl")
+
+    def __contains__(self, key):
+        return super().__contains__(key) or bool(self.spill_dir and os.path.exists(self._spill_path(key)))
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if value is not default or not self.spill_dir:
+            return value
+        path = self._spill_path(key)
+        try:
+            with open(path, "rb") as source:
+                value = pickle.load(source)
+        except FileNotFoundError:
+            return default
+        except Exception:  # 文件损坏或版本不兼容时当作未命中
+            self._remove(path)
+            return default
+        # 载入后放回内存，磁盘文件保留（再次淘汰时无需重写）
+        os.utime(path)
+        super().put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        value = super().pop(key, default)
+        if self.spill_dir:
+            self._remove(self._spill_path(key))
+        return value
+
+    def clear(self):
+        super().clear()
+        if self.spill_dir:
+            for name in os.listdir(self.spill_dir):
+                if name.endswith(".pkl"):
+                    self._remove(os.path.join(self.spill_dir, name))
+
+    def namespace(self, name):
+        """返回键自动加上name前缀的视图（不同用途的键互不冲突，共用内存上限）"""
+        return StoreNamespace(self, name)
+
+    def _on_evict(self, evicted):
+        if not self.spill_dir:
+            return
+        for key, value in evicted:
+            path = self._spill_path(key)
+            if os.path.exists(path):
+                continue
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as output:
+                    pickle.dump(value, output, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except Exception:
+                self._remove(tmp_path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        entries = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith(".pkl"):
+                path = os.path.join(self.spill_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.spill_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class StoreNamespace:
+    """共享缓存中带前缀的视图，接口与LRUCache一致"""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __contains__(self, key):
+        return (self.name, key) in self.store
+
+    def get(self, key, default=None):
+        return self.store.get((self.name, key), default)
+
+    def put(self, key, value):
+        self.store.put((self.name, key), value)
+
+    def pop(self, key, default=None):
+        return self.store.pop((self.name, key), default)
+
+
+# 所有会话共享的结果缓存
+SHARED_STORE = SharedStore()
+
+
+def content_hash(data):
+    """计算字节内容的SHA-256摘要"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def upload_hash(uploaded_file, memo=None):
+    """返回上传文件的内容哈希；memo按上传记录缓存摘要，避免每次重跑都重新读取文件"""
+    upload_id = (
+        getattr(uploaded_file, 'file_id', None) or getattr(uploaded_file, 'id', None),
+        uploaded_file.name,
+        uploaded_file.size,
+    )
+    if memo is not None and upload_id in memo:
+        return memo[upload_id]
+    digest = content_hash(uploaded_file.getvalue())
+    if memo is not None:
+        memo[upload_id] = digest
+    return digest
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """按块计算本地文件内容的SHA-256摘要（与content_hash结果一致）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,202 @@
+"""批量生成桑基图结果（不依赖Streamlit）
+
+示例：
+    python cli.py data1.xlsx data2.csv --pairs Q1:Q2 Q2:Q3 --top-n 10 --out output
+    python cli.py data.parquet --pair-mode consecutive --jobs 4 --format png
+    python cli.py huge.parquet --out-of-core on --jobs 4
+
+每个（文件，期间组合）输出 流向数据CSV、流量占比CSV、品牌分析报告和桑基图。
+同一文件只解析一次：先转换为列式文件，各进程内存映射读取本进程期间组合用到的期间，
+进程内的全粒度（门店，品牌）汇总在这些期间组合之间共享。
+超出内存的大文件（见out_of_core）在主进程中按Passport_id分区落盘，
+一次遍历分区计算所有期间组合，分区之间按 --jobs 并行。
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from allocator import ALLOCATION_LABELS
+from brands import load_aliases
+from parallel import DEFAULT_WORKERS
+from period_cube import period_pairs
+from pipeline import (Dataset, aggregate_flows, brand_report, flow_download_table, open_dataset, percentage_table,
+                      sankey_figure)
+
+FIGURE_FORMATS = ["html", "png", "svg", "pdf"]
+
+
+def parse_pair(text):
+    """'Q1:Q2' -> ('Q1', 'Q2')"""
+    start, sep, end = text.partition(":")
+    if not sep or not start or not end:
+        raise argparse.ArgumentTypeError(f"期间组合格式应为 期初:期末，实际为 {text}")
+    return start, end
+
+
+def write_outputs(dataset, start_period, end_period, out_dir, top_n=10, strategy='sequential',
+                  seed=None, highlight_keyword="", show_rank_value=True, figure_format="html", flow_table=None):
+    """计算一个期间组合并写出结果文件，返回写出的文件路径列表
+
+    flow_table为已计算的流向表（如分区一次遍历的结果）时直接使用，不再计算。
+    """
+    if flow_table is None:
+        flow_table = dataset.flows(start_period, end_period, top_n=top_n, strategy=strategy, seed=seed)
+    os.makedirs(out_dir, exist_ok=True)
+    suffix = f"{start_period}_to_{end_period}"
+    paths = []
+
+    flow_path = os.path.join(out_dir, f"桑基图流向数据_{suffix}.csv")
+    flow_download_table(flow_table).to_csv(flow_path, index=False, encoding="utf-8-sig")
+    paths.append(flow_path)
+    if flow_table.empty:
+        return paths
+
+    aggregated_df, source_flow, target_flow = aggregate_flows(flow_table.flows)
+    percentage_df = percentage_table(aggregated_df, source_flow, target_flow, flow_table.nodes)
+    percentage_path = os.path.join(out_dir, f"桑基图流量占比数据_{suffix}.csv")
+    percentage_df.drop(columns=['source', 'target']).to_csv(percentage_path, index=False, encoding="utf-8-sig")
+    paths.append(percentage_path)
+
+    report_path = os.path.join(out_dir, f"品牌流量分析报告_{suffix}.md")
+    with open(report_path, "w", encoding="utf-8") as report:
+        report.write("\n\n".join(brand_report(percentage_df, source_flow, target_flow, flow_table.nodes)) + "\n")
+    paths.append(report_path)
+
+    fig, _, _ = sankey_figure(aggregated_df, source_flow, target_flow, flow_table.nodes,
+                              highlight_keyword=highlight_keyword, show_rank_value=show_rank_value,
+                              title=f"品牌流量桑基图（{start_period} → {end_period}）")
+    figure_path = os.path.join(out_dir, f"桑基图_{suffix}.{figure_format}")
+    if figure_format == "html":
+        fig.write_html(figure_path, include_plotlyjs="cdn")
+    else:
+        fig.write_image(figure_path)
+    paths.append(figure_path)
+    return paths
+
+
+def _available_pairs(dataset, pairs):
+    # 命令行中的期间为字符串，按字符串匹配文件中的期间（CSV/Parquet中的Q可能为整数）
+    periods = {str(period): period for period in dataset.periods}
+    available = []
+    for start_period, end_period in pairs:
+        if str(start_period) not in periods or str(end_period) not in periods:
+            print(f"跳过 {dataset.name} {start_period} -> {end_period}：文件中没有该期间", file=sys.stderr)
+            continue
+        available.append((periods[str(start_period)], periods[str(end_period)]))
+    return available
+
+
+def write_pairs(dataset, pairs, out_dir, options, tables=None):
+    """写出各期间组合的结果；tables为已计算的 {(期初, 期末): FlowTable}"""
+    written = []
+    for start_period, end_period in pairs:
+        flow_table = None if tables is None else tables[(start_period, end_period)]
+        written.extend(write_outputs(dataset, start_period, end_period,
+                                     os.path.join(out_dir, dataset.name), flow_table=flow_table, **options))
+    return written
+
+
+def run_task(columnar_file, name, aliases, scan, pairs, out_dir, options):
+    """子进程：同一文件的多个期间组合共享解析后的数据，只读取这些组合用到的期间"""
+    used_periods = {period for pair in pairs for period in pair}
+    dataset = Dataset(columnar_file, name, aliases, used_periods=used_periods, scan=scan)
+    return write_pairs(dataset, pairs, out_dir, options)
+
+
+def run_out_of_core(dataset, pairs, pair_mode, out_dir, options):
+    """主进程：一次遍历分区计算该文件的所有期间组合，写出后删除分区文件"""
+    file_pairs = _available_pairs(dataset, pairs or period_pairs(dataset.periods, pair_mode))
+    try:
+        tables = dataset.compute_pairs(file_pairs, top_n=options['top_n'], strategy=options['strategy'],
+                                       seed=options['seed'])
+        return write_pairs(dataset, file_pairs, out_dir, options, tables)
+    finally:
+        dataset.close()
+
+
+def plan_tasks(datasets, pairs, pair_mode, jobs):
+    """把（文件，期间组合）划分为任务：每个任务处理一个文件的一批期间组合
+
+    期间在主进程中按文件的扫描结果匹配，扫描结果随任务传给子进程（子进程不再扫描文件）。
+    """
+    tasks = []
+    for dataset in datasets:
+        file_pairs = _available_pairs(dataset, pairs or period_pairs(dataset.periods, pair_mode))
+        scan = (dataset.periods, dataset.raw_brand_totals)
+        # 组合数较多时拆分到多个进程，每个进程各自内存映射同一个列式文件；
+        # 按顺序连续切分，相邻组合共用期间，每个进程读取的期间最少
+        n_chunks = max(1, min(len(file_pairs), jobs // max(len(datasets), 1)))
+        bounds = [round(i * len(file_pairs) / n_chunks) for i in range(n_chunks + 1)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if hi > lo:
+                tasks.append((dataset.columnar_file, dataset.name, dataset.aliases, scan, file_pairs[lo:hi]))
+    return tasks
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="批量生成品牌流量桑基图结果")
+    parser.add_argument("inputs", nargs="+", help="数据文件（.xlsx / .csv / .parquet）")
+    parser.add_argument("--pairs", nargs="+", type=parse_pair, metavar="期初:期末",
+                        help="要计算的期间组合，如 Q1:Q2；不指定时按 --pair-mode 生成")
+    parser.add_argument("--pair-mode", choices=["consecutive", "all"], default="consecutive",
+                        help="未指定 --pairs 时的期间组合：相邻期间或所有组合")
+    parser.add_argument("--top-n", type=int, default=10, help="保留Top N品牌数量")
+    parser.add_argument("--strategy", choices=list(ALLOCATION_LABELS), default="sequential",
+                        help="品牌转换分配方式")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--highlight", default="家乐", help="节点高亮关键词")
+    parser.add_argument("--no-rank-value", action="store_true", help="节点标签中不显示排名和数值")
+    parser.add_argument("--format", choices=FIGURE_FORMATS, default="html", help="桑基图输出格式")
+    parser.add_argument("--out", default="output", help="输出目录")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_WORKERS, help="并行进程数")
+    parser.add_argument("--cache-dir", default=None, help="列式文件缓存目录")
+    parser.add_argument("--out-of-core", choices=["auto", "on", "off"], default="auto",
+                        help="按Passport_id分区落盘计算：auto为超过行数阈值时启用")
+    parser.add_argument("--aliases", default=None, metavar="JSON",
+                        help="品牌别名字典文件（{变体名称: 标准名称}），合并拼写变体")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.format != "html":
+        try:
+            import kaleido  # noqa: F401
+        except ImportError:
+            parser.error("输出静态图片需要安装kaleido（pip install kaleido），或使用 --format html")
+    options = dict(top_n=args.top_n, strategy=args.strategy, seed=args.seed,
+                   highlight_keyword=args.highlight, show_rank_value=not args.no_rank_value,
+                   figure_format=args.format)
+
+    # 每个文件只转换一次，子进程直接读取列式文件
+    jobs = max(1, args.jobs)
+    out_of_core = {"auto": None, "on": True, "off": False}[args.out_of_core]
+    aliases = load_aliases(args.aliases) if args.aliases else {}
+    datasets = [open_dataset(path, args.cache_dir, out_of_core, workers=jobs, aliases=aliases)
+                for path in args.inputs]
+
+    tasks = plan_tasks([dataset for dataset in datasets if not dataset.out_of_core],
+                       args.pairs, args.pair_mode, jobs)
+    if jobs == 1:
+        results = [run_task(*task, args.out, options) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=get_context("spawn")) as executor:
+            futures = [executor.submit(run_task, *task, args.out, options) for task in tasks]
+            results = [future.result() for future in futures]
+    results.extend(run_out_of_core(dataset, args.pairs, args.pair_mode, args.out, options)
+                   for dataset in datasets if dataset.out_of_core)
+
+    for paths in results:
+        for path in paths:
+            print(path)
+    if not any(results):
+        print("没有计算任何期间组合（请检查 --pairs 中的期间）", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""运行诊断：按阶段记录耗时、内存和行数，可选采集一次cProfile"""
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+import weakref
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # 没有psutil时不记录当前RSS
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块，不记录峰值RSS
+    resource = None
+
+_MB = 1024 * 1024
+
+# tracemalloc是进程级的：各会话、各任务的记录器按引用计数共用，全部释放后才停止
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started = False
+
+
+def _acquire_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started = True
+        _tracing_users += 1
+
+
+def _release_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        _tracing_users -= 1
+        # 外部启动的跟踪（如python -X tracemalloc）不停止
+        if _tracing_users == 0 and _tracing_started:
+            tracemalloc.stop()
+            _tracing_started = False
+
+
+def current_rss():
+    """当前进程常驻内存（字节），无法获取时为None"""
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def peak_rss():
+    """进程启动以来的峰值常驻内存（字节），无法获取时为None"""
+    if resource is None:
+        return None
+    # Linux上ru_maxrss单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _mb(value):
+    return None if value is None else round(value / _MB, 2)
+
+
+class StageRecord:
+    """一个阶段的测量结果；rows由调用方在阶段内设置"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.seconds = None
+        self.rss_mb = None
+        self.rss_delta_mb = None
+        self.peak_rss_mb = None
+        self.traced_peak_mb = None
+
+    def to_dict(self):
+        return {
+            'stage': self.name,
+            'seconds': self.seconds,
+            'rows': self.rows,
+            'rss_mb': self.rss_mb,
+            'rss_delta_mb': self.rss_delta_mb,
+            'peak_rss_mb': self.peak_rss_mb,
+            'traced_peak_mb': self.traced_peak_mb,
+        }
+
+
+class PipelineProfiler:
+    """按阶段记录耗时、内存和行数
+
+    同名阶段再次运行时覆盖旧记录（局部片段重跑时只更新对应阶段）。
+    trace_memory=True时用tracemalloc记录每个阶段的Python内存分配峰值（有额外开销；
+    跟踪在所有记录器close或被回收后停止，多个会话同时跟踪时峰值会相互影响）；
+    profile=True时从创建起对当前线程采集cProfile，直到调用stop_profile。
+    """
+
+    def __init__(self, trace_memory=False, profile=False):
+        self.records = {}
+        self.trace_memory = trace_memory
+        self._release = None
+        if trace_memory:
+            _acquire_tracing()
+            self._release = weakref.finalize(self, _release_tracing)
+        self._profile = cProfile.Profile() if profile else None
+        self.profile_stats = None
+        if self._profile is not None:
+            try:
+                self._profile.enable()
+            except ValueError:  # Python 3.12起同一时间只能有一个分析器，其他任务正在采集时跳过
+                self._profile = None
+
+    @contextmanager
+    def stage(self, name):
+        record = StageRecord(name)
+        rss_before = current_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = round(time.perf_counter() - start, 4)
+            rss_after = current_rss()
+            record.rss_mb = _mb(rss_after)
+            if rss_before is not None and rss_after is not None:
+                record.rss_delta_mb = _mb(rss_after - rss_before)
+            record.peak_rss_mb = _mb(peak_rss())
+            if self.trace_memory and tracemalloc.is_tracing():
+                record.traced_peak_mb = _mb(tracemalloc.get_traced_memory()[1])
+            self.records.pop(name, None)
+            self.records[name] = record
+
+    def close(self):
+        """释放tracemalloc跟踪（已记录的阶段仍可读取）"""
+        if self._release is not None:
+            self._release()
+
+    def merge(self, other):
+        """并入另一个记录器的阶段记录（如后台任务中的计算阶段）"""
+        for name, record in other.records.items():
+            self.records.pop(name, None)
+            self.records[name] = record
+
+    def to_records(self):
+        return [record.to_dict() for record in self.records.values()]
+
+    def to_json(self):
+        return json.dumps({
+            'stages': self.to_records(),
+            'profile': self.profile_stats,
+        }, ensure_ascii=False, indent=2)
+
+    def stop_profile(self, limit=40):
+        """停止cProfile，返回按累计耗时排序的前limit项统计文本"""
+        if self._profile is None:
+            return self.profile_stats
+        self._profile.disable()
+        output = io.StringIO()
+        pstats.Stats(self._profile, stream=output).sort_stats('cumulative').print_stats(limit)
+        self._profile = None
+        self.profile_stats = output.getvalue()
+        return self.profile_stats
@@ -0,0 +1,108 @@
+"""链接下钻：链接（起始点，目标点）-> 贡献该链接流量的门店
+
+流向计算可选地输出门店贡献索引（见flow_engine.flows_from_totals的contributions参数）：
+所有（链接，门店）流量按链接、门店排序后存为紧凑数组，每条链接占其中一段（偏移量）；
+查询一条链接只需一次二分查找和切片，再在该段内选出流量最大的门店，不需要重新计算。
+"""
+import numpy as np
+import pandas as pd
+
+from nodes import object_nbytes
+
+
+def link_keys(source, target):
+    """（起始点，目标点）-> 链接键（int64，起始点在高32位）"""
+    return (np.asarray(source, dtype=np.int64) << 32) | np.asarray(target, dtype=np.int64)
+
+
+class StoreContributions:
+    """门店贡献索引
+
+    links为排序后的链接键，offsets[i]:offsets[i + 1]为第i条链接在store/value中的一段；
+    store为门店编号（stores中的下标，段内按门店编号排序），stores为门店编号 -> 门店名称（Passport_id）。
+    由from_flows构建，同一门店在同一链接上的多条流向合并为一条。
+    """
+
+    def __init__(self, links, offsets, store, value, stores):
+        self.links = links
+        self.offsets = offsets
+        self.store = store
+        self.value = value
+        self.stores = np.asarray(stores, dtype=object)
+
+    @classmethod
+    def _build(cls, key, store, value, stores):
+        # 链接键编码为连续的链接编号（按链接键排序），再按（链接，门店）一次排序
+        link_id, links = pd.factorize(key, sort=True)
+        order = np.argsort(link_id.astype(np.int64) * max(len(stores), 1) + store)
+        link_id, store, value = link_id[order], store[order], value[order]
+        if len(key):
+            starts = np.flatnonzero(np.r_[True, (link_id[1:] != link_id[:-1]) | (store[1:] != store[:-1])])
+            link_id, store, value = link_id[starts], store[starts], np.add.reduceat(value, starts)
+        offsets = np.searchsorted(link_id, np.arange(len(links) + 1))
+        return cls(np.asarray(links, dtype=np.int64), offsets.astype(np.int64), store.astype(np.int32),
+                   value, stores)
+
+    @classmethod
+    def from_flows(cls, source, target, store, value, stores):
+        """由逐门店的流向构建：source/target为节点编号，store为门店编号，value为流量"""
+        return cls._build(link_keys(source, target), np.asarray(store, dtype=np.int64),
+                          np.asarray(value, dtype=np.float64), stores)
+
+    def __len__(self):
+        return len(self.links)
+
+    @property
+    def nbytes(self):
+        return int(self.links.nbytes + self.offsets.nbytes + self.store.nbytes + self.value.nbytes
+                   + object_nbytes(self.stores))
+
+    @classmethod
+    def combine(cls, parts):
+        """合并按门店分块计算的索引（各块门店互不重叠）"""
+        parts = list(parts)
+        if not parts:
+            return cls.from_flows([], [], [], [], [])
+        keys, stores, values, names = [], [], [], []
+        base = 0
+        for part in parts:
+            keys.append(np.repeat(part.links, np.diff(part.offsets)))
+            stores.append(part.store.astype(np.int64) + base)
+            values.append(part.value)
+            names.append(part.stores)
+            base += len(part.stores)
+        return cls._build(np.concatenate(keys), np.concatenate(stores), np.concatenate(values),
+                          np.concatenate(names))
+
+    def link_counts(self, source, target):
+        """各链接的贡献门店数（没有记录的链接为0）"""
+        key = link_keys(source, target)
+        position = np.minimum(np.searchsorted(self.links, key), max(len(self.links) - 1, 0))
+        found = (self.links[position] == key) if len(self.links) else np.zeros(len(key), dtype=bool)
+        counts = np.diff(self.offsets)
+        return np.where(found, counts[position] if len(counts) else 0, 0)
+
+    def link_stores(self, source, target, limit=None):
+        """一条链接的贡献门店，返回 门店/流量/占比 表（按流量降序，limit为最多返回的门店数）
+
+        占比为该门店流量占整条链接流量的比例。
+        """
+        key = link_keys([source], [target])[0]
+        position = np.searchsorted(self.links, key)
+        if position == len(self.links) or self.links[position] != key:
+            return pd.DataFrame({'门店': pd.Series([], dtype=object), '流量': pd.Series([], dtype=np.float64),
+                                 '占比': pd.Series([], dtype=np.float64)})
+        lo, hi = self.offsets[position], self.offsets[position + 1]
+        value = self.value[lo:hi]
+        total = value.sum()
+        if limit is not None and limit < len(value):
+            # 只对流量最大的limit个门店排序
+            top = np.argpartition(-value, int(limit) - 1)[:int(limit)]
+            top = top[np.lexsort((top, -value[top]))]
+        else:
+            top = np.lexsort((np.arange(len(value)), -value))
+        return pd.DataFrame({
+            '门店': self.stores[self.store[lo:hi][top]],
+            '流量': value[top],
+            '占比': value[top] / total if total else np.zeros(len(top)),
+        })
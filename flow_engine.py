@@ -0,0 +1,419 @@
+"""向量化流向计算引擎：一次性完成所有门店的期初/期末流向拆分
+
+金额按整数单位计算（见FLOW_DECIMALS和flow_decimals），每次计算后按未取整的汇总值
+向量化核对流量守恒，核对失败时抛出ReconciliationError，不会把不一致的流向表交给展示环节。
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from allocator import allocate
+from drilldown import StoreContributions
+from nodes import FlowTable, NodeDictionary, NodeKind, special_node
+
+FLOW_COLUMNS = ['source', 'target', '流量']
+# 流量计算单位：Value U至少按该位数的小数缩放为整数后计算（2即按分计算），数据精度更高时
+# 自动增加位数（见flow_decimals），区间相减不产生浮点残差；设为none时按浮点计算，
+# 并清理不超过FLOW_RTOL的残差流量。按比例分配（proportional）的流量为比例值，不是整数单位
+_decimals = os.environ.get("SANKEY_FLOW_DECIMALS", "2").strip().lower()
+FLOW_DECIMALS = None if _decimals in ("", "none") else int(_decimals)
+# 核对流向时允许的相对误差（相对门店期初、期末总量）；整数单位计算时每行另允许0.5个单位的取整误差
+FLOW_RTOL = 1e-9
+# 期初、期末合计允许的取整损失（相对所有期初、期末值的绝对值合计）
+FLOW_TOTAL_RTOL = 1e-6
+# 各值在计算单位下与最近整数的相对偏差不超过该值时视为整数（浮点表示误差）
+_UNIT_RTOL = 1e-9
+# 按门店分块计算时每块的门店数（用于报告进度和响应取消）
+STORE_CHUNK = int(os.environ.get("SANKEY_STORE_CHUNK", "200000"))
+# flows_from_totals内报告进度的步骤数（汇总对齐、相同品牌保留、跨品牌配对、核对、生成流向表）
+FLOW_STEPS = 5
+
+
+def brand_categories(values):
+    """将品牌列转换为分类类型（未分类时按品牌名称排序），返回Categorical"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.array
+    return pd.Categorical(values, categories=sorted(values.dropna().unique()))
+
+
+def _store_keys(values):
+    """门店键：分类列直接使用整数编码，返回 (键, 有效掩码, 门店键 -> 门店名称)"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.array.codes
+        return codes, codes >= 0, values.array.categories.to_numpy(dtype=object)
+    return values.to_numpy(), values.notna().to_numpy(), None
+
+
+def _empty_totals():
+    return pd.Series([], index=pd.MultiIndex.from_arrays([[], []]), dtype=np.float64)
+
+
+def store_period_totals(df, periods, brand_col='brand_processed'):
+    """一次分组得到各期按（门店，品牌编码）汇总的Value U
+
+    返回 ({期间: Series}, 节点字典)；多个期间组合共享同一份各期汇总。
+    """
+    brands = brand_categories(df[brand_col])
+    store_keys, store_valid, store_names = _store_keys(df['Passport_id'])
+    period_values = df['Q'].to_numpy()
+    keep = df['Q'].isin(periods).to_numpy() & store_valid & (brands.codes >= 0)
+    values = df['Value U'].to_numpy(dtype=np.float64)[keep]
+    grouped = pd.Series(values).groupby(
+        [period_values[keep], store_keys[keep], brands.codes[keep]], sort=True
+    ).sum()
+    totals = {period: _empty_totals() for period in periods}
+    for period, period_totals in grouped.groupby(level=0, sort=False):
+        totals[period] = period_totals.droplevel(0)
+    return totals, NodeDictionary(brands.categories, store_names)
+
+
+def rebucket_totals(totals, mapping):
+    """按品牌编码映射合并各期（门店，品牌编码）汇总
+
+    mapping[旧编码] = 新编码，如Top N以外的品牌并入其他品牌；
+    只需对已汇总的数据再分组一次，不必重新读取和清洗原始数据。
+    """
+    mapping = np.asarray(mapping)
+    rebucketed = {}
+    for period, period_totals in totals.items():
+        if period_totals.empty:
+            rebucketed[period] = _empty_totals()
+            continue
+        stores = period_totals.index.get_level_values(0)
+        codes = mapping[period_totals.index.get_level_values(1).to_numpy()]
+        rebucketed[period] = period_totals.groupby([stores, codes], sort=True).sum()
+    return rebucketed
+
+
+class ReconciliationError(ValueError):
+    """流向表与期初/期末汇总对不上（流量有遗漏或重复计算）"""
+
+
+class Reconciliation:
+    """流向核对结果：每个（门店，品牌）的期初值 = 流出合计、期末值 = 流入合计，以及全局合计
+
+    数值为原始单位，期初、期末为未取整的汇总值；magnitude为期初、期末值的绝对值合计，
+    全局合计的差额（取整损失）超过FLOW_TOTAL_RTOL × magnitude时核对失败。
+    dropped为清理掉的零流量/浮点残差链接数。
+    """
+
+    def __init__(self, start_total, end_total, outflow, inflow, bad_stores, max_gap, dropped, links,
+                 magnitude=0.0):
+        self.start_total = start_total
+        self.end_total = end_total
+        self.outflow = outflow
+        self.inflow = inflow
+        self.bad_stores = bad_stores
+        self.max_gap = max_gap
+        self.dropped = dropped
+        self.links = links
+        self.magnitude = magnitude
+
+    @property
+    def total_gap(self):
+        return max(abs(self.outflow - self.start_total), abs(self.inflow - self.end_total))
+
+    @property
+    def ok(self):
+        return self.bad_stores == 0 and self.total_gap <= FLOW_TOTAL_RTOL * self.magnitude
+
+    def to_dict(self):
+        return {
+            'start_total': self.start_total,
+            'end_total': self.end_total,
+            'outflow': self.outflow,
+            'inflow': self.inflow,
+            'bad_stores': self.bad_stores,
+            'max_gap': self.max_gap,
+            'dropped': self.dropped,
+            'links': self.links,
+            'magnitude': self.magnitude,
+        }
+
+    @classmethod
+    def combine(cls, checks):
+        """合并按门店分块计算的核对结果"""
+        checks = list(checks)
+        return cls(
+            start_total=sum(check.start_total for check in checks),
+            end_total=sum(check.end_total for check in checks),
+            outflow=sum(check.outflow for check in checks),
+            inflow=sum(check.inflow for check in checks),
+            bad_stores=sum(check.bad_stores for check in checks),
+            max_gap=max((check.max_gap for check in checks), default=0.0),
+            dropped=sum(check.dropped for check in checks),
+            links=sum(check.links for check in checks),
+            magnitude=sum(check.magnitude for check in checks),
+        )
+
+    def raise_for_errors(self):
+        if not self.ok:
+            problem = (f"{self.bad_stores}个门店的期初/期末与流出/流入不一致" if self.bad_stores
+                       else "期初/期末合计与流出/流入合计不一致（计算单位取整损失过大）")
+            raise ReconciliationError(
+                f"流向核对失败：{problem}"
+                f"（最大差额{max(self.max_gap, self.total_gap):g}，期初{self.start_total:g}/流出{self.outflow:g}，"
+                f"期末{self.end_total:g}/流入{self.inflow:g}）"
+            )
+
+
+def flow_decimals(values, decimals=FLOW_DECIMALS):
+    """按数据选择计算单位的小数位数（decimals为None时返回None，即按浮点计算）
+
+    从decimals起逐位增加，直到所有值在该单位下都是整数、取整不再损失数值；
+    最多增加到所有值的绝对值合计仍在2**53以内（门店内累计的区间端点精确）。
+    """
+    if decimals is None:
+        return None
+    values = np.abs(values[~np.isnan(values)])
+    total = float(values.sum())
+    if total == 0:
+        return decimals
+    limit = max(decimals, int(np.floor(np.log10(2.0 ** 53 / total))))
+    for candidate in range(decimals, limit + 1):
+        scaled = values * 10.0 ** candidate
+        if (np.abs(scaled - np.rint(scaled)) <= _UNIT_RTOL * np.maximum(scaled, 1.0)).all():
+            return candidate
+    return limit
+
+
+def _scale_units(values, decimals):
+    # 数值 -> 计算单位（未取整）
+    if decimals is None:
+        return values
+    return values * 10.0 ** decimals
+
+
+def _to_units(values, decimals):
+    """数值 -> 按decimals位小数缩放后的整数单位（仍为float64，整数在2**53以内精确）"""
+    if decimals is None:
+        return values
+    return np.rint(_scale_units(values, decimals))
+
+
+def _from_units(values, decimals):
+    if decimals is None:
+        return values
+    return values / 10.0 ** decimals
+
+
+def reconcile_flows(start, end, store_codes, start_rows, end_rows, values, decimals=FLOW_DECIMALS, dropped=0):
+    """向量化核对流向：按（门店，品牌）行汇总流出、流入，与期初、期末值比较
+
+    start/end为各行未取整的期初、期末值（原始单位，缺失为NaN），start_rows/end_rows为每条流量
+    来源/去向的行号（新增门店/新增品类、门店流失/品类流失一侧为-1），values为计算单位的流量
+    （见flows_from_totals的decimals）。允许FLOW_RTOL的相对误差，整数单位计算时每行另允许
+    0.5个单位的取整误差；全局合计的取整损失另按FLOW_TOTAL_RTOL核对（见Reconciliation）。
+    返回Reconciliation。
+    """
+    n = len(start)
+    start = _scale_units(np.nan_to_num(start), decimals)
+    end = _scale_units(np.nan_to_num(end), decimals)
+    has_start = start_rows >= 0
+    has_end = end_rows >= 0
+    outflow = np.bincount(start_rows[has_start], weights=values[has_start], minlength=n)
+    inflow = np.bincount(end_rows[has_end], weights=values[has_end], minlength=n)
+    # 误差按门店规模放宽（区间端点为门店内累计值）
+    store_scale = np.bincount(store_codes, weights=np.abs(start) + np.abs(end))[store_codes] if n else start
+    gap = np.maximum(np.abs(outflow - start), np.abs(inflow - end))
+    bad = gap > (0.0 if decimals is None else 0.5) + FLOW_RTOL * store_scale
+    return Reconciliation(
+        start_total=float(_from_units(start.sum(), decimals)),
+        end_total=float(_from_units(end.sum(), decimals)),
+        outflow=float(_from_units(values[has_start].sum(), decimals)),
+        inflow=float(_from_units(values[has_end].sum(), decimals)),
+        bad_stores=int(len(np.unique(store_codes[bad]))),
+        max_gap=float(_from_units(gap.max(), decimals)) if n else 0.0,
+        dropped=dropped,
+        links=len(values) - dropped,
+        magnitude=float(_from_units(np.abs(start).sum() + np.abs(end).sum(), decimals)),
+    )
+
+
+def compute_flows(df, start_period, end_period, brand_col='brand_processed',
+                  strategy='sequential', seed=None, decimals=FLOW_DECIMALS):
+    """计算期初到期末的品牌流向表
+
+    df需包含 Passport_id、Q、Value U 以及处理后的品牌列（推荐为分类类型，
+    品牌在门店内按分类顺序参与配对）；返回FlowTable，流向表中
+    source/target为节点编号。分类规则与逐门店循环一致：
+    只有期末的门店来自期初_新增门店，只有期初的门店流向期末_门店流失，
+    其余门店先按相同品牌保留，再按strategy配对不同品牌的剩余量
+    （见allocator.ALLOCATORS，seed固定时结果可复现），
+    期初余量流向期末_品类流失，期末余量来自期初_新增品类。
+    """
+    totals, nodes = store_period_totals(df, [start_period, end_period], brand_col)
+    return flows_from_totals(totals[start_period], totals[end_period], nodes,
+                             strategy=strategy, seed=seed, decimals=decimals)
+
+
+def flows_from_totals(start_totals, end_totals, nodes, strategy='sequential', seed=None,
+                      decimals=FLOW_DECIMALS, contributions=False, progress=None):
+    """由期初、期末的（门店，品牌编码）汇总计算流向表，规则见compute_flows
+
+    decimals为计算单位最少的小数位数（按数据自动增加，见flow_decimals；None为浮点计算）；
+    结果的reconciliation属性为核对结果，核对失败时抛出ReconciliationError。
+    流量为0（或浮点残差）的链接不写入流向表。
+    contributions为True时结果附带门店贡献索引（见drilldown.StoreContributions）。
+    progress(已完成步骤数, FLOW_STEPS)在每个计算步骤完成后调用（可在其中抛出异常以中断计算）。
+    """
+    def step(done):
+        if progress is not None:
+            progress(done, FLOW_STEPS)
+
+    merged = pd.concat([start_totals.rename('start'), end_totals.rename('end')], axis=1).sort_index()
+
+    store_codes, store_keys = pd.factorize(merged.index.get_level_values(0), sort=True)
+    brand = nodes.brand_nodes(merged.index.get_level_values(1).to_numpy())
+    raw_start = merged['start'].to_numpy(dtype=np.float64)
+    raw_end = merged['end'].to_numpy(dtype=np.float64)
+    decimals = flow_decimals(np.concatenate([raw_start, raw_end]), decimals)
+    start = _to_units(raw_start, decimals)
+    end = _to_units(raw_end, decimals)
+    in_start = ~np.isnan(start)
+    in_end = ~np.isnan(end)
+
+    # 门店级别的期初/期末存在性
+    store_has_start = np.bincount(store_codes, weights=in_start)[store_codes] > 0
+    store_has_end = np.bincount(store_codes, weights=in_end)[store_codes] > 0
+    both = store_has_start & store_has_end
+    step(1)
+
+    new_store = special_node(NodeKind.NEW_STORE)
+    store_loss = special_node(NodeKind.STORE_LOSS)
+    new_category = special_node(NodeKind.NEW_CATEGORY)
+    category_loss = special_node(NodeKind.CATEGORY_LOSS)
+    # 每部分为 (期初行号, 期末行号, 流量)，-1表示该侧为特殊节点
+    start_parts = []
+    end_parts = []
+    value_parts = []
+
+    def add(start_rows, end_rows, values):
+        count = len(values)
+        start_parts.append(np.full(count, -1, dtype=np.int64) if start_rows is None else start_rows)
+        end_parts.append(np.full(count, -1, dtype=np.int64) if end_rows is None else end_rows)
+        value_parts.append(values)
+
+    # 场景1：只有期末 -> 期初_新增门店
+    rows = np.flatnonzero(~store_has_start & in_end)
+    add(None, rows, end[rows])
+
+    # 场景2：只有期初 -> 期末_门店流失
+    rows = np.flatnonzero(store_has_start & ~store_has_end & in_start)
+    add(rows, None, start[rows])
+
+    # 场景3-1：相同品牌优先匹配
+    common = both & in_start & in_end
+    retained = np.where(common, np.fmin(start, end), 0.0)
+    rows = np.flatnonzero(common)
+    add(rows, rows, retained[rows])
+    step(2)
+
+    # 场景3-2：不同品牌配对剩余量（剩余量为0的品牌不再参与）
+    start_rest = np.where(in_start, start, 0.0) - retained
+    end_rest = np.where(in_end, end, 0.0) - retained
+    start_mask = both & in_start & ~(common & (start_rest == 0))
+    end_mask = both & in_end & ~(common & (end_rest == 0))
+    start_rows = np.flatnonzero(start_mask)
+    end_rows = np.flatnonzero(end_mask)
+    pairs, start_left, end_left = allocate(
+        store_codes[start_rows], start_rest[start_rows],
+        store_codes[end_rows], end_rest[end_rows],
+        strategy=strategy, seed=seed,
+    )
+    pair_start, pair_end, pair_flow = pairs
+    add(start_rows[pair_start], end_rows[pair_end], pair_flow)
+
+    # 场景3-3：期初余量 -> 期末_品类流失，期末余量 <- 期初_新增品类
+    left_idx, left_flow = start_left
+    add(start_rows[left_idx], None, left_flow)
+    left_idx, left_flow = end_left
+    add(None, end_rows[left_idx], left_flow)
+    step(3)
+
+    flow_start = np.concatenate(start_parts)
+    flow_end = np.concatenate(end_parts)
+    values = np.concatenate(value_parts).astype(np.float64)
+
+    # 清理零流量；浮点计算时同时清理区间相减留下的残差
+    if decimals is None:
+        magnitude = max(float(np.nanmax(np.abs(start), initial=0.0)), float(np.nanmax(np.abs(end), initial=0.0)))
+        keep = np.abs(values) > FLOW_RTOL * magnitude
+    else:
+        keep = values != 0
+    check = reconcile_flows(raw_start, raw_end, store_codes, flow_start, flow_end, values, decimals,
+                            dropped=int((~keep).sum()))
+    check.raise_for_errors()
+    step(4)
+
+    flow_start, flow_end, values = flow_start[keep], flow_end[keep], values[keep]
+    sources = np.where(flow_start >= 0, brand[np.maximum(flow_start, 0)], new_store)
+    # 只有期末的门店来自新增门店，其余期初一侧的特殊节点为新增品类
+    sources[(flow_start < 0) & store_has_start[np.maximum(flow_end, 0)]] = new_category
+    targets = np.where(flow_end >= 0, brand[np.maximum(flow_end, 0)], category_loss)
+    targets[(flow_end < 0) & ~store_has_end[np.maximum(flow_start, 0)]] = store_loss
+    flows = pd.DataFrame({
+        'source': sources.astype(np.int32),
+        'target': targets.astype(np.int32),
+        '流量': _from_units(values, decimals),
+    })
+    store_index = None
+    if contributions:
+        # 每条流向来自同一门店的期初行或期末行
+        flow_store = store_codes[np.where(flow_start >= 0, flow_start, flow_end)]
+        store_names = (np.asarray(store_keys, dtype=object) if nodes.stores is None
+                       else nodes.stores[np.asarray(store_keys, dtype=np.int64)])
+        store_index = StoreContributions.from_flows(sources, targets, flow_store, flows['流量'].to_numpy(), store_names)
+    step(5)
+    return FlowTable(flows, nodes, check, store_index)
+
+
+def _store_slice(period_totals, lo, hi):
+    stores = period_totals.index.get_level_values(0)
+    start, stop = stores.searchsorted(lo, side='left'), stores.searchsorted(hi, side='right')
+    return period_totals.iloc[start:stop]
+
+
+def flows_by_store_chunks(start_totals, end_totals, nodes, strategy='sequential', seed=None,
+                          decimals=FLOW_DECIMALS, chunk_stores=STORE_CHUNK, progress=None, contributions=False):
+    """按门店分块计算流向表，调用progress(已处理门店数, 门店总数)报告进度
+
+    每块内的各计算步骤完成后按比例报告一次进度（见flows_from_totals的progress），
+    门店数较少、只有一块时也能在步骤之间响应取消。
+    门店之间互不影响，门店数不超过chunk_stores时结果与flows_from_totals完全相同；
+    分多块时random策略各块使用由seed派生的独立随机数（同parallel.compute_flows_parallel）。
+    """
+    stores = np.union1d(start_totals.index.get_level_values(0), end_totals.index.get_level_values(0))
+    n_stores = len(stores)
+    n_chunks = max(1, -(-n_stores // max(1, chunk_stores)))
+
+    def chunk_progress(lo, hi):
+        # 块内步骤 -> 已处理门店数
+        if progress is None:
+            return None
+        return lambda done, total: progress(lo + (hi - lo) * done // total, n_stores)
+
+    if progress is not None:
+        progress(0, n_stores)
+    if n_chunks == 1:
+        return flows_from_totals(start_totals, end_totals, nodes, strategy=strategy, seed=seed,
+                                 decimals=decimals, contributions=contributions,
+                                 progress=chunk_progress(0, n_stores))
+
+    chunk_seeds = (np.random.SeedSequence(seed).spawn(n_chunks) if seed is not None
+                   else [None] * n_chunks)
+    parts = []
+    for i, chunk_seed in enumerate(chunk_seeds):
+        first, last = i * chunk_stores, min(n_stores, (i + 1) * chunk_stores)
+        lo, hi = stores[first], stores[last - 1]
+        table = flows_from_totals(
+            _store_slice(start_totals, lo, hi), _store_slice(end_totals, lo, hi), nodes, strategy=strategy,
+            seed=None if chunk_seed is None else int(chunk_seed.generate_state(1)[0]), decimals=decimals,
+            contributions=contributions, progress=chunk_progress(first, last),
+        )
+        parts.append(table)
+    store_index = (StoreContributions.combine(table.contributions for table in parts) if contributions
+                   else None)
+    return FlowTable(pd.concat([table.flows for table in parts], ignore_index=True), nodes,
+                     Reconciliation.combine(table.reconciliation for table in parts), store_index)
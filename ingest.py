@@ -0,0 +1,253 @@
+"""数据导入：上传文件（xlsx/csv/parquet）一次性转换为带类型的列式文件，后续按列内存映射读取
+
+转换和读取都按块进行：转换时每次只处理一个数据块；读取时先扫描Q列
+得到可选期间，再只加载所选期间的行，峰值内存与所选期间的数据量成正比。
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+# 流向计算需要的列
+REQUIRED_COLUMNS = ['brand', 'Value U', 'Passport_id', 'Q']
+CATEGORICAL_COLUMNS = ['brand', 'Q', 'Passport_id']
+# 以字符串保存的分类列（避免不同数据块推断出不同类型）
+STRING_COLUMNS = ['brand', 'Passport_id']
+SUPPORTED_TYPES = ["xlsx", "csv", "parquet"]
+COLUMNAR_DIR = os.environ.get("SANKEY_COLUMNAR_DIR", ".columnar_cache")
+# 列式文件格式变化时递增，旧格式的缓存文件不再复用
+COLUMNAR_VERSION = 2
+CHUNK_ROWS = 200_000
+
+
+def file_type(name):
+    """根据文件名返回上传文件类型"""
+    suffix = os.path.splitext(name)[1].lower().lstrip(".")
+    if suffix not in SUPPORTED_TYPES:
+        raise ValueError(f"不支持的文件类型: {name}")
+    return suffix
+
+
+def _iter_xlsx_chunks(source, chunk_rows):
+    # 只读模式逐行读取第一个工作表，不把整个工作簿载入内存
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(col) if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                yield pd.DataFrame(chunk, columns=columns, dtype=object)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns, dtype=object)
+    finally:
+        workbook.close()
+
+
+def iter_upload_chunks(uploaded_file, chunk_rows=CHUNK_ROWS):
+    """按块读取上传文件，每块为一个DataFrame"""
+    kind = file_type(uploaded_file.name)
+    if kind == "xlsx":
+        yield from _iter_xlsx_chunks(uploaded_file, chunk_rows)
+    elif kind == "csv":
+        yield from pd.read_csv(uploaded_file, chunksize=chunk_rows,
+                               dtype={col: str for col in STRING_COLUMNS})
+    else:
+        for batch in pq.ParquetFile(uploaded_file).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+
+
+def to_columnar(df):
+    """统一列名并转换列类型：brand/Q/Passport_id为分类类型，Value U为float64"""
+    # 统一Value U列名
+    if 'Value U' not in df.columns and 'Value' in df.columns:
+        df = df.rename(columns={'Value': 'Value U'})
+    columns = [col for col in REQUIRED_COLUMNS if col in df.columns]
+    df = df[columns].copy()
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            if col in STRING_COLUMNS:
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+            df[col] = df[col].astype('category')
+    if 'Value U' in df.columns:
+        # 保持float64：float32下12.34读回为12.3400001525…，流向单位会被推到最大小数位
+        df['Value U'] = pd.to_numeric(df['Value U'], errors='coerce').astype(np.float64)
+    return df
+
+
+class ColumnarWriter:
+    """把多个数据块写入同一个Arrow文件，分类列共享逐块增长的字典"""
+
+    def __init__(self, path):
+        self.path = path
+        # 临时文件名按进程和线程区分：多个会话同时转换同一文件时互不覆盖
+        self._tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._sink = None
+        self._writer = None
+        self._categories = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def _dictionary_array(self, col, values):
+        # 新出现的取值追加到字典末尾，使每块的字典都是上一块的扩展（字典增量）
+        categories = self._categories.get(col, pd.Index([], dtype=object))
+        new_values = pd.Index(values.cat.categories).difference(categories, sort=False)
+        if len(new_values):
+            categories = categories.append(new_values)
+            self._categories[col] = categories
+        codes = pd.Categorical(values, categories=categories).codes.astype(np.int32)
+        indices = pa.array(codes, mask=codes < 0, type=pa.int32())
+        return pa.DictionaryArray.from_arrays(indices, pa.array(categories.to_numpy(), from_pandas=True))
+
+    def write(self, df):
+        df = to_columnar(df)
+        arrays = [
+            self._dictionary_array(col, df[col]) if col in CATEGORICAL_COLUMNS
+            else pa.array(df[col].to_numpy(), from_pandas=True)
+            for col in df.columns
+        ]
+        batch = pa.record_batch(arrays, names=list(df.columns))
+        if self._writer is None:
+            self._sink = pa.OSFile(self._tmp_path, "wb")
+            options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self._writer = pa.ipc.new_file(self._sink, batch.schema, options=options)
+        self._writer.write_batch(batch)
+
+    def close(self):
+        if self._writer is None:
+            # 空文件：写入仅含表头的文件
+            write_columnar(pd.DataFrame(columns=REQUIRED_COLUMNS), self.path)
+            return
+        self._writer.close()
+        self._sink.close()
+        os.replace(self._tmp_path, self.path)
+
+    def _abort(self):
+        if self._writer is not None:
+            self._sink.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def write_columnar(df, path):
+    """写入列式文件（.feather不压缩以便内存映射，.parquet用于归档）"""
+    table = pa.Table.from_pandas(to_columnar(df), preserve_index=False)
+    tmp_path = f"{path}.tmp"
+    if path.endswith(".parquet"):
+        pq.write_table(table, tmp_path)
+    else:
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+    return path
+
+
+def columnar_columns(path):
+    """返回列式文件包含的列名"""
+    if path.endswith(".parquet"):
+        return pq.read_schema(path).names
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def columnar_rows(path):
+    """只读取元数据得到列式文件的行数"""
+    if path.endswith(".parquet"):
+        return pq.ParquetFile(path).metadata.num_rows
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+def iter_columnar_batches(path, columns=None):
+    """按块内存映射读取列式文件，只读取需要的列"""
+    if columns is not None:
+        available = set(columnar_columns(path))
+        columns = [col for col in columns if col in available]
+    if path.endswith(".parquet"):
+        yield from pq.ParquetFile(path, memory_map=True).iter_batches(columns=columns)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield batch.select(columns) if columns is not None else batch
+
+
+def _period_mask(column, periods):
+    """返回一列中Q属于所选期间的布尔掩码"""
+    if pa.types.is_dictionary(column.type):
+        # 只比较字典取值，再按编码筛选
+        matched = np.flatnonzero(column.dictionary.to_pandas().isin(periods).to_numpy())
+        indices = column.indices.to_numpy(zero_copy_only=False)
+        return pa.array(np.isin(indices, matched) & column.is_valid().to_numpy(zero_copy_only=False))
+    return pc.fill_null(pc.is_in(column, value_set=pa.array(periods)), False)
+
+
+def iter_period_batches(path, periods, columns=None):
+    """按块读取列式文件，每块只保留Q属于periods的行"""
+    periods = list(periods)
+    if columns is not None and 'Q' not in columns:
+        columns = list(columns) + ['Q']
+    for batch in iter_columnar_batches(path, columns):
+        yield batch.filter(_period_mask(batch.column('Q'), periods))
+
+
+def load_periods(path, periods, columns=None):
+    """按块读取列式文件，只保留Q属于periods的行"""
+    if columns is not None and 'Q' not in columns:
+        columns = list(columns) + ['Q']
+    batches = list(iter_period_batches(path, periods, columns))
+    if not batches:
+        return pd.DataFrame(columns=columns or REQUIRED_COLUMNS)
+    return pa.Table.from_batches(batches).unify_dictionaries().to_pandas()
+
+
+def scan_columnar(path):
+    """轻量扫描：只读取Q/brand/Value U列，返回 (排序后的期间列表, 原始品牌的全期Value U合计)"""
+    available = set(columnar_columns(path))
+    periods = set()
+    brand_totals = pd.Series(dtype=np.float64)
+    for batch in iter_columnar_batches(path, [col for col in ['Q', 'brand', 'Value U'] if col in available]):
+        chunk = batch.to_pandas()
+        if 'Q' in chunk.columns:
+            periods.update(chunk['Q'].dropna().unique().tolist())
+        if 'brand' in chunk.columns and 'Value U' in chunk.columns:
+            totals = chunk['Value U'].astype(np.float64).groupby(chunk['brand'], observed=True).sum()
+            totals.index = totals.index.astype(object)
+            brand_totals = brand_totals.add(totals, fill_value=0)
+    return sorted(periods), brand_totals.rename_axis('brand')
+
+
+def ensure_columnar(uploaded_file, file_hash, cache_dir=None, chunk_rows=CHUNK_ROWS):
+    """上传文件首次出现时按块转换为列式文件，之后直接复用，返回文件路径"""
+    path = columnar_path(file_hash, cache_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with ColumnarWriter(path) as writer:
+            for chunk in iter_upload_chunks(uploaded_file, chunk_rows):
+                writer.write(chunk)
+    return path
+
+
+def columnar_path(file_hash, cache_dir=None):
+    """返回上传文件对应的列式文件路径"""
+    return os.path.join(cache_dir or COLUMNAR_DIR, f"{file_hash}.v{COLUMNAR_VERSION}.feather")
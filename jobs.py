@@ -0,0 +1,181 @@
+"""后台计算任务：在线程池中运行流向计算，报告进度，可取消，相同参数的任务在会话间共享
+
+任务按输入参数生成的任务编号去重：其他会话提交相同参数时直接关联到同一任务，
+完成后共享同一份结果；所有关联会话都取走结果后任务不再保留结果（由调用方存入共享结果缓存）。计算函数通过progress(已完成, 总数)报告进度，
+取消请求在下一次报告进度时以JobCancelled中断计算。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时运行的后台任务数，其余任务排队
+JOB_WORKERS = max(1, int(os.environ.get("SANKEY_JOB_WORKERS", "2")))
+# 保留已结束任务的数量（任务状态和失败原因，结果取走后即释放）
+MAX_FINISHED_JOBS = 16
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+STATUS_LABELS = {
+    PENDING: '排队中',
+    RUNNING: '计算中',
+    DONE: '已完成',
+    FAILED: '失败',
+    CANCELLED: '已取消',
+}
+
+
+class JobCancelled(Exception):
+    """任务已被取消（在报告进度时抛出，中断计算）"""
+
+
+def job_id(key):
+    """输入参数 -> 任务编号"""
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:16]
+
+
+class Job:
+    """一个后台任务：状态、进度、结果或异常；subscribers为关联该任务的会话"""
+
+    def __init__(self, key, compute, label=""):
+        self.id = job_id(key)
+        self.key = key
+        self.label = label
+        self.status = PENDING
+        self.done_units = 0
+        self.total_units = 0
+        self.message = ""
+        self.result = None
+        self.released = False
+        self.error = None
+        self.subscribers = set()
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self._compute = compute
+        self._cancel = threading.Event()
+        self._future = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def fraction(self):
+        if self.status == DONE:
+            return 1.0
+        if not self.total_units:
+            return 0.0
+        return min(1.0, self.done_units / self.total_units)
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def progress(self, done, total, message=None):
+        """计算函数报告进度；已请求取消时抛出JobCancelled"""
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+        self.done_units = done
+        self.total_units = total
+        if message is not None:
+            self.message = message
+
+    def cancel(self):
+        """请求取消：排队中的任务直接取消，运行中的任务在下一次报告进度时中断"""
+        self._cancel.set()
+        if self._future is not None and self._future.cancel():
+            self._finish(CANCELLED)
+
+    def _run(self):
+        if self._cancel.is_set():
+            self._finish(CANCELLED)
+            return
+        self.status = RUNNING
+        try:
+            self.result = self._compute(self.progress)
+        except JobCancelled:
+            self._finish(CANCELLED)
+        except BaseException as e:  # 异常交给查看任务的会话显示
+            self.error = e
+            self._finish(FAILED)
+        else:
+            self._finish(DONE)
+        finally:
+            self._compute = None
+
+    def _finish(self, status):
+        self.status = status
+        self.finished_at = time.time()
+
+
+class JobManager:
+    """进程内共享的任务表
+
+    submit按任务编号去重；会话在提交时关联任务（subscriber），通过unsubscribe放弃，
+    只有所有关联会话都放弃时才真正取消任务。
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_finished=MAX_FINISHED_JOBS):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sankey_job")
+        self._jobs = OrderedDict()  # 任务编号 -> Job
+        self._lock = threading.Lock()
+
+    def get(self, id_):
+        with self._lock:
+            return self._jobs.get(id_)
+
+    def submit(self, key, compute, label="", subscriber=None):
+        """提交任务：相同参数的任务正在运行或已完成时直接返回该任务
+
+        失败、已取消、正在取消以及结果已被取走的任务重新提交。
+        """
+        id_ = job_id(key)
+        with self._lock:
+            job = self._jobs.get(id_)
+            if job is None or job.status in (FAILED, CANCELLED) or job.cancel_requested or job.released:
+                job = Job(key, compute, label)
+                self._jobs[id_] = job
+                job._future = self._executor.submit(job._run)
+            self._jobs.move_to_end(id_)
+            if subscriber is not None:
+                job.subscribers.add(subscriber)
+            self._prune()
+        return job
+
+    def unsubscribe(self, id_, subscriber):
+        """会话放弃任务；没有其他会话关联且任务未结束时取消任务"""
+        with self._lock:
+            job = self._jobs.get(id_)
+            if job is None:
+                return None
+            job.subscribers.discard(subscriber)
+            orphaned = not job.subscribers and not job.finished
+        if orphaned:
+            job.cancel()
+        return job
+
+    def collect(self, job, subscriber):
+        """会话取走已结束任务的结果并放弃任务；最后一个关联会话取走后任务释放结果"""
+        with self._lock:
+            job.subscribers.discard(subscriber)
+            result = job.result
+            if not job.subscribers and job.status == DONE:
+                job.result = None
+                job.released = True
+        return result
+
+    def _prune(self):
+        finished = [id_ for id_, job in self._jobs.items() if job.finished]
+        for id_ in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[id_]
+
+
+# Streamlit各会话共享同一进程，模块级的任务表即为全局任务表
+JOBS = JobManager()
@@ -0,0 +1,187 @@
+"""桑基图节点布局：节点高度与流量成比例，同一列节点按间距依次堆叠、互不重叠，
+同一列内的上下顺序用重心法（barycenter）调整以减少链接交叉
+
+列数不限：两列（期初/期末）和多期串联的多列使用同一套计算，链接只连接相邻列。
+坐标与plotly的sankey一致：y为节点中心在绘图区内的相对位置（0在上、1在下）。
+"""
+import numpy as np
+
+# 节点间距（像素）；节点很多时缩小间距，间距总和最多占列高的MAX_PAD_SHARE
+NODE_PAD = 25
+MAX_PAD_SHARE = 0.4
+# 重心法的往返扫描次数
+ORDER_SWEEPS = 4
+# plotly把坐标0视为未设置，纵坐标限制在(0, 1)内
+_EDGE = 1e-3
+
+
+def node_values(n_nodes, link_source, link_target, link_value):
+    """节点流量 = max(流入, 流出)，与plotly计算节点高度时一致"""
+    inflow = np.bincount(link_target, weights=link_value, minlength=n_nodes)
+    outflow = np.bincount(link_source, weights=link_value, minlength=n_nodes)
+    return np.maximum(inflow, outflow)
+
+
+def _plotly_columns(column, link_source, link_target):
+    # plotly（d3-sankey，justify对齐）按链接推算节点所在层：没有流入的节点在第一层，
+    # 没有流出的节点在最后一层；节点高度的比例按这些层计算
+    n_nodes = len(column)
+    has_inflow = np.bincount(link_target, minlength=n_nodes) > 0
+    has_outflow = np.bincount(link_source, minlength=n_nodes) > 0
+    return np.where(~has_outflow, column.max(), np.where(~has_inflow, 0, column))
+
+
+def node_pad(columns, plot_height, pad=NODE_PAD, max_share=MAX_PAD_SHARE):
+    """节点间距（像素）：任一分层中节点最多的一层，间距总和不超过列高的max_share"""
+    gaps = max(max(int(np.bincount(column).max()) - 1 for column in columns), 1)
+    return min(pad, max_share * plot_height / gaps)
+
+
+def _scale(column, value, pad_share):
+    # 流量 -> 高度的比例：取最满一列刚好放下的比例（所有列共用，与plotly一致）
+    counts = np.bincount(column)
+    column_value = np.bincount(column, weights=value, minlength=len(counts))
+    used = column_value > 0
+    scale = (1 - (counts[used] - 1) * pad_share) / column_value[used]
+    return scale.min() if len(scale) else 0.0
+
+
+def _fit_pad(column, value, scale, pad_share):
+    # plotly按自己的分层算出的比例大于scale时，加大间距使比例降到scale（加大后仍不超过列高）
+    counts = np.bincount(column)
+    column_value = np.bincount(column, weights=value, minlength=len(counts))
+    usable = (counts > 1) & (column_value > 0)
+    if not usable.any():
+        return pad_share
+    needed = (1 - scale * column_value[usable]) / (counts[usable] - 1)
+    fitted = max(pad_share, needed.min())
+    if (np.maximum(counts - 1, 0) * fitted >= 1).any():
+        return pad_share
+    return fitted
+
+
+def column_gaps(column, height, pad_share):
+    """各列相邻节点的间隔：默认pad_share，列中放不下时均分剩余空间"""
+    counts = np.bincount(column)
+    free = 1 - np.bincount(column, weights=height, minlength=len(counts))
+    return np.clip(free / np.maximum(counts - 1, 1), 0, pad_share)
+
+
+def stack_nodes(column, position, height, gaps):
+    """按position在各列内从上到下堆叠节点，返回节点中心的纵坐标
+
+    height为各节点高度，gaps为各列相邻节点的间隔（均为占绘图区高度的比例），
+    各列整体垂直居中；position相同时按节点顺序排列。
+    """
+    n_nodes = len(column)
+    order = np.lexsort((np.arange(n_nodes), position, column))
+    sorted_column = column[order]
+    height = height[order]
+    counts = np.bincount(column)
+    start = np.searchsorted(sorted_column, sorted_column)  # 所在列第一个节点的位置
+    above = np.cumsum(height) - height
+    slot = np.arange(n_nodes) - start
+    gap = gaps[sorted_column]
+    offset = above - above[start] + slot * gap
+    column_height = np.bincount(sorted_column, weights=height, minlength=len(counts)) \
+        + np.maximum(counts - 1, 0) * gaps
+    center = (1 - column_height[sorted_column]) / 2 + offset + height / 2
+    y = np.empty(n_nodes)
+    y[order] = center
+    return np.clip(y, _EDGE, 1 - _EDGE)
+
+
+def _ranks(column, position):
+    # 各节点在所在列内的位次（0在上）
+    n_nodes = len(column)
+    order = np.lexsort((np.arange(n_nodes), position, column))
+    sorted_column = column[order]
+    rank = np.empty(n_nodes, dtype=np.int64)
+    rank[order] = np.arange(n_nodes) - np.searchsorted(sorted_column, sorted_column)
+    return rank
+
+
+def crossings(column, rank, link_source, link_target, link_value):
+    """相邻两列之间链接的加权交叉量：交叉的两条链接按流量乘积计入"""
+    counts = np.bincount(column)
+    link_column = column[link_source]
+    total = 0.0
+    for c in range(len(counts) - 1):
+        mask = link_column == c
+        if not mask.any():
+            continue
+        weights = np.zeros((counts[c], counts[c + 1]))
+        np.add.at(weights, (rank[link_source[mask]], rank[link_target[mask]]), link_value[mask])
+        # 链接(i, j)与下方各行中左侧各列的链接交叉
+        below = np.cumsum(weights[::-1], axis=0)[::-1] - weights
+        left = np.cumsum(below, axis=1) - below
+        total += float((weights * left).sum())
+    return total
+
+
+def _barycenter(y, link_from, link_to, link_value, n_nodes):
+    # 节点纵坐标 -> 相连节点纵坐标的流量加权平均；没有相连链接的节点保持原位
+    weight = np.bincount(link_to, weights=link_value, minlength=n_nodes)
+    moment = np.bincount(link_to, weights=link_value * y[link_from], minlength=n_nodes)
+    return np.where(weight > 0, moment / np.where(weight > 0, weight, 1), y)
+
+
+def order_nodes(column, link_source, link_target, link_value, height, gaps, sweeps=ORDER_SWEEPS):
+    """重心法排序：返回各节点在所在列内的位次（0在上）
+
+    初始顺序为节点的给定顺序；每次扫描先由左向右按流入链接、再由右向左按流出链接，
+    把各列节点按相连节点纵坐标的加权平均重新排序，保留加权交叉量最少的顺序。
+    """
+    n_nodes = len(column)
+    n_columns = int(column.max()) + 1
+    position = np.arange(n_nodes, dtype=float)
+    best_rank = _ranks(column, position)
+    best = crossings(column, best_rank, link_source, link_target, link_value)
+    link_column = column[link_target]
+    for _ in range(sweeps):
+        if best == 0:
+            break
+        previous = _ranks(column, position)
+        passes = [(c, link_source, link_target, link_column == c) for c in range(1, n_columns)]
+        passes += [(c, link_target, link_source, link_column == c + 1) for c in range(n_columns - 2, -1, -1)]
+        for c, link_from, link_to, mask in passes:
+            y = stack_nodes(column, position, height, gaps)
+            moved = _barycenter(y, link_from[mask], link_to[mask], link_value[mask], n_nodes)
+            position = np.where(column == c, moved, y)
+        rank = _ranks(column, position)
+        total = crossings(column, rank, link_source, link_target, link_value)
+        if total < best:
+            best_rank, best = rank, total
+        if np.array_equal(rank, previous):
+            break
+    return best_rank
+
+
+def node_positions(column, link_source, link_target, link_value, plot_height, pad=NODE_PAD, reorder=True):
+    """节点纵坐标：返回 (y, 节点间距像素)
+
+    column为各节点所在列（从0开始），link_*为以节点下标表示的链接（只连接相邻列），
+    plot_height为绘图区高度（像素），用于换算节点间距。reorder为False时保持给定的节点顺序。
+    返回的节点间距即plotly的node.pad，plotly据此计算的节点高度与布局一致。
+    """
+    column = np.asarray(column, dtype=np.int64)
+    link_source = np.asarray(link_source, dtype=np.int64)
+    link_target = np.asarray(link_target, dtype=np.int64)
+    link_value = np.asarray(link_value, dtype=float)
+    if not len(column):
+        return np.empty(0), pad
+    value = node_values(len(column), link_source, link_target, link_value)
+    # 多期串联时新增/流失节点在plotly中位于首/尾层，与布局的列不同：
+    # 高度比例按plotly的分层计算，必要时加大间距使节点仍能放进布局的各列
+    plotly_column = _plotly_columns(column, link_source, link_target)
+    pad_share = node_pad([column, plotly_column], plot_height, pad) / plot_height
+    scale = _scale(column, value, pad_share)
+    if _scale(plotly_column, value, pad_share) > scale:
+        pad_share = _fit_pad(plotly_column, value, scale, pad_share)
+    height = value * _scale(plotly_column, value, pad_share)
+    gaps = column_gaps(column, height, pad_share)
+    if reorder and len(link_value):
+        rank = order_nodes(column, link_source, link_target, link_value, height, gaps)
+    else:
+        rank = _ranks(column, np.arange(len(column), dtype=float))
+    return stack_nodes(column, rank.astype(float), height, gaps), pad_share * plot_height
@@ -0,0 +1,128 @@
+"""节点编码：流向表只保存整数节点编号，可读标签只在展示时生成"""
+from enum import IntEnum
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+SOURCE = 'source'
+TARGET = 'target'
+SIDE_PREFIX = {SOURCE: "期初_", TARGET: "期末_"}
+OTHER_BRAND_NAME = "其他品牌"
+
+
+def object_nbytes(values):
+    """对象数组（如名称字符串）的深度内存占用（字节），包括各元素本身"""
+    return int(pd.Index(values).memory_usage(deep=True))
+
+
+class NodeKind(IntEnum):
+    """节点类型"""
+    BRAND = 0
+    NEW_STORE = 1
+    STORE_LOSS = 2
+    NEW_CATEGORY = 3
+    CATEGORY_LOSS = 4
+    OTHER_BRAND = 5
+    OTHER_FLOW = 6
+
+    @property
+    def key(self):
+        """颜色方案等处使用的类型名称，如 'new_store'"""
+        return self.name.lower()
+
+
+# 非品牌节点固定占用前几个编号，品牌节点编号 = 品牌编码 + len(SPECIAL_KINDS)
+# OTHER_FLOW只出现在图中：细节层级合并后的小链接汇入该节点
+SPECIAL_KINDS = (NodeKind.NEW_STORE, NodeKind.STORE_LOSS, NodeKind.NEW_CATEGORY, NodeKind.CATEGORY_LOSS,
+                 NodeKind.OTHER_FLOW)
+SPECIAL_NAMES = {
+    NodeKind.NEW_STORE: "新增门店",
+    NodeKind.STORE_LOSS: "门店流失",
+    NodeKind.NEW_CATEGORY: "新增品类",
+    NodeKind.CATEGORY_LOSS: "品类流失",
+    NodeKind.OTHER_FLOW: "其他流向",
+}
+
+
+def special_node(kind):
+    """返回非品牌节点的编号"""
+    return SPECIAL_KINDS.index(kind)
+
+
+class NodeDictionary:
+    """节点字典：节点编号 -> 类型、品牌名称、标签
+
+    stores为门店键 -> 门店名称（Passport_id的分类类别，门店键为其编码），
+    由store_period_totals记录，用于链接下钻；为None时门店键即门店名称。
+    """
+
+    def __init__(self, brands, stores=None):
+        self.brands = pd.Index(brands, dtype=object)
+        self.stores = stores
+        self.names = np.array([SPECIAL_NAMES[kind] for kind in SPECIAL_KINDS] + list(self.brands), dtype=object)
+        brand_kinds = np.where(self.brands == OTHER_BRAND_NAME, NodeKind.OTHER_BRAND, NodeKind.BRAND)
+        self.kinds = np.concatenate([np.array(SPECIAL_KINDS), brand_kinds]).astype(np.int8)
+
+    def __len__(self):
+        return len(self.names)
+
+    @cached_property
+    def nbytes(self):
+        """占用内存（字节），包括名称字符串本身（门店名称可达百万级）"""
+        size = self.kinds.nbytes + object_nbytes(self.names) + object_nbytes(self.brands)
+        if self.stores is not None:
+            size += object_nbytes(self.stores)
+        return size
+
+    def brand_nodes(self, codes):
+        """品牌编码 -> 节点编号"""
+        return np.asarray(codes, dtype=np.int32) + len(SPECIAL_KINDS)
+
+    def kind(self, node):
+        return NodeKind(int(self.kinds[node]))
+
+    def brand(self, node):
+        """品牌节点返回品牌名称，其他节点返回None"""
+        return self.names[node] if self.kinds[node] == NodeKind.BRAND else None
+
+    def label(self, node, side):
+        return SIDE_PREFIX[side] + self.names[node]
+
+    def labels(self, nodes, side):
+        """批量生成节点标签，如 期初_xxx / 期末_xxx"""
+        return SIDE_PREFIX[side] + self.names[np.asarray(nodes, dtype=np.int64)]
+
+
+class FlowTable:
+    """流向表：source/target为节点编号，流量为数值，nodes为共享的节点字典
+
+    reconciliation为计算时的流量核对结果（见flow_engine.Reconciliation），汇总后的表为None；
+    contributions为可选的门店贡献索引（见drilldown.StoreContributions）。
+    """
+
+    def __init__(self, flows, nodes, reconciliation=None, contributions=None):
+        self.flows = flows
+        self.nodes = nodes
+        self.reconciliation = reconciliation
+        self.contributions = contributions
+
+    @property
+    def empty(self):
+        return self.flows.empty
+
+    @property
+    def nbytes(self):
+        size = int(self.flows.memory_usage(index=True, deep=True).sum()) + self.nodes.nbytes
+        if self.contributions is not None:
+            size += self.contributions.nbytes
+        return size
+
+    def labeled(self, flows=None):
+        """转换为带可读标签的 起始点/目标点/流量 表（仅用于展示和导出）"""
+        flows = self.flows if flows is None else flows
+        return pd.DataFrame({
+            '起始点': self.nodes.labels(flows['source'].to_numpy(), SOURCE),
+            '目标点': self.nodes.labels(flows['target'].to_numpy(), TARGET),
+            '流量': flows['流量'].to_numpy(),
+        })
@@ -0,0 +1,275 @@
+"""超出内存的数据：按Passport_id哈希分区落盘，逐个分区计算流向后只保留汇总结果
+
+分区时按块流式读取列式文件（每块只保留所需期间的行），门店、期间、品牌转换为编码后
+写入各分区的Arrow文件；同一门店总在同一分区，因此逐分区计算流向再按（起始点，目标点）
+求和与一次性计算的结果相同。峰值内存与单个数据块、单个分区的大小成正比，
+与文件总行数无关。分区只做一次，Top N、分配方式和期间组合变化时直接复用。
+"""
+import math
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from brands import normalize_names, select_top_brands, top_brand_mapping
+from flow_engine import flows_from_totals, store_period_totals
+from ingest import columnar_rows, iter_period_batches, scan_columnar
+from nodes import OTHER_BRAND_NAME, FlowTable, NodeDictionary, object_nbytes
+from parallel import DEFAULT_WORKERS
+from period_cube import PeriodCube, period_pairs
+
+# 超过该行数的文件默认使用分区计算
+OUT_OF_CORE_ROWS = int(os.environ.get("SANKEY_OUT_OF_CORE_ROWS", "20000000"))
+# 每个分区的目标行数（决定单个分区计算时的内存）
+PARTITION_ROWS = int(os.environ.get("SANKEY_PARTITION_ROWS", "2000000"))
+MAX_PARTITIONS = 256
+# 分区文件落盘目录（默认系统临时目录；不放在/dev/shm，否则仍然占用内存）
+SPILL_DIR = os.environ.get("SANKEY_SPILL_DIR") or None
+
+PARTITION_SCHEMA = pa.schema([
+    ('Passport_id', pa.string()),
+    ('Q', pa.int16()),
+    ('brand', pa.int32()),
+    ('Value U', pa.float64()),
+])
+
+
+def _category_positions(values, index, clean=False):
+    """分类列的每个取值在index中的位置（不存在或缺失为-1），只对类别做一次查找"""
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    categories = values.cat.categories
+    if clean:
+        categories = normalize_names(categories)
+    positions = np.append(index.get_indexer(categories), -1)
+    return positions[values.cat.codes.to_numpy()]
+
+
+def _store_strings(column):
+    """Passport_id列 -> 字符串数组（分区文件不共享字典）"""
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+    return pc.cast(column, pa.string())
+
+
+def partition_columnar(columnar_file, periods, brands, n_partitions, partition_dir):
+    """按Passport_id哈希把所选期间的行写入n_partitions个分区文件，返回分区文件路径列表
+
+    分区文件中Q为期间在periods中的位置，brand为清洗后的品牌在brands中的编码，
+    缺失品牌记为'其他品牌'，缺失门店的行不参与流向计算，直接丢弃。
+    """
+    period_index = pd.Index(list(periods), dtype=object)
+    other_code = brands.get_loc(OTHER_BRAND_NAME)
+    paths = [os.path.join(partition_dir, f"part_{i}.arrow") for i in range(n_partitions)]
+    sinks = [None] * n_partitions
+    writers = [None] * n_partitions
+    try:
+        for batch in iter_period_batches(columnar_file, periods, ['brand', 'Value U', 'Passport_id', 'Q']):
+            if batch.num_rows == 0:
+                continue
+            # 按本块门店字符串哈希（字典增量下每块的门店字典是累计的，不对整个字典求哈希）
+            stores = _store_strings(batch.column('Passport_id'))
+            keep = np.flatnonzero(stores.is_valid().to_numpy(zero_copy_only=False))
+            if not len(keep):
+                continue
+            hashes = pd.util.hash_array(stores.take(pa.array(keep)).to_numpy(zero_copy_only=False))
+            parts = (hashes % np.uint64(n_partitions)).astype(np.int64)
+            chunk = batch.select(['Q', 'brand']).to_pandas()
+            period_codes = _category_positions(chunk['Q'], period_index).astype(np.int16)
+            brand_codes = _category_positions(chunk['brand'], brands, clean=True)
+            brand_codes = np.where(brand_codes < 0, other_code, brand_codes).astype(np.int32)
+            values = batch.column('Value U').cast(pa.float64())
+
+            order = np.argsort(parts, kind='stable')
+            bounds = np.searchsorted(parts[order], np.arange(n_partitions + 1))
+            for part, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+                if lo == hi:
+                    continue
+                rows = keep[order[lo:hi]]
+                taken = pa.array(rows)
+                part_batch = pa.record_batch([
+                    stores.take(taken),
+                    pa.array(period_codes[rows]),
+                    pa.array(brand_codes[rows]),
+                    values.take(taken),
+                ], schema=PARTITION_SCHEMA)
+                if writers[part] is None:
+                    sinks[part] = pa.OSFile(paths[part], "wb")
+                    writers[part] = pa.ipc.new_file(sinks[part], PARTITION_SCHEMA)
+                writers[part].write_batch(part_batch)
+    finally:
+        for writer, sink in zip(writers, sinks):
+            if writer is not None:
+                writer.close()
+                sink.close()
+    return [path for path, writer in zip(paths, writers) if writer is not None]
+
+
+def _partition_flows(path, pair_codes, mapping, categories, strategy, seed):
+    """读取一个分区，返回 {(期初编码, 期末编码): 按（起始点，目标点）汇总的流向}"""
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    df = pd.DataFrame({
+        'Passport_id': pd.Categorical(table.column('Passport_id').to_numpy(zero_copy_only=False)),
+        'Q': table.column('Q').to_numpy(),
+        'brand_processed': pd.Categorical.from_codes(mapping[table.column('brand').to_numpy()], categories),
+        'Value U': table.column('Value U').to_numpy(zero_copy_only=False),
+    })
+    del table
+    needed = sorted({period for pair in pair_codes for period in pair})
+    totals, nodes = store_period_totals(df, needed, 'brand_processed')
+    del df
+    results = {}
+    for start, end in pair_codes:
+        flows = flows_from_totals(totals[start], totals[end], nodes, strategy=strategy, seed=seed).flows
+        results[(start, end)] = flows.groupby(['source', 'target'], as_index=False, sort=False)['流量'].sum()
+    return results
+
+
+class OutOfCoreDataset:
+    """按分区计算流向的数据文件，接口与pipeline.Dataset一致
+
+    flows返回按（起始点，目标点）汇总后的流向表，界面、报告和导出直接使用该汇总结果；
+    对象不保留计算结果（由调用方缓存，界面使用共享的流向缓存），分区文件在对象回收或调用close时删除。同一对象可在多个会话间共享：
+    各会话通过aliases/workers参数传入自己的选项，不修改对象属性。
+    """
+    out_of_core = True
+
+    def __init__(self, columnar_file, name=None, workers=DEFAULT_WORKERS,
+                 partition_rows=PARTITION_ROWS, spill_dir=SPILL_DIR, aliases=None):
+        self.columnar_file = columnar_file
+        self.name = name or os.path.splitext(os.path.basename(columnar_file))[0]
+        self.periods, self.raw_brand_totals = scan_columnar(columnar_file)
+        self.rows = columnar_rows(columnar_file)
+        self.workers = max(1, int(workers))
+        self.partition_rows = partition_rows
+        self.spill_dir = spill_dir
+        # 别名在计算时按编码映射合并，修改别名不需要重新分区
+        self.aliases = aliases or {}
+        # 全粒度品牌（清洗后），分区文件中的品牌编码指向这里
+        cleaned = set(normalize_names(self.raw_brand_totals.index)) | {OTHER_BRAND_NAME}
+        self.brands = pd.Index(sorted(cleaned), dtype=object)
+        self._partitions = None
+        self._finalizer = None
+        self._lock = threading.Lock()
+
+    @property
+    def n_partitions(self):
+        return int(min(MAX_PARTITIONS, max(1, math.ceil(self.rows / max(1, self.partition_rows)))))
+
+    @property
+    def nbytes(self):
+        return (object_nbytes(self.brands) + object_nbytes(self.raw_brand_totals.index)
+                + int(self.raw_brand_totals.nbytes))
+
+    def partitions(self):
+        """分区文件路径列表（首次调用时生成，多个会话同时调用时只分区一次）"""
+        with self._lock:
+            if self._partitions is None:
+                partition_dir = tempfile.mkdtemp(prefix="sankey_partitions_", dir=self.spill_dir)
+                self._finalizer = weakref.finalize(self, shutil.rmtree, partition_dir, True)
+                try:
+                    self._partitions = partition_columnar(self.columnar_file, self.periods, self.brands,
+                                                          self.n_partitions, partition_dir)
+                except BaseException:
+                    self.close()
+                    raise
+            return self._partitions
+
+    def close(self):
+        """删除分区文件"""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._partitions = None
+        self._finalizer = None
+
+    def _top_n(self, top_n, aliases):
+        top_brands = select_top_brands(self.raw_brand_totals, top_n, aliases)
+        mapping, categories = top_brand_mapping(self.brands, top_brands, aliases)
+        return mapping, categories
+
+    def compute_pairs(self, pairs, top_n=10, strategy='sequential', seed=None, progress=None,
+                      aliases=None, workers=None):
+        """一次遍历所有分区计算多个期间组合，返回 {(期初, 期末): FlowTable}
+
+        random策略下各分区使用由seed派生的独立随机数（见parallel.compute_flows_parallel）；
+        progress(已完成分区数, 分区总数)在每个分区完成后调用（分区按门店哈希划分，近似门店比例）；
+        aliases/workers为None时使用对象属性。
+        """
+        aliases = self.aliases if aliases is None else aliases
+        workers = self.workers if workers is None else max(1, int(workers))
+        mapping, categories = self._top_n(top_n, aliases)
+        nodes = NodeDictionary(categories)
+        pairs = list(dict.fromkeys(tuple(pair) for pair in pairs))
+        results = {}
+        if pairs:
+            pair_codes = [(self.periods.index(start), self.periods.index(end)) for start, end in pairs]
+            paths = self.partitions()
+            shard_seeds = (np.random.SeedSequence(seed).spawn(len(paths)) if seed is not None
+                           else [None] * len(paths))
+            tasks = [(path, pair_codes, mapping, categories, strategy,
+                      None if shard_seed is None else int(shard_seed.generate_state(1)[0]))
+                     for path, shard_seed in zip(paths, shard_seeds)]
+            if progress is not None:
+                progress(0, len(tasks))
+            if workers == 1 or len(tasks) == 1:
+                partials = []
+                for task in tasks:
+                    partials.append(_partition_flows(*task))
+                    if progress is not None:
+                        progress(len(partials), len(tasks))
+            else:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+                    futures = [executor.submit(_partition_flows, *task) for task in tasks]
+                    try:
+                        for done, _ in enumerate(as_completed(futures), 1):
+                            if progress is not None:
+                                progress(done, len(tasks))
+                    except BaseException:
+                        # 取消时不再启动排队中的分区
+                        for future in futures:
+                            future.cancel()
+                        raise
+                    partials = [future.result() for future in futures]
+
+            for pair, codes in zip(pairs, pair_codes):
+                parts = [partial[codes] for partial in partials]
+                merged = (pd.concat(parts, ignore_index=True) if parts
+                          else pd.DataFrame({'source': [], 'target': [], '流量': []}))
+                merged = merged.groupby(['source', 'target'], as_index=False, sort=True)['流量'].sum()
+                results[pair] = merged.astype({'source': np.int32, 'target': np.int32})
+        return {pair: FlowTable(results[pair], nodes) for pair in pairs}
+
+    def flows(self, start_period, end_period, top_n=10, strategy='sequential', seed=None, progress=None,
+              aliases=None, workers=None):
+        """计算期初到期末的流向表（已按起始点、目标点汇总）"""
+        pair = (start_period, end_period)
+        return self.compute_pairs([pair], top_n=top_n, strategy=strategy, seed=seed, progress=progress,
+                                  aliases=aliases, workers=workers)[pair]
+
+    def cube(self, mode='consecutive', top_n=10, strategy='sequential', seed=None, periods=None, progress=None,
+             aliases=None, workers=None):
+        """一次遍历分区构建期间立方体（见period_cube.PeriodCube）；periods默认为全部期间"""
+        periods = list(periods or self.periods)
+        aliases = self.aliases if aliases is None else aliases
+        pairs = period_pairs(periods, mode)
+        tables = self.compute_pairs(pairs, top_n=top_n, strategy=strategy, seed=seed, progress=progress,
+                                    aliases=aliases, workers=workers)
+        parts = []
+        for (start_period, end_period), table in tables.items():
+            flows = table.flows.copy()
+            flows.insert(0, 'end', np.int16(periods.index(end_period)))
+            flows.insert(0, 'start', np.int16(periods.index(start_period)))
+            parts.append(flows)
+        columns = ['start', 'end', 'source', 'target', '流量']
+        data = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+        nodes = NodeDictionary(self._top_n(top_n, aliases)[1])
+        return PeriodCube(periods, data[columns], nodes)
@@ -0,0 +1,89 @@
+"""多进程流向计算：按Passport_id哈希分片，各进程计算局部流向表后合并"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from flow_engine import FLOW_COLUMNS, brand_categories, compute_flows
+from nodes import FlowTable, NodeDictionary
+
+# 默认进程数（1表示单进程），可通过环境变量配置
+DEFAULT_WORKERS = max(1, int(os.environ.get("SANKEY_WORKERS", "1")))
+MAX_WORKERS = os.cpu_count() or 1
+# 分片文件优先放在内存文件系统中
+SHARD_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def shard_ids(stores, n_shards):
+    """按门店哈希分片，同一门店总在同一分片"""
+    hashes = pd.util.hash_pandas_object(stores, index=False).to_numpy()
+    return (hashes % np.uint64(n_shards)).astype(np.int64)
+
+
+def _write_shard(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _compute_shard(path, start_period, end_period, brand_col, strategy, seed):
+    """子进程：内存映射读取分片并计算聚合后的局部流向表"""
+    with pa.memory_map(path) as source:
+        shard = pa.ipc.open_file(source).read_all().to_pandas()
+    flows = compute_flows(shard, start_period, end_period, brand_col=brand_col,
+                          strategy=strategy, seed=seed).flows
+    return flows.groupby(['source', 'target'], as_index=False, sort=False)['流量'].sum()
+
+
+def compute_flows_parallel(df, start_period, end_period, brand_col='brand_processed',
+                           strategy='sequential', seed=None, workers=DEFAULT_WORKERS, progress=None):
+    """多进程计算流向表，结果与compute_flows按（起始点，目标点）汇总后一致
+
+    门店之间互不影响，因此按门店分片计算后求和与单进程结果相同；
+    random策略下各分片使用由seed派生的独立随机数，节点总量不变，
+    具体的跨品牌配对与单进程不同。progress(已完成分片数, 分片总数)在每个分片完成后调用。
+    """
+    workers = max(1, int(workers))
+    brands = brand_categories(df[brand_col])
+    nodes = NodeDictionary(brands.categories)
+    if workers == 1:
+        return compute_flows(df, start_period, end_period, brand_col=brand_col,
+                             strategy=strategy, seed=seed)
+
+    # 只传递计算需要的列和两期的行；品牌保持统一的分类字典
+    data = df.loc[df['Q'].isin([start_period, end_period]), ['Passport_id', 'Q', 'Value U']].copy()
+    data[brand_col] = brands[df['Q'].isin([start_period, end_period]).to_numpy()]
+    shards = shard_ids(data['Passport_id'], workers)
+    shard_seeds = np.random.SeedSequence(seed).spawn(workers) if seed is not None else [None] * workers
+
+    with tempfile.TemporaryDirectory(prefix="sankey_shards_", dir=SHARD_DIR) as shard_dir:
+        paths = []
+        for i in range(workers):
+            path = os.path.join(shard_dir, f"shard_{i}.arrow")
+            _write_shard(data[shards == i], path)
+            paths.append(path)
+        del data
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+            futures = [
+                executor.submit(_compute_shard, path, start_period, end_period, brand_col, strategy,
+                                None if shard_seed is None else int(shard_seed.generate_state(1)[0]))
+                for path, shard_seed in zip(paths, shard_seeds)
+            ]
+            try:
+                for done, _ in enumerate(as_completed(futures), 1):
+                    if progress is not None:
+                        progress(done, len(futures))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            partials = [future.result() for future in futures]
+
+    merged = pd.concat(partials, ignore_index=True)
+    merged = merged.groupby(['source', 'target'], as_index=False)['流量'].sum()
+    return FlowTable(merged[FLOW_COLUMNS], nodes)
@@ -0,0 +1,92 @@
+"""期间流向立方体：一次批量计算多个（期初，期末）组合的流向，切换期间时直接查表"""
+from itertools import permutations
+
+import numpy as np
+import pandas as pd
+
+from flow_engine import flows_from_totals
+from nodes import FlowTable
+
+# 预计算方式及界面显示名称
+CUBE_MODES = {
+    'none': '不预计算',
+    'consecutive': '相邻期间',
+    'all': '所有期间组合',
+}
+
+
+def period_pairs(periods, mode='consecutive'):
+    """返回需要预计算的（期初，期末）组合：相邻期间或所有有序组合"""
+    periods = list(periods)
+    if mode == 'consecutive':
+        return list(zip(periods[:-1], periods[1:]))
+    if mode == 'all':
+        return list(permutations(periods, 2))
+    raise ValueError(f"未知的预计算方式: {mode}")
+
+
+class PeriodCube:
+    """按（期初，期末，起始节点，目标节点）索引的流量表
+
+    data按期间组合排序保存（期间编码 + 节点编号 + 流量），
+    每个组合对应一段连续的行，查找只需切片。
+    """
+
+    def __init__(self, periods, data, nodes):
+        self.periods = list(periods)
+        self.data = data
+        self.nodes = nodes
+        self._slices = {}
+        starts = data['start'].to_numpy()
+        ends = data['end'].to_numpy()
+        if len(data):
+            change = np.flatnonzero((starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])) + 1
+            bounds = np.r_[0, change, len(data)]
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                pair = (self.periods[starts[lo]], self.periods[ends[lo]])
+                self._slices[pair] = slice(lo, hi)
+
+    def __contains__(self, pair):
+        return tuple(pair) in self._slices
+
+    @property
+    def pairs(self):
+        return list(self._slices)
+
+    @property
+    def nbytes(self):
+        return int(self.data.memory_usage(index=True, deep=True).sum()) + self.nodes.nbytes
+
+    def flows(self, start_period, end_period):
+        """查表得到某个期间组合的流向表（按起始点、目标点汇总）"""
+        rows = self.data.iloc[self._slices[(start_period, end_period)]]
+        return FlowTable(rows[['source', 'target', '流量']].reset_index(drop=True), self.nodes)
+
+
+def cube_from_totals(totals, nodes, periods, mode='consecutive', strategy='sequential', seed=None,
+                     progress=None):
+    """由各期（门店，品牌编码）汇总构建期间立方体（见flow_engine.store_period_totals）
+
+    progress(已完成组合数, 组合总数)在每个期间组合计算前后以及组合内各计算步骤之间调用。
+    """
+    periods = list(periods)
+    pairs = period_pairs(periods, mode)
+    parts = []
+    for i, (start_period, end_period) in enumerate(pairs):
+        step_progress = None
+        if progress is not None:
+            progress(i, len(pairs))
+            # 组合内的计算步骤只用于响应取消，进度仍按组合计
+            step_progress = lambda done, total, i=i: progress(i, len(pairs))
+        flows = flows_from_totals(totals[start_period], totals[end_period], nodes,
+                                  strategy=strategy, seed=seed, progress=step_progress).flows
+        flows = flows.groupby(['source', 'target'], as_index=False, sort=True)['流量'].sum()
+        flows.insert(0, 'end', np.int16(periods.index(end_period)))
+        flows.insert(0, 'start', np.int16(periods.index(start_period)))
+        parts.append(flows)
+    if progress is not None:
+        progress(len(pairs), len(pairs))
+
+    columns = ['start', 'end', 'source', 'target', '流量']
+    data = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+    return PeriodCube(periods, data[columns], nodes)
@@ -0,0 +1,669 @@
+"""不依赖Streamlit的分析流程：读取 -> Top N品牌 -> 流向 -> 汇总 -> 占比表 -> 品牌报告 -> 桑基图
+
+界面（product.py）和批量命令行（cli.py）共用这些函数。
+"""
+import colorsys
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from brands import clean_brands, select_top_brands, top_brand_mapping
+from cache import estimate_size, file_hash
+from flow_engine import flows_from_totals, rebucket_totals, store_period_totals
+from ingest import REQUIRED_COLUMNS, columnar_rows, ensure_columnar, load_periods, scan_columnar
+from node_layout import node_positions
+from nodes import SOURCE, SPECIAL_KINDS, TARGET, NodeDictionary, NodeKind, special_node
+from out_of_core import OUT_OF_CORE_ROWS, OutOfCoreDataset
+from period_cube import cube_from_totals
+
+# 定义类型颜色方案
+TYPE_COLOR_SCHEME = {
+    "highlight": "rgb(255, 215, 0)",       # 高亮节点（金色）
+    "new_store": "rgb(255, 182, 193)",    # 新增门店（浅粉色）
+    "store_loss": "rgb(255, 182, 193)",   # 门店流失（浅粉色，与新增门店相同）
+    "new_category": "rgb(144, 238, 144)", # 新增品类（浅绿色）
+    "category_loss": "rgb(144, 238, 144)",# 品类流失（浅绿色，与新增品类相同）
+    "other_brand": "rgb(221, 160, 221)",  # 其他品牌（淡紫色）
+    "other": "rgb(220, 220, 220)"         # 其他节点（浅灰色）
+}
+# 图表高度上限（像素），节点再多也不再增高
+MAX_FIGURE_HEIGHT = 2000
+# 图表下边距（像素），绘图区高度 = 图表高度 - 上下边距
+_BOTTOM_MARGIN = 80
+
+
+def open_source(path, cache_dir=None):
+    """本地数据文件 -> (文件哈希, 列式文件路径)；同一内容只转换一次"""
+    digest = file_hash(path)
+    with open(path, "rb") as source:
+        return digest, ensure_columnar(source, digest, cache_dir)
+
+
+def load_clean_data(columnar_file, periods):
+    """读取所选期间并清洗品牌列（全粒度brand_clean）"""
+    df = load_periods(columnar_file, periods, REQUIRED_COLUMNS)
+    # 检查必要的列是否存在
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if missing_columns:
+        raise ValueError(f"上传的文件缺少必要的列: {', '.join(missing_columns)}")
+    return clean_brands(df)
+
+
+def full_brand_totals(df, periods):
+    """各期按（门店，全粒度品牌）汇总，返回 ({期间: Series}, 节点字典)"""
+    return store_period_totals(df, periods, 'brand_clean')
+
+
+def top_n_totals(full_totals, full_nodes, raw_brand_totals, top_n, aliases=None):
+    """把全粒度汇总合并为Top N品牌 + 其他品牌，返回 (各期汇总, 节点字典, Top N品牌)
+
+    aliases为品牌别名字典：别名合并与Top N归类在同一次编码映射中完成，不需要重新清洗数据。
+    """
+    top_brands = select_top_brands(raw_brand_totals, top_n, aliases)
+    mapping, categories = top_brand_mapping(full_nodes.brands, top_brands, aliases)
+    return rebucket_totals(full_totals, mapping), NodeDictionary(categories, full_nodes.stores), top_brands
+
+
+class Dataset:
+    """一个数据文件的已解析数据，在多个期间组合、Top N之间共享
+
+    全粒度（门店，品牌）汇总在首次使用时一次性计算，只读取used_periods的行：
+    used_periods默认为全部期间，批量计算时为本进程的期间组合用到的期间。
+    scan为已有的扫描结果 (期间列表, 原始品牌合计)，传入时不再扫描文件。
+    """
+    out_of_core = False
+
+    def __init__(self, columnar_file, name=None, aliases=None, used_periods=None, scan=None):
+        self.columnar_file = columnar_file
+        self.name = name or os.path.splitext(os.path.basename(columnar_file))[0]
+        self.periods, self.raw_brand_totals = scan or scan_columnar(columnar_file)
+        if used_periods is None:
+            self.used_periods = self.periods
+        else:
+            used_periods = set(used_periods)
+            self.used_periods = [period for period in self.periods if period in used_periods]
+        self.aliases = aliases or {}
+        self._totals = None
+
+    @classmethod
+    def from_path(cls, path, cache_dir=None, aliases=None):
+        _, columnar_file = open_source(path, cache_dir)
+        return cls(columnar_file, os.path.splitext(os.path.basename(path))[0], aliases)
+
+    def totals(self):
+        if self._totals is None:
+            df = load_clean_data(self.columnar_file, self.used_periods)
+            self._totals = full_brand_totals(df, self.used_periods)
+        return self._totals
+
+    def flows(self, start_period, end_period, top_n=10, strategy='sequential', seed=None):
+        """计算期初到期末的流向表（FlowTable）"""
+        full_totals, full_nodes = self.totals()
+        totals, nodes, _ = top_n_totals(full_totals, full_nodes, self.raw_brand_totals, top_n, self.aliases)
+        return flows_from_totals(totals[start_period], totals[end_period], nodes,
+                                 strategy=strategy, seed=seed)
+
+    def cube(self, mode='consecutive', top_n=10, strategy='sequential', seed=None, periods=None):
+        """构建期间立方体；periods默认为used_periods（多期串联时为所选期间）"""
+        full_totals, full_nodes = self.totals()
+        totals, nodes, _ = top_n_totals(full_totals, full_nodes, self.raw_brand_totals, top_n, self.aliases)
+        return cube_from_totals(totals, nodes, periods or self.used_periods, mode, strategy=strategy, seed=seed)
+
+
+def open_dataset(path, cache_dir=None, out_of_core=None, workers=1, aliases=None):
+    """本地数据文件 -> Dataset或OutOfCoreDataset
+
+    out_of_core为None时按行数自动选择：超过OUT_OF_CORE_ROWS行的文件按分区落盘计算。
+    """
+    _, columnar_file = open_source(path, cache_dir)
+    name = os.path.splitext(os.path.basename(path))[0]
+    if out_of_core is None:
+        out_of_core = columnar_rows(columnar_file) > OUT_OF_CORE_ROWS
+    if out_of_core:
+        return OutOfCoreDataset(columnar_file, name, workers=workers, aliases=aliases)
+    return Dataset(columnar_file, name, aliases)
+
+
+class LinkIndex:
+    """全量流向按（起始点，目标点）汇总一次后的链接索引
+
+    节点筛选只需对链接做掩码（按节点编号查布尔表），不再重新筛选、汇总原始流向。
+    """
+
+    def __init__(self, flows, n_nodes):
+        self.links = flows.groupby(['source', 'target'], as_index=False, sort=True)['流量'].sum()
+        self.n_nodes = n_nodes
+        self._source = self.links['source'].to_numpy()
+        self._target = self.links['target'].to_numpy()
+
+    @property
+    def nbytes(self):
+        return int(self.links.memory_usage(index=True, deep=True).sum())
+
+    def _selected(self, nodes):
+        selected = np.zeros(self.n_nodes, dtype=bool)
+        selected[np.asarray(list(nodes), dtype=np.int64)] = True
+        return selected
+
+    def select(self, selected_sources, selected_targets):
+        """筛选后的链接（已按起始点、目标点汇总）"""
+        mask = self._selected(selected_sources)[self._source] & self._selected(selected_targets)[self._target]
+        return self.links[mask].reset_index(drop=True)
+
+    def filter_flows(self, flows, selected_sources, selected_targets):
+        """用同样的节点掩码筛选原始流向表（用于导出明细）"""
+        mask = (self._selected(selected_sources)[flows['source'].to_numpy()]
+                & self._selected(selected_targets)[flows['target'].to_numpy()])
+        return flows[mask]
+
+
+def aggregate_flows(flows):
+    """按（起始点，目标点）汇总流向，返回 (汇总流向, 源节点总流量, 目标节点总流量)
+
+    节点总流量为 节点/总流量 两列，按总流量降序排列。
+    """
+    aggregated_df = flows.groupby(['source', 'target'], as_index=False)['流量'].sum()
+
+    # 源节点按流出流量排序（降序）
+    source_flow = aggregated_df.groupby('source')['流量'].sum().reset_index()
+    source_flow.columns = ['节点', '总流量']
+    source_flow_sorted = source_flow.sort_values('总流量', ascending=False).reset_index(drop=True)
+
+    # 目标节点按流入流量排序（降序）
+    target_flow = aggregated_df.groupby('target')['流量'].sum().reset_index()
+    target_flow.columns = ['节点', '总流量']
+    target_flow_sorted = target_flow.sort_values('总流量', ascending=False).reset_index(drop=True)
+    return aggregated_df, source_flow_sorted, target_flow_sorted
+
+
+def percentage_table(aggregated_df, source_flow, target_flow, nodes):
+    """流量占比表：每个源节点流向各目标节点的流量及占期初、期末比
+
+    一次连接源、目标节点总流量后按列计算占比；行按源节点总流量降序，
+    同一源节点内按占期初比降序（相同时按目标节点编号）。
+    包含source/target节点编号列（展示和导出时去掉）。
+    """
+    source_totals = source_flow.rename(columns={'节点': 'source', '总流量': 'source_total'})
+    source_totals['source_rank'] = range(len(source_totals))
+    target_totals = target_flow.rename(columns={'节点': 'target', '总流量': 'target_total'})
+    df = (aggregated_df
+          .merge(source_totals, on='source', how='inner')
+          .merge(target_totals, on='target', how='inner'))
+
+    # 计算占比（保留两位小数）
+    df['占期初比(%)'] = (df['流量'] / df['source_total'] * 100).round(2)
+    df['占期末比(%)'] = (df['流量'] / df['target_total'] * 100).round(2)
+    df = df.sort_values(['source_rank', '占期初比(%)', 'target'], ascending=[True, False, True], kind='stable')
+
+    source = df['source'].to_numpy()
+    target = df['target'].to_numpy().astype(int)
+    return pd.DataFrame({
+        'source': source,
+        'target': target,
+        '源节点': nodes.labels(source, SOURCE),
+        '源节点总流量(万)': df['source_total'].to_numpy() / 10000,  # 转换为万单位
+        '目标节点': nodes.labels(target, TARGET),
+        '流量(万)': df['流量'].to_numpy() / 10000,
+        '占期初比(%)': df['占期初比(%)'].to_numpy(),
+        '占期末比(%)': df['占期末比(%)'].to_numpy(),
+    })
+
+
+def _report_pivot(percentage_df):
+    """把占比表中与品牌报告相关的行透视为 品牌节点 × 指标 的表
+
+    指标：保留、门店流失、品类流失（期初侧），新增门店、新增品类（期末侧）；
+    每项都有 流量(万)、占期初比(%)、占期末比(%) 三列，缺失为NaN。
+    """
+    source = percentage_df['source'].to_numpy()
+    target = percentage_df['target'].to_numpy()
+    conditions = [
+        source == target,
+        target == special_node(NodeKind.STORE_LOSS),
+        target == special_node(NodeKind.CATEGORY_LOSS),
+        source == special_node(NodeKind.NEW_STORE),
+        source == special_node(NodeKind.NEW_CATEGORY),
+    ]
+    metric = np.select(conditions, ['retain', 'store_loss', 'category_loss', 'new_store', 'new_category'], '')
+    # 期初侧指标归属源节点，期末侧指标归属目标节点
+    brand = np.where(np.isin(metric, ['new_store', 'new_category']), target, source)
+    keep = metric != ''
+    rows = percentage_df.loc[keep, ['流量(万)', '占期初比(%)', '占期末比(%)']].assign(
+        brand=brand[keep], metric=metric[keep]
+    )
+    return rows.pivot(index='brand', columns='metric')
+
+
+def _top_conversions(percentage_df, nodes, by, limit=3):
+    """品牌之间的转换：每个品牌按占比表顺序取前limit条，返回 {品牌节点: 行DataFrame}"""
+    source = percentage_df['source'].to_numpy()
+    target = percentage_df['target'].to_numpy()
+    is_brand = nodes.kinds == NodeKind.BRAND
+    conversions = percentage_df[is_brand[source] & is_brand[target] & (source != target)]
+    top = conversions.groupby(by, sort=False).head(limit)
+    return {node: rows for node, rows in top.groupby(by, sort=False)}
+
+
+def brand_report(percentage_df, source_flow, target_flow, nodes):
+    """品牌流量分析报告，返回按顺序显示的Markdown文本行
+
+    只包含汇总流向中出现的品牌节点（源节点顺序优先，然后是仅在目标节点中的品牌）。
+    各品牌的保留、转换、流失和新增数据来自一次透视，不再逐品牌筛选占比表。
+    """
+    source_total_flow = dict(zip(source_flow['节点'], source_flow['总流量']))
+    target_total_flow = dict(zip(target_flow['节点'], target_flow['总流量']))
+
+    # 品牌节点在期初、期末两侧使用同一个编号
+    report_nodes = pd.unique(np.concatenate([source_flow['节点'].to_numpy(), target_flow['节点'].to_numpy()]))
+    sorted_brands = [node for node in report_nodes if nodes.kind(node) == NodeKind.BRAND]
+
+    pivot = _report_pivot(percentage_df)
+    stats = pivot.to_dict('index') if len(pivot) else {}
+    converted_to = _top_conversions(percentage_df, nodes, 'source')
+    converted_from = _top_conversions(percentage_df, nodes, 'target')
+
+    def stat(node, column, metric):
+        # 没有对应流向时记为0
+        value = stats.get(node, {}).get((column, metric), np.nan)
+        return 0 if pd.isna(value) else value
+
+    lines = []
+    for brand_node in sorted_brands:
+        brand = nodes.brand(brand_node)
+        # 1. 品牌A的期初分析
+        if brand_node in source_total_flow:
+            start_total = source_total_flow[brand_node] / 10000  # 转换为万单位
+            lines.append(f"**{brand} 期初分析**")
+
+            # 生成期初分析文本
+            report_text = f"{brand}，期初金额{start_total:.1f}万，"
+            report_text += (f"期末仍旧使用{brand}的金额{stat(brand_node, '流量(万)', 'retain'):.1f}万，"
+                            f"占比{stat(brand_node, '占期初比(%)', 'retain')}%；")
+
+            # 添加转换到其他品牌的信息（只显示前3个主要转换）
+            conversions = converted_to.get(brand_node)
+            if conversions is not None:
+                for target, flow, pct in zip(conversions['target'], conversions['流量(万)'], conversions['占期初比(%)']):
+                    report_text += f"转换为{nodes.brand(target)}的金额{flow:.1f}万，占比{pct}%；"
+
+            # 明确区分门店流失和品类流失
+            report_text += (f"门店流失金额{stat(brand_node, '流量(万)', 'store_loss'):.1f}万，"
+                            f"占比{stat(brand_node, '占期初比(%)', 'store_loss')}%；")
+            report_text += (f"品类流失金额{stat(brand_node, '流量(万)', 'category_loss'):.1f}万，"
+                            f"占比{stat(brand_node, '占期初比(%)', 'category_loss')}%；")
+
+            lines.append(report_text)
+
+        # 2. 品牌A的期末分析
+        target_total = target_total_flow.get(brand_node, 0) / 10000
+
+        if target_total > 0:
+            lines.append(f"**{brand} 期末分析**")
+
+            # 生成期末分析文本
+            report_text = f"{brand}，期末金额{target_total:.1f}万，"
+            report_text += (f"来自期初{brand}的金额{stat(brand_node, '流量(万)', 'retain'):.1f}万，"
+                            f"占比{stat(brand_node, '占期末比(%)', 'retain'):.2f}%；")
+
+            # 添加从其他品牌转换来的信息（只显示前3个主要来源）
+            conversions = converted_from.get(brand_node)
+            if conversions is not None:
+                for source, flow, pct in zip(conversions['source'], conversions['流量(万)'], conversions['占期末比(%)']):
+                    report_text += f"从{nodes.brand(source)}转换来的金额{flow:.1f}万，占比{pct:.2f}%；"
+
+            # 明确区分新增门店和新增品类
+            report_text += (f"新增门店金额{stat(brand_node, '流量(万)', 'new_store'):.1f}万，"
+                            f"占比{stat(brand_node, '占期末比(%)', 'new_store'):.2f}%；")
+            report_text += (f"新增品类金额{stat(brand_node, '流量(万)', 'new_category'):.1f}万，"
+                            f"占比{stat(brand_node, '占期末比(%)', 'new_category'):.2f}%；")
+
+            lines.append(report_text)
+
+        lines.append("---")  # 分隔线
+    return lines
+
+
+def generate_brand_colors(brands):
+    """生成品牌专属颜色"""
+    brand_colors = {}
+    num_brands = len(brands)
+    # 从HSV颜色空间生成均匀分布的颜色
+    for i, brand in enumerate(brands):
+        hue = i / num_brands  # 色相均匀分布
+        saturation = 0.6  # 适中饱和度
+        value = 0.9  # 较高明度，确保清晰
+        r, g, b = colorsys.hsv_to_rgb(hue, saturation, value)
+        brand_colors[brand] = f"rgb({int(r*255)}, {int(g*255)}, {int(b*255)})"
+    return brand_colors
+
+
+def prune_links(aggregated_df, source_flow, target_flow, min_share=0.0, max_links=None):
+    """细节层级：合并小链接，使图中链接数有上限
+
+    占源节点流出量比例低于min_share的链接，以及按流量排在max_links之后的链接，
+    合并为每个源节点一条流向"其他流向"节点的链接，图中链接数不超过
+    max(max_links, 源节点数 + 1)。返回 (链接, 目标节点总流量)：
+    有合并时目标节点总流量末尾追加"其他流向"节点。各源节点的流出量和链接总量不变，
+    节点总流量沿用汇总结果（标签中的数值仍为完整总量）。
+    """
+    if min_share <= 0 and (max_links is None or len(aggregated_df) <= max_links):
+        return aggregated_df, target_flow
+
+    source_total = pd.Series(source_flow['总流量'].to_numpy(), index=source_flow['节点'].to_numpy())
+    value = aggregated_df['流量'].to_numpy()
+    share = value / source_total.reindex(aggregated_df['source'].to_numpy()).to_numpy()
+    small = share < min_share
+    if max_links is not None:
+        # 每个源节点最多追加一条合并链接，保留的链接数要为其留出空间
+        keep_limit = max(max_links - len(source_flow), 1)
+        kept = np.flatnonzero(~small)
+        if len(kept) > keep_limit:
+            order = kept[np.argsort(-value[kept], kind='stable')]
+            small[order[keep_limit:]] = True
+    if not small.any():
+        return aggregated_df, target_flow
+
+    other_flow = special_node(NodeKind.OTHER_FLOW)
+    merged = aggregated_df[small].groupby('source', as_index=False, sort=False)['流量'].sum()
+    merged.insert(1, 'target', other_flow)
+    links = pd.concat([aggregated_df[~small], merged[aggregated_df.columns]], ignore_index=True)
+    target_flow = pd.concat([target_flow, pd.DataFrame({'节点': [other_flow], '总流量': [merged['流量'].sum()]})],
+                            ignore_index=True)
+    return links, target_flow
+
+
+def _rgba(colors, alpha):
+    """'rgb(r, g, b)' -> 'rgba(r, g, b, alpha)'"""
+    return colors.str.replace("rgb", "rgba", regex=False).str.replace(")", f", {alpha})", regex=False)
+
+
+def _style_nodes(table, nodes, highlight_keyword="", show_rank_value=True):
+    """为节点表添加 kind、brand_code、color、link_color、display 列（按列批量计算）
+
+    table需包含 node、label、prefix、rank、total 列；有name列时用它代替节点名称显示。
+    """
+    node = table['node'].to_numpy()
+    kind = nodes.kinds[node]
+    table['kind'] = kind
+    table['brand_code'] = np.where(kind == NodeKind.BRAND, node - len(SPECIAL_KINDS), -1)
+
+    # 品牌颜色按品牌首次出现的顺序在HSV色相上均匀分布，各列中同一品牌颜色相同
+    brand_codes = table['brand_code'].where(table['brand_code'] >= 0)
+    brand_order, brand_uniques = pd.factorize(brand_codes)
+    brand_colors = np.array(list(generate_brand_colors(range(len(brand_uniques))).values()) or [""], dtype=object)
+    kind_colors = np.array([TYPE_COLOR_SCHEME.get(NodeKind(k).key, TYPE_COLOR_SCHEME["other"])
+                            for k in range(len(NodeKind))], dtype=object)
+    color = np.where(brand_order >= 0, brand_colors[np.maximum(brand_order, 0)], kind_colors[kind])
+    # 优先检查是否为高亮节点
+    highlighted = table['label'].str.lower().str.contains(highlight_keyword.lower(), regex=False)
+    table['color'] = np.where(highlighted, TYPE_COLOR_SCHEME["highlight"], color)
+    # 链接使用源节点的颜色并设置透明度
+    table['link_color'] = _rgba(table['color'], 0.7)
+
+    # 节点标签（转换为万单位，精简标签内容，避免过长）
+    names = table['name'] if 'name' in table else pd.Series(nodes.names[node], dtype=object)
+    if show_rank_value:
+        totals = pd.Series(np.char.mod("%.1f", table['total'].to_numpy() / 10000), dtype=object)
+        table['display'] = table['prefix'] + table['rank'].astype(str) + ". " + names + " (" + totals + "万)"
+    else:
+        table['display'] = names
+    return table.drop(columns=[col for col in ['prefix', 'name'] if col in table])
+
+
+def node_table(source_flow_sorted, target_flow_sorted, nodes, highlight_keyword="", show_rank_value=True):
+    """桑基图节点表：每行一个图中节点（左侧源节点在前，右侧目标节点在后）
+
+    行号即桑基图中的节点下标。列：node（节点编号）、side、kind、brand_code
+    （品牌分类编码，非品牌为-1）、total、rank（所在侧按总流量的名次）、
+    color、link_color、label（完整标签，如 期初_xxx）、display（图中显示的标签）、column（列号）、x。
+    所有列都按列批量计算，不逐节点筛选；纵坐标由_place_nodes按链接计算。
+    """
+    sides = [(SOURCE, source_flow_sorted, "S", 0.15), (TARGET, target_flow_sorted, "T", 0.85)]
+    parts = []
+    for column, (side, side_flow, prefix, x) in enumerate(sides):
+        node = side_flow['节点'].to_numpy().astype(np.int64)
+        count = len(node)
+        rank = np.arange(1, count + 1)
+        parts.append(pd.DataFrame({
+            'node': node,
+            'side': side,
+            'rank': rank,
+            'prefix': prefix,
+            'total': side_flow['总流量'].to_numpy(dtype=float),
+            'label': nodes.labels(node, side),
+            'column': column,
+            'x': x,
+        }))
+    table = pd.concat(parts, ignore_index=True)
+    return _style_nodes(table, nodes, highlight_keyword, show_rank_value)
+
+
+def _place_nodes(table, link_source, link_target, link_value, height, top_margin=80):
+    """为节点表添加y列（节点中心的纵坐标），返回节点间距（像素）
+
+    节点高度与流量成比例、按列堆叠互不重叠，列内顺序按链接减少交叉（见node_layout）。
+    """
+    y, pad = node_positions(table['column'].to_numpy(), link_source, link_target, link_value,
+                            height - top_margin - _BOTTOM_MARGIN)
+    table['y'] = y
+    return pad
+
+
+def _sankey_trace(table, link_source, link_target, link_value, thickness, pad):
+    """桑基图数据（plotly的sankey trace），各属性直接取自节点表和链接数组"""
+    return {
+        'type': 'sankey',
+        'arrangement': "snap",  # 禁用自动布局
+        'node': {
+            'pad': pad,  # 节点间距（与节点布局一致）
+            'thickness': thickness,  # 节点厚度
+            'line': {'color': "rgba(100, 150, 255, 0.5)", 'width': 1},  # 浅色边框
+            'label': table['display'].to_numpy(),
+            'color': table['color'].to_numpy(),
+            'x': table['x'].to_numpy(dtype=float),
+            'y': table['y'].to_numpy(dtype=float),
+        },
+        'link': {
+            'source': link_source,
+            'target': link_target,
+            'value': link_value,
+            'color': table['link_color'].to_numpy()[link_source],
+        },
+    }
+
+
+def _sankey_layout(title, font_size, width, height, top_margin=80):
+    # 优化布局和字体渲染
+    return {
+        'title': {'text': title},
+        'font': {
+            'family': "Microsoft YaHei",  # 使用微软雅黑字体
+            'size': font_size,
+            'color': "rgb(30, 30, 30)",  # 深灰色文字提高清晰度
+        },
+        'width': width,
+        'height': height,
+        'margin': {'l': 120, 'r': 120, 't': top_margin, 'b': _BOTTOM_MARGIN},
+        'paper_bgcolor': "rgba(0,0,0,0)",  # 完全透明背景
+        'plot_bgcolor': "rgba(0,0,0,0)",  # 图表区域透明
+    }
+
+
+def sankey_spec(aggregated_df, source_flow_sorted, target_flow_sorted, nodes,
+                highlight_keyword="", show_rank_value=True, title="", min_link_share=0.0, max_links=None):
+    """桑基图的图形描述（plotly figure字典，数组为NumPy数组），返回 (描述, 品牌列表, 品牌颜色映射)
+
+    直接由节点表和链接数组生成，不经过plotly.graph_objects的逐属性校验；
+    min_link_share/max_links控制细节层级，见prune_links。
+    """
+    aggregated_df, target_flow_sorted = prune_links(aggregated_df, source_flow_sorted, target_flow_sorted,
+                                                    min_link_share, max_links)
+    table = node_table(source_flow_sorted, target_flow_sorted, nodes, highlight_keyword, show_rank_value)
+    source_count = len(source_flow_sorted)
+    target_count = len(target_flow_sorted)
+    total_nodes = len(table)
+
+    # 节点编号 -> 图中下标（左右两侧分别查表）
+    source_index = np.full(len(nodes), -1, dtype=np.int64)
+    target_index = np.full(len(nodes), -1, dtype=np.int64)
+    source_index[table['node'].to_numpy()[:source_count]] = np.arange(source_count)
+    target_index[table['node'].to_numpy()[source_count:]] = np.arange(source_count, total_nodes)
+    link_source = source_index[aggregated_df['source'].to_numpy()]
+    link_target = target_index[aggregated_df['target'].to_numpy()]
+
+    # 图例使用的品牌及其颜色（品牌首次出现的顺序）
+    brand_codes = pd.unique(table.loc[table['brand_code'] >= 0, 'brand_code'])
+    all_brands = list(nodes.brands[brand_codes])
+    brand_color_map = generate_brand_colors(all_brands)
+
+    # 动态调整字体大小，避免文字拥挤
+    base_font_size = 12
+    font_size = max(8, base_font_size - (total_nodes // 10))  # 节点越多字体越小
+
+    link_value = aggregated_df['流量'].to_numpy(dtype=float)
+    height = min(max(source_count, target_count) * 50 + 200, MAX_FIGURE_HEIGHT)
+    pad = _place_nodes(table, link_source, link_target, link_value, height)
+    spec = {
+        'data': [_sankey_trace(table, link_source, link_target, link_value, 40, pad)],
+        'layout': _sankey_layout(title, font_size, 1400, height),
+    }
+    return spec, all_brands, brand_color_map
+
+
+def sankey_figure(aggregated_df, source_flow_sorted, target_flow_sorted, nodes,
+                  highlight_keyword="", show_rank_value=True, title="", min_link_share=0.0, max_links=None):
+    """绘制桑基图，返回 (Figure, 品牌列表, 品牌颜色映射)；用于导出HTML/图片（见sankey_spec）"""
+    spec, all_brands, brand_color_map = sankey_spec(aggregated_df, source_flow_sorted, target_flow_sorted, nodes,
+                                                    highlight_keyword, show_rank_value, title,
+                                                    min_link_share, max_links)
+    return go.Figure(spec), all_brands, brand_color_map
+
+
+class SankeyChart:
+    """缓存的桑基图：由图形描述构建一次的plotly图形（校验只在构建时进行一次）
+
+    st.plotly_chart对Figure对象不再逐属性校验，只做序列化；nbytes按图形描述中的数组和字符串估算。
+    """
+
+    def __init__(self, spec):
+        self.figure = go.Figure(spec)
+        self.height = spec['layout']['height']
+        self.n_links = len(spec['data'][0]['link']['value'])
+        self.nbytes = estimate_size(spec)
+
+
+def chain_transitions(cube, periods, min_link_share=0.0, max_links=None):
+    """多期串联：逐个相邻期间组合汇总并合并小链接，返回 [(链接, 源节点总流量, 目标节点总流量)]
+
+    max_links为整张图的链接上限，平均分配给各个期间组合（见prune_links）。
+    """
+    periods = list(periods)
+    per_transition = None if max_links is None else max(1, max_links // max(len(periods) - 1, 1))
+    transitions = []
+    for start_period, end_period in zip(periods[:-1], periods[1:]):
+        aggregated_df, source_flow, target_flow = aggregate_flows(cube.flows(start_period, end_period).flows)
+        links, target_flow = prune_links(aggregated_df, source_flow, target_flow, min_link_share, per_transition)
+        transitions.append((links, source_flow, target_flow))
+    return transitions
+
+
+def chain_node_table(transitions, periods, nodes, highlight_keyword="", show_rank_value=True):
+    """多期串联桑基图节点表：第c列对应periods[c]，行号即图中节点下标
+
+    品牌节点在相邻两个期间组合之间共用（前一组合的目标即后一组合的源）；
+    新增门店/新增品类位于所在期间组合的左列，标签使用其进入的期间，
+    门店流失/品类流失/其他流向位于右列。除node_table的各列外，
+    key = column * 节点数 + 节点编号。
+    """
+    periods = np.asarray(list(periods), dtype=object)
+    n_nodes = len(nodes)
+    keys, totals = [], []
+    for column, (_, source_flow, target_flow) in enumerate(transitions):
+        keys += [column * n_nodes + source_flow['节点'].to_numpy(dtype=np.int64),
+                 (column + 1) * n_nodes + target_flow['节点'].to_numpy(dtype=np.int64)]
+        totals += [source_flow['总流量'].to_numpy(dtype=float), target_flow['总流量'].to_numpy(dtype=float)]
+    # 中间列的品牌节点流入、流出相等；首尾两列只有一侧
+    node_totals = pd.Series(np.concatenate(totals)).groupby(np.concatenate(keys)).max()
+    key = node_totals.index.to_numpy()
+    table = pd.DataFrame({'key': key, 'column': key // n_nodes, 'node': key % n_nodes,
+                          'total': node_totals.to_numpy()})
+    table = table.sort_values(['column', 'total', 'node'], ascending=[True, False, True],
+                              kind='stable', ignore_index=True)
+    column = table['column'].to_numpy()
+    node = table['node'].to_numpy()
+    table['rank'] = table.groupby('column').cumcount().to_numpy() + 1
+    table['x'] = 0.05 + 0.9 * column / max(len(periods) - 1, 1)
+
+    kind = nodes.kinds[node]
+    entering = np.isin(kind, [NodeKind.NEW_STORE, NodeKind.NEW_CATEGORY])
+    # 期间可能为整数（如CSV/Parquet中的20231），按字符串拼接标签
+    label_period = pd.Series(periods[np.minimum(column + entering, len(periods) - 1)], dtype=object).astype(str)
+    names = pd.Series(nodes.names[node], dtype=object)
+    table['label'] = label_period + "_" + names
+    table['name'] = names.where(~entering, names + "(" + label_period + ")")
+    table['prefix'] = ""
+    return _style_nodes(table, nodes, highlight_keyword, show_rank_value)
+
+
+def chain_sankey_spec(cube, periods, highlight_keyword="", show_rank_value=True, title="",
+                      min_link_share=0.0, max_links=None):
+    """多期串联桑基图的图形描述：periods的相邻期间依次连接为len(periods)列，返回 (描述, 品牌列表, 品牌颜色映射)
+
+    cube需包含periods所有相邻期间组合的流向（cube_from_totals的consecutive模式，
+    各期（门店，品牌）汇总只分组一次，相邻组合共用同一期的汇总）。
+    """
+    periods = list(periods)
+    nodes = cube.nodes
+    transitions = chain_transitions(cube, periods, min_link_share, max_links)
+    table = chain_node_table(transitions, periods, nodes, highlight_keyword, show_rank_value)
+
+    # 节点键 -> 图中下标
+    n_nodes = len(nodes)
+    index = np.full(len(periods) * n_nodes, -1, dtype=np.int64)
+    index[table['key'].to_numpy()] = np.arange(len(table))
+    link_source = np.concatenate([index[column * n_nodes + links['source'].to_numpy(dtype=np.int64)]
+                                  for column, (links, _, _) in enumerate(transitions)])
+    link_target = np.concatenate([index[(column + 1) * n_nodes + links['target'].to_numpy(dtype=np.int64)]
+                                  for column, (links, _, _) in enumerate(transitions)])
+    link_value = np.concatenate([links['流量'].to_numpy(dtype=float) for links, _, _ in transitions])
+
+    brand_codes = pd.unique(table.loc[table['brand_code'] >= 0, 'brand_code'])
+    all_brands = list(nodes.brands[brand_codes])
+    brand_color_map = generate_brand_colors(all_brands)
+
+    max_count = int(table.groupby('column').size().max())
+    font_size = max(8, 12 - (max_count // 10))
+    column_x = 0.05 + 0.9 * np.arange(len(periods)) / max(len(periods) - 1, 1)
+
+    height = min(max_count * 50 + 200, MAX_FIGURE_HEIGHT)
+    pad = _place_nodes(table, link_source, link_target, link_value, height, top_margin=100)
+    layout = _sankey_layout(title, font_size, max(1400, 300 * len(periods)), height, top_margin=100)
+    # 每列上方标注期间
+    layout['annotations'] = [{'x': float(x), 'y': 1.06, 'xref': "paper", 'yref': "paper",
+                              'text': f"<b>{period}</b>", 'showarrow': False}
+                             for x, period in zip(column_x, periods)]
+    spec = {
+        'data': [_sankey_trace(table, link_source, link_target, link_value, 30, pad)],
+        'layout': layout,
+    }
+    return spec, all_brands, brand_color_map
+
+
+def chain_download_table(cube, periods):
+    """多期串联导出表：期初/期末/起始点/目标点/流量(万)"""
+    parts = []
+    for start_period, end_period in zip(periods[:-1], periods[1:]):
+        table = flow_download_table(cube.flows(start_period, end_period))
+        table.insert(0, '期末', end_period)
+        table.insert(0, '期初', start_period)
+        parts.append(table)
+    return pd.concat(parts, ignore_index=True)
+
+
+def flow_download_table(flow_table, flows=None):
+    """导出用流向表：起始点/目标点/流量(万)"""
+    flow_for_download = flow_table.labeled(flows)
+    flow_for_download['流量'] = flow_for_download['流量'] / 10000
+    return flow_for_download.rename(columns={'流量': '流量(万)'})
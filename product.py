@@ -1,9 +1,21 @@
+import uuid
+
 import streamlit as st
-import pandas as pd
-import numpy as np
-import random
-import plotly.graph_objects as go
-import colorsys
+
+from allocator import ALLOCATION_LABELS
+from cache import SHARED_STORE, upload_hash
+from diagnostics import PipelineProfiler
+from nodes import SOURCE, TARGET
+from ingest import SUPPORTED_TYPES, columnar_columns, columnar_rows, ensure_columnar, scan_columnar
+from brands import alias_fingerprint, load_aliases, process_brands, save_aliases, suggest_aliases
+from flow_engine import flows_by_store_chunks
+from period_cube import CUBE_MODES, cube_from_totals
+from pipeline import (TYPE_COLOR_SCHEME, LinkIndex, SankeyChart, aggregate_flows, brand_report,
+                      chain_download_table, chain_sankey_spec, flow_download_table, full_brand_totals,
+                      load_clean_data, percentage_table, sankey_spec, top_n_totals)
+from parallel import DEFAULT_WORKERS, MAX_WORKERS, compute_flows_parallel
+from out_of_core import OUT_OF_CORE_ROWS, OutOfCoreDataset
+from jobs import CANCELLED, FAILED, JOBS, STATUS_LABELS, job_id
 
 # 初始化session_state
 if 'flow_df' not in st.session_state:
@@ -24,6 +36,120 @@ if 'highlight_keyword' not in st.session_state:
     st.session_state.highlight_keyword = "家乐"
 if 'show_rank_value' not in st.session_state:
     st.session_state.show_rank_value = True
+# 当前流向表对应的计算参数（用于判断哪些计算阶段需要重跑）
+if 'flow_params' not in st.session_state:
+    st.session_state.flow_params = None
+# 多期串联图对应的计算参数
+if 'chain_params' not in st.session_state:
+    st.session_state.chain_params = None
+# 后台计算任务：会话标识用于关联任务（相同参数的任务在会话间共享）
+if 'session_token' not in st.session_state:
+    st.session_state.session_token = uuid.uuid4().hex
+if 'active_job' not in st.session_state:
+    st.session_state.active_job = None
+if 'cancelled_job' not in st.session_state:
+    st.session_state.cancelled_job = None
+# 缓存：解析后的上传数据（按文件内容哈希）和流向结果（按文件哈希+计算参数），
+# 存放在所有会话共享的结果缓存中，多个会话分析同一文件时只计算、只占用一份内存
+if 'upload_hashes' not in st.session_state:
+    st.session_state.upload_hashes = {}
+if 'data_cache' not in st.session_state:
+    st.session_state.data_cache = SHARED_STORE.namespace('data')
+if 'flow_cache' not in st.session_state:
+    st.session_state.flow_cache = SHARED_STORE.namespace('flows')
+# 运行诊断：每次完整运行重新记录各阶段；勾选后对下一次实际执行计算的后台任务采集cProfile
+if 'profiler' in st.session_state:
+    st.session_state.profiler.close()
+st.session_state.profiler = PipelineProfiler(trace_memory=st.session_state.get('trace_memory', False))
+profiler = st.session_state.profiler
+
+
+# 后台任务进度的刷新间隔（秒）
+JOB_POLL_SECONDS = 0.5
+
+
+def reporting(progress, unit):
+    """把计算函数的progress(已完成, 总数)转换为带说明的任务进度"""
+    return lambda done, total: progress(done, total, f"已完成{unit} {done:,}/{total:,}")
+
+
+def begin_stage(progress, name):
+    """进入新的计算阶段：显示阶段名称，已请求取消时在此中断"""
+    progress(0, 0, name)
+
+
+# 后台任务进度：定时刷新进度条，任务结束后重跑整个页面取结果；可取消本会话的等待
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_progress(id_):
+    job = JOBS.get(id_)
+    if job is None or job.finished:
+        st.rerun()
+    st.progress(job.fraction, text=f"{job.label}：{STATUS_LABELS[job.status]} {job.message}")
+    if len(job.subscribers) > 1:
+        st.caption(f"另有{len(job.subscribers) - 1}个会话在等待同一计算结果")
+    if st.button("取消计算"):
+        # 其他会话仍在等待时任务继续运行，只有本会话放弃
+        JOBS.unsubscribe(id_, st.session_state.session_token)
+        st.session_state.active_job = None
+        st.session_state.cancelled_job = id_
+        st.rerun()
+
+
+def background_result(key, compute, label, force=False):
+    """在后台任务中运行compute(progress, 诊断记录器)并返回结果
+
+    相同参数的任务（包括其他会话提交的）只计算一次；未完成时显示进度和取消按钮并停止本次运行，
+    完成后由进度片段重跑页面取结果。切换参数时放弃本会话之前的任务；
+    取消后需再次点击生成按钮（force=True）才重新计算。
+    任务中的阶段记录（以及勾选时采集的cProfile）在任务线程中记录，取结果时并入本次运行的诊断。
+    """
+    trace_memory = profiler.trace_memory
+    profile = st.session_state.get('profile_pending', False)
+
+    def run(progress):
+        job_profiler = PipelineProfiler(trace_memory=trace_memory, profile=profile)
+        try:
+            return compute(progress, job_profiler), job_profiler
+        finally:
+            job_profiler.stop_profile()
+            job_profiler.close()
+
+    token = st.session_state.session_token
+    id_ = job_id(key)
+    if force:
+        st.session_state.cancelled_job = None
+    elif st.session_state.cancelled_job == id_:
+        st.info("计算已取消，点击“生成桑基图”重新计算")
+        st.stop()
+    active = st.session_state.active_job
+    if active is not None and active != id_:
+        JOBS.unsubscribe(active, token)
+    job = JOBS.submit(key, run, label, subscriber=token)
+    st.session_state.active_job = job.id
+    if not job.finished:
+        render_job_progress(job.id)
+        st.stop()
+    # 取走结果后任务不再保留结果，由调用方存入共享结果缓存
+    collected = JOBS.collect(job, token)
+    st.session_state.active_job = None
+    if job.status == CANCELLED:
+        st.session_state.cancelled_job = job.id
+        st.warning("计算已取消")
+        st.stop()
+    if job.status == FAILED:
+        # 数据和流向核对错误提示后停止，不把不一致的流向表交给后面的展示环节
+        if isinstance(job.error, ValueError):
+            st.error(str(job.error))
+            st.stop()
+        raise job.error
+    result, job_profiler = collected
+    profiler.merge(job_profiler)
+    if job_profiler.profile_stats:
+        # 采集到计算的cProfile后才清除勾选（命中缓存、未实际计算的运行不消耗这次采集）
+        st.session_state.last_profile = job_profiler.profile_stats
+        st.session_state.profile_pending = False
+    return result
+
 
 # 设置页面配置
 st.set_page_config(
@@ -32,6 +158,12 @@ st.set_page_config(
     layout="wide"  # 使用宽布局增加空间
 )
 
+# 分析模式：单个期初/期末组合，或多个期间依次串联
+ANALYSIS_MODES = {
+    'pair': '单期对比（期初 → 期末）',
+    'chain': '多期串联（Q1 → Q2 → Q3 …）',
+}
+
 # 标题
 st.title("品牌流量桑基图分析工具")
 
@@ -41,67 +173,98 @@ param_col1, param_col2 = st.columns(2)
 
 # 文件上传区域
 with param_col1:
-    uploaded_file = st.file_uploader("请上传Excel格式的数据文件（.xlsx）", type=["xlsx"])
+    uploaded_file = st.file_uploader("请上传数据文件（.xlsx / .csv / .parquet）", type=SUPPORTED_TYPES)
 
-# 辅助函数：判断节点类型并提取品牌
-def get_node_info(node):
-    """返回节点类型和品牌（如适用）"""
-    if "其他品牌" in node:
-        return ("other_brand", None)
-    elif "新增门店" in node:
-        return ("new_store", None)
-    elif "门店流失" in node:
-        return ("store_loss", None)
-    elif "新增品类" in node:
-        return ("new_category", None)
-    elif "品类流失" in node:
-        return ("category_loss", None)
-    elif "期初_" in node:
-        brand = node.split("期初_")[1]
-        return ("brand", brand)
-    elif "期末_" in node:
-        brand = node.split("期末_")[1]
-        return ("brand", brand)
-    return ("other", None)
+# 品牌别名字典：查看当前别名，按名称相似度生成建议并保存（跨上传文件复用）
+def render_alias_editor(raw_brand_totals):
+    aliases = load_aliases()
+    with st.expander(f"品牌别名字典（{len(aliases)}条）"):
+        if aliases:
+            st.dataframe([{'变体名称': variant, '标准名称': canonical} for variant, canonical in aliases.items()])
+        threshold = st.slider("名称相似度阈值", 70, 100, 90)
+        if st.button("根据相似名称生成别名建议"):
+            st.session_state.alias_suggestions = suggest_aliases(raw_brand_totals, threshold, aliases)
+        suggestions = st.session_state.get('alias_suggestions')
+        if suggestions:
+            st.dataframe([{'变体名称': variant, '标准名称': canonical} for variant, canonical in suggestions.items()])
+            if st.button("保存建议到别名字典"):
+                aliases = save_aliases({**aliases, **suggestions})
+                st.session_state.alias_suggestions = None
+                st.success(f"已保存{len(suggestions)}条别名")
+        elif suggestions is not None:
+            st.write("没有找到相似的品牌名称")
+    return aliases
 
-# 辅助函数：生成品牌专属颜色
-def generate_brand_colors(brands):
-    brand_colors = {}
-    num_brands = len(brands)
-    # 从HSV颜色空间生成均匀分布的颜色
-    for i, brand in enumerate(brands):
-        hue = i / num_brands  # 色相均匀分布
-        saturation = 0.6  # 适中饱和度
-        value = 0.9  # 较高明度，确保清晰
-        r, g, b = colorsys.hsv_to_rgb(hue, saturation, value)
-        brand_colors[brand] = f"rgb({int(r*255)}, {int(g*255)}, {int(b*255)})"
-    return brand_colors
+# 运行诊断面板：各阶段耗时、内存和行数，可导出JSON
+def render_diagnostics():
+    profiler = st.session_state.profiler
+    with st.expander("运行诊断（各阶段耗时与内存）"):
+        records = profiler.to_records()
+        if records:
+            st.dataframe(records)
+        else:
+            st.write("本次运行没有执行计算阶段")
+        st.caption(f"共享结果缓存：{len(SHARED_STORE)}项，{SHARED_STORE.total_bytes / 1024 ** 2:,.1f} MB"
+                   f" / {SHARED_STORE.max_bytes / 1024 ** 2:,.0f} MB"
+                   + (f"，溢出目录 {SHARED_STORE.spill_dir}" if SHARED_STORE.spill_dir else ""))
+        st.download_button(
+            label="导出诊断数据(JSON)",
+            data=profiler.to_json(),
+            file_name="桑基图运行诊断.json",
+            mime="application/json",
+        )
+        st.checkbox("跟踪Python内存分配（tracemalloc，有额外开销）", key="trace_memory")
+        # 勾选状态另存在会话中，等待计算期间停止的运行不会丢失
+        st.session_state.profile_pending = st.checkbox(
+            "下一次计算时采集cProfile", value=st.session_state.get('profile_pending', False))
+        if st.session_state.get('last_profile'):
+            st.text(st.session_state.last_profile)
 
 # 如果上传了文件，则进行后续参数设置
 if uploaded_file is not None:
-    # 读取数据以获取Q的可能值
-    df = pd.read_excel(uploaded_file)
-    if 'Q' not in df.columns:
+    # 首次上传时按块转换为列式文件，之后只按需读取所需的列和行
+    file_hash = upload_hash(uploaded_file, st.session_state.upload_hashes)
+    with profiler.stage("上传文件转换"):
+        columnar_file = ensure_columnar(uploaded_file, file_hash)
+    if 'Q' not in columnar_columns(columnar_file):
         st.error("上传的文件缺少必要的'Q'列")
         st.stop()
     
-    # 获取Q的唯一值并排序
-    q_values = sorted(df['Q'].unique().tolist())
+    # 轻量扫描：获取Q的唯一值（已排序）、全期品牌金额合计和总行数
+    scan_result = st.session_state.data_cache.get((file_hash, 'scan'))
+    if scan_result is None:
+        with profiler.stage("扫描期间和品牌"):
+            scan_result = scan_columnar(columnar_file) + (columnar_rows(columnar_file),)
+        st.session_state.data_cache.put((file_hash, 'scan'), scan_result)
+    q_values, raw_brand_totals, n_rows = scan_result
+    # 超出内存的大文件按Passport_id分区落盘计算，界面只使用汇总后的流向
+    out_of_core = n_rows > OUT_OF_CORE_ROWS
     
     with param_col1:
-        # 期初和期末选择
-        col1, col2 = st.columns(2)
-        with col1:
-            start_period = st.selectbox("选择期初", q_values, index=0)
-            st.session_state.start_period = start_period
-        with col2:
-            end_period = st.selectbox("选择期末", q_values, index=min(1, len(q_values)-1))
-            st.session_state.end_period = end_period
-        
-        # 确保期初不等于期末
-        if start_period == end_period:
-            st.error("期初和期末不能选择相同的值，请重新选择")
-            st.stop()
+        analysis_mode = st.radio("分析模式", list(ANALYSIS_MODES.keys()),
+                                 format_func=lambda key: ANALYSIS_MODES[key], horizontal=True)
+        if analysis_mode == 'chain':
+            # 多期串联：按期间顺序依次连接所选期间
+            chain_periods = st.multiselect("选择串联的期间", q_values, default=q_values)
+            chain_periods = [q for q in q_values if q in chain_periods]
+            if len(chain_periods) < 2:
+                st.error("多期串联至少需要选择两个期间")
+                st.stop()
+            start_period, end_period = chain_periods[0], chain_periods[-1]
+        else:
+            # 期初和期末选择
+            col1, col2 = st.columns(2)
+            with col1:
+                start_period = st.selectbox("选择期初", q_values, index=0)
+                st.session_state.start_period = start_period
+            with col2:
+                end_period = st.selectbox("选择期末", q_values, index=min(1, len(q_values)-1))
+                st.session_state.end_period = end_period
+            
+            # 确保期初不等于期末
+            if start_period == end_period:
+                st.error("期初和期末不能选择相同的值，请重新选择")
+                st.stop()
     
     with param_col2:
         # 其他参数设置
@@ -110,159 +273,287 @@ if uploaded_file is not None:
         
         top_n_brands = st.slider("保留Top N品牌数量", 5, 20, 10)
         
+        # 品牌别名只在Top N归类时按编码映射合并，不需要重新读取和清洗数据
+        use_aliases = st.checkbox("合并品牌别名（使用别名字典）", value=False)
+        brand_aliases = render_alias_editor(raw_brand_totals) if use_aliases else {}
+        alias_key = alias_fingerprint(brand_aliases)
+        
         show_rank_value = st.checkbox("在节点标签中显示排名和数值", value=True)
         st.session_state.show_rank_value = show_rank_value
         
+        # 细节层级：小链接合并为每个源节点一条"其他流向"链接，限制图中链接数
+        min_link_share = st.number_input("合并占源节点比例低于(%)的链接", min_value=0.0, max_value=100.0,
+                                         value=0.0, step=0.5) / 100
+        max_links = int(st.number_input("最多显示链接数", min_value=10, value=500, step=50))
+        
+        # 跨品牌转换分配方式：默认与命令行、流程函数一致的顺序分配
+        # （随机分配的结果随进程数、期间立方体、门店分片大小变化）
+        allocation_options = list(ALLOCATION_LABELS.keys())
+        allocation_strategy = st.selectbox(
+            "品牌转换分配方式",
+            allocation_options,
+            index=allocation_options.index('sequential'),
+            format_func=lambda key: ALLOCATION_LABELS[key],
+            help="随机分配在固定种子下可复现，但结果与并行进程数和分片方式有关"
+        )
+        allocation_seed = int(st.number_input("随机种子", min_value=0, value=0, step=1))
+        
+        # 计算模式：按门店分片的并行进程数（1为单进程）
+        compute_workers = int(st.number_input(
+            "并行计算进程数", min_value=1, max_value=MAX_WORKERS,
+            value=min(DEFAULT_WORKERS, MAX_WORKERS), step=1
+        ))
+        
+        # 预计算多个期间组合，切换期初/期末时直接查表
+        precompute_mode = st.selectbox(
+            "预计算期间组合",
+            list(CUBE_MODES.keys()),
+            format_func=lambda key: CUBE_MODES[key]
+        )
+        
+        # 链接下钻：计算流向时记录各链接的贡献门店（分区计算的大文件只保留汇总流向，不支持）
+        store_drilldown = st.checkbox("记录各链接的贡献门店（链接下钻）", value=False, disabled=out_of_core,
+                                      help="按门店计算流向并建立门店贡献索引，不使用并行进程和预计算的期间组合")
+        store_drilldown = store_drilldown and not out_of_core
+        
         # 生成桑基图按钮
         generate_chart = st.button("生成桑基图")
     
-    # 当点击生成按钮时进行处理
-    if generate_chart:
-        with st.spinner("正在读取和处理数据..."):
-            # 统一Value U列名
-            if 'Value U' not in df.columns and 'Value' in df.columns:
-                df = df.rename(columns={'Value': 'Value U'})
-            
-            # 检查必要的列是否存在
-            required_columns = ['brand', 'Value U', 'Passport_id', 'Q']
-            missing_columns = [col for col in required_columns if col not in df.columns]
-            if missing_columns:
-                st.error(f"上传的文件缺少必要的列: {', '.join(missing_columns)}")
-                st.stop()
+    def out_of_core_dataset():
+        """分区计算的数据集：分区文件按文件缓存（各会话共享），Top N、分配方式和期间变化时直接复用"""
+        dataset = st.session_state.data_cache.get((file_hash, 'out_of_core'))
+        if dataset is None:
+            dataset = OutOfCoreDataset(columnar_file)
+            st.session_state.data_cache.put((file_hash, 'out_of_core'), dataset)
+        return dataset
+    
+    if analysis_mode == 'chain':
+        # 多期串联：所选期间的（门店，品牌）汇总一次分组得到，相邻期间组合共用同一期的汇总
+        chain_key = (file_hash, tuple(chain_periods), top_n_brands, alias_key, allocation_strategy, allocation_seed)
+        chain_data_key = (file_hash, tuple(chain_periods))
+        chain_cube = st.session_state.flow_cache.get(chain_key)
+        # 已生成过串联图时，汇总已缓存的参数变化直接增量更新
+        refresh = (st.session_state.chain_params is not None
+                   and (chain_data_key + ('totals',) in st.session_state.data_cache or out_of_core))
+        if chain_cube is None and (generate_chart or refresh or st.session_state.active_job is not None):
+            data_cache = st.session_state.data_cache
+            dataset = out_of_core_dataset() if out_of_core else None
             
-            # 处理品牌列：聚合Value U并保留Top N品牌，统一品牌名称格式
-            df['brand_clean'] = df['brand'].str.strip().str.lower()  # 清洗品牌名称
-            brand_values = df.groupby('brand_clean')['Value U'].sum().reset_index()
-            brand_values_sorted = brand_values.sort_values('Value U', ascending=False)
-            top_brands = brand_values_sorted.head(top_n_brands)['brand_clean'].tolist()
-            df['brand_processed'] = df['brand_clean'].apply(lambda x: x if x in top_brands else '其他品牌')
+            def compute_chain(progress, job_profiler):
+                """后台计算多期串联的期间立方体（不调用Streamlit接口）"""
+                with job_profiler.stage("计算多期串联流向数据") as stage:
+                    if out_of_core:
+                        cube = dataset.cube('consecutive', top_n=top_n_brands, strategy=allocation_strategy,
+                                            seed=allocation_seed, periods=chain_periods,
+                                            progress=reporting(progress, "分区"),
+                                            aliases=brand_aliases, workers=compute_workers)
+                    else:
+                        totals_entry = data_cache.get(chain_data_key + ('totals',))
+                        if totals_entry is None:
+                            df = data_cache.get(chain_data_key)
+                            if df is None:
+                                begin_stage(progress, "读取和处理数据")
+                                df = load_clean_data(columnar_file, chain_periods)
+                                data_cache.put(chain_data_key, df)
+                            begin_stage(progress, "按门店、品牌汇总")
+                            totals_entry = full_brand_totals(df, chain_periods)
+                            data_cache.put(chain_data_key + ('totals',), totals_entry)
+                        full_totals, full_nodes = totals_entry
+                        begin_stage(progress, "品牌Top N处理")
+                        totals, brand_nodes, _ = top_n_totals(full_totals, full_nodes, raw_brand_totals,
+                                                              top_n_brands, brand_aliases)
+                        cube = cube_from_totals(totals, brand_nodes, chain_periods, mode='consecutive',
+                                                strategy=allocation_strategy, seed=allocation_seed,
+                                                progress=reporting(progress, "期间组合"))
+                    stage.rows = len(cube.data)
+                return cube
             
-            st.success(f"已处理品牌列，保留Top {top_n_brands}品牌，其余归为'其他品牌'")
+            chain_cube = background_result(('chain',) + chain_key, compute_chain,
+                                           "计算多期串联流向数据", force=generate_chart)
+            st.session_state.flow_cache.put(chain_key, chain_cube)
+            st.success(f"已计算{len(chain_periods) - 1}个相邻期间组合的流向数据")
         
-        # 计算流向数据
-        with st.spinner("正在计算流向数据..."):
-            flow_results = []
-            
-            # 按Passport_id分组处理
-            for passport_id, group in df.groupby('Passport_id'):
-                # 检查是否有期初和期末数据
-                has_start = start_period in group['Q'].values
-                has_end = end_period in group['Q'].values
-                
-                # 场景1：只有期末（期末有值，期初无值）
-                if not has_start and has_end:
-                    # 所有品牌都来自期初_新增门店
-                    brand_data = group[group['Q'] == end_period].groupby('brand_processed')['Value U'].sum().reset_index()
-                    for _, row in brand_data.iterrows():
-                        flow_results.append({
-                            '起始点': f"期初_新增门店",
-                            '目标点': f"期末_{row['brand_processed']}",
-                            '流量': row['Value U']
-                        })
-                    continue
-                
-                # 场景2：只有期初（期初有值，期末无值）
-                if has_start and not has_end:
-                    # 所有品牌流向期末_门店流失
-                    brand_data = group[group['Q'] == start_period].groupby('brand_processed')['Value U'].sum().reset_index()
-                    for _, row in brand_data.iterrows():
-                        flow_results.append({
-                            '起始点': f"期初_{row['brand_processed']}",
-                            '目标点': f"期末_门店流失",
-                            '流量': row['Value U']
-                        })
-                    continue
-                
-                # 场景3：既有期初又有期末（处理完整流向）
-                if has_start and has_end:
-                    # 按品牌聚合期初和期末的数据
-                    start_data = group[group['Q'] == start_period].groupby('brand_processed')['Value U'].sum().reset_index()
-                    end_data = group[group['Q'] == end_period].groupby('brand_processed')['Value U'].sum().reset_index()
-                    
-                    start_dict = dict(zip(start_data['brand_processed'], start_data['Value U']))
-                    end_dict = dict(zip(end_data['brand_processed'], end_data['Value U']))
-                    
-                    # 1. 相同品牌优先匹配
-                    common_brands = set(start_dict.keys()) & set(end_dict.keys())
-                    remaining_start = start_dict.copy()
-                    remaining_end = end_dict.copy()
-                    
-                    for brand in common_brands:
-                        flow = min(start_dict[brand], end_dict[brand])
-                        flow_results.append({
-                            '起始点': f"期初_{brand}",
-                            '目标点': f"期末_{brand}",
-                            '流量': flow
-                        })
-                        # 更新剩余量
-                        remaining_start[brand] -= flow
-                        remaining_end[brand] -= flow
-                        if remaining_start[brand] == 0:
-                            del remaining_start[brand]
-                        if remaining_end[brand] == 0:
-                            del remaining_end[brand]
-                    
-                    # 2. 不同品牌随机匹配剩余量
-                    start_remaining = list(remaining_start.items())
-                    end_remaining = list(remaining_end.items())
-                    
-                    while start_remaining and end_remaining:
-                        brand1, val1 = start_remaining[0]
-                        brand2, val2 = random.choice(end_remaining)
-                        
-                        flow = min(val1, val2)
-                        flow_results.append({
-                            '起始点': f"期初_{brand1}",
-                            '目标点': f"期末_{brand2}",
-                            '流量': flow
-                        })
-                        
-                        # 更新剩余量
-                        if val1 == flow:
-                            start_remaining.pop(0)
-                        else:
-                            start_remaining[0] = (brand1, val1 - flow)
-                            
-                        idx = end_remaining.index((brand2, val2))
-                        if val2 == flow:
-                            end_remaining.pop(idx)
-                        else:
-                            end_remaining[idx] = (brand2, val2 - flow)
-                    
-                    # 3. 处理最终余量
-                    # 期初剩余量流向期末_品类流失
-                    for brand, value in start_remaining:
-                        flow_results.append({
-                            '起始点': f"期初_{brand}",
-                            '目标点': f"期末_品类流失",
-                            '流量': value
-                        })
-                    
-                    # 期末剩余量来自期初_新增品类
-                    for brand, value in end_remaining:
-                        flow_results.append({
-                            '起始点': f"期初_新增品类",
-                            '目标点': f"期末_{brand}",
-                            '流量': value
-                        })
+        if chain_cube is not None and not chain_cube.data.empty:
+            st.session_state.chain_params = chain_key
+            # 图形按流向和外观参数缓存，未变化时不重新生成和校验
+            figure_key = chain_key + ('figure', highlight_keyword, show_rank_value, min_link_share, max_links)
+            with st.spinner("正在生成多期串联桑基图..."), profiler.stage("生成多期串联桑基图") as stage:
+                chart = st.session_state.flow_cache.get(figure_key)
+                if chart is None:
+                    spec, _, _ = chain_sankey_spec(
+                        chain_cube, chain_periods,
+                        highlight_keyword=highlight_keyword,
+                        show_rank_value=show_rank_value,
+                        title=f"品牌流量多期串联桑基图（{' → '.join(map(str, chain_periods))}）",
+                        min_link_share=min_link_share,
+                        max_links=max_links,
+                    )
+                    chart = SankeyChart(spec)
+                    st.session_state.flow_cache.put(figure_key, chart)
+                stage.rows = chart.n_links
+            st.subheader(f"品牌流量多期串联桑基图（{' → '.join(map(str, chain_periods))}）")
+            with profiler.stage("渲染桑基图（序列化）"):
+                st.plotly_chart(chart.figure, width="stretch")
+            st.download_button(
+                label="下载多期串联流向数据",
+                data=lambda: chain_download_table(chain_cube, chain_periods).to_csv(index=False),
+                file_name=f"多期串联桑基图流向数据_{chain_periods[0]}_to_{chain_periods[-1]}.csv",
+                mime="text/csv",
+            )
+        elif chain_cube is not None:
+            st.warning("所选期间没有流向数据")
+        render_diagnostics()
+        st.stop()
+    
+    # 计算按依赖关系分阶段缓存：
+    #   读取+清洗品牌 / 全粒度（门店，品牌）汇总 —— 只依赖文件和期间
+    #   Top N归类 —— 只需按编码映射合并已缓存的汇总
+    #   流向 —— 依赖Top N和分配方式
+    # 高亮关键词等外观参数不进入任何数据阶段
+    load_periods_list = list(q_values) if precompute_mode != 'none' else [start_period, end_period]
+    data_key = (file_hash, tuple(load_periods_list))
+    totals_key = data_key + ('totals',)
+    flow_params = (file_hash, start_period, end_period, top_n_brands, alias_key, allocation_strategy,
+                   allocation_seed, compute_workers, precompute_mode, store_drilldown)
+    cube_key = (file_hash, top_n_brands, alias_key, allocation_strategy, allocation_seed, precompute_mode)
+    period_cube = st.session_state.flow_cache.get(cube_key) if precompute_mode != 'none' else None
+    
+    # 已生成过图表时，参数变化若能由缓存的中间结果得到则自动增量更新，无需再点按钮
+    incremental = (
+        st.session_state.flow_params is not None
+        and st.session_state.flow_params != flow_params
+        and (totals_key in st.session_state.data_cache
+             or (period_cube is not None and (start_period, end_period) in period_cube))
+    )
+    
+    # 当点击生成按钮时进行处理（后台任务未结束时继续等待其结果）
+    if generate_chart or incremental or st.session_state.active_job is not None:
+        flow_key = (file_hash, start_period, end_period, top_n_brands, alias_key, allocation_strategy,
+                    allocation_seed, compute_workers, store_drilldown)
+        flow_df = st.session_state.flow_cache.get(flow_key)
+        # 期间立方体只保存流向，链接下钻需要按门店重新计算所选期间组合
+        if (flow_df is None and not store_drilldown
+                and period_cube is not None and (start_period, end_period) in period_cube):
+            flow_df = period_cube.flows(start_period, end_period)
+        
+        if flow_df is None:
+            data_cache = st.session_state.data_cache
+            dataset = out_of_core_dataset() if out_of_core else None
             
-            # 确保flow_df包含正确的列名
-            st.session_state.flow_df = pd.DataFrame(flow_results, columns=['起始点', '目标点', '流量'])
-            st.success("流向数据计算完成")
+            def clean_data():
+                """读取所需期间并清洗品牌列（全粒度），结果按文件和期间缓存"""
+                df = data_cache.get(data_key)
+                if df is None:
+                    df = load_clean_data(columnar_file, load_periods_list)
+                    data_cache.put(data_key, df)
+                return df
             
-            # 保存节点信息
-            st.session_state.source_nodes = st.session_state.flow_df['起始点'].unique().tolist()
-            st.session_state.target_nodes = st.session_state.flow_df['目标点'].unique().tolist()
+            def compute_flows(progress, job_profiler):
+                """后台计算流向表（不调用Streamlit接口），返回 (流向表, 期间立方体)"""
+                cube = None
+                flows = None
+                if out_of_core:
+                    with job_profiler.stage("分区计算流向数据") as stage:
+                        if precompute_mode != 'none':
+                            cube = dataset.cube(precompute_mode, top_n=top_n_brands, strategy=allocation_strategy,
+                                                seed=allocation_seed, progress=reporting(progress, "分区"),
+                                                aliases=brand_aliases, workers=compute_workers)
+                            if (start_period, end_period) in cube:
+                                flows = cube.flows(start_period, end_period)
+                        if flows is None:
+                            flows = dataset.flows(start_period, end_period, top_n=top_n_brands,
+                                                  strategy=allocation_strategy, seed=allocation_seed,
+                                                  progress=reporting(progress, "分区"),
+                                                  aliases=brand_aliases, workers=compute_workers)
+                        stage.rows = n_rows
+                    return flows, cube
+                
+                totals_entry = data_cache.get(totals_key)
+                if totals_entry is None:
+                    with job_profiler.stage("读取和处理数据") as stage:
+                        # 只加载需要的期间（预计算时加载全部期间）
+                        begin_stage(progress, "读取和处理数据")
+                        df = clean_data()
+                        begin_stage(progress, "按门店、品牌汇总")
+                        totals_entry = full_brand_totals(df, load_periods_list)
+                        stage.rows = len(df)
+                        data_cache.put(totals_key, totals_entry)
+                full_totals, full_nodes = totals_entry
+                
+                # 处理品牌列：按全部期间的金额保留Top N品牌（来自扫描结果），其余品牌的汇总合并为'其他品牌'
+                with job_profiler.stage("品牌Top N处理") as stage:
+                    begin_stage(progress, "品牌Top N处理")
+                    totals, brand_nodes, top_brands = top_n_totals(full_totals, full_nodes, raw_brand_totals,
+                                                                   top_n_brands, brand_aliases)
+                    stage.rows = sum(len(period_totals) for period_totals in totals.values())
+                
+                if precompute_mode != 'none':
+                    with job_profiler.stage("预计算期间组合的流向数据") as stage:
+                        cube = cube_from_totals(totals, brand_nodes, q_values, mode=precompute_mode,
+                                                strategy=allocation_strategy, seed=allocation_seed,
+                                                progress=reporting(progress, "期间组合"))
+                        stage.rows = len(cube.data)
+                    if (start_period, end_period) in cube and not store_drilldown:
+                        flows = cube.flows(start_period, end_period)
+                
+                if flows is None:
+                    with job_profiler.stage("计算流向数据") as stage:
+                        if compute_workers > 1 and not store_drilldown:
+                            df = process_brands(clean_data(), top_brands, brand_aliases)
+                            flows = compute_flows_parallel(df, start_period, end_period,
+                                                           strategy=allocation_strategy, seed=allocation_seed,
+                                                           workers=compute_workers,
+                                                           progress=reporting(progress, "分片"))
+                        else:
+                            flows = flows_by_store_chunks(totals[start_period], totals[end_period], brand_nodes,
+                                                          strategy=allocation_strategy, seed=allocation_seed,
+                                                          progress=reporting(progress, "门店"),
+                                                          contributions=store_drilldown)
+                        stage.rows = len(flows.flows)
+                return flows, cube
             
-            # 初始化选择
-            st.session_state.selected_sources = st.session_state.source_nodes
-            st.session_state.selected_targets = st.session_state.target_nodes
+            flow_df, computed_cube = background_result(('flows',) + flow_params, compute_flows,
+                                                       "计算流向数据", force=generate_chart)
+            if out_of_core:
+                st.success(f"流向数据计算完成（{dataset.n_partitions}个分区）")
+            else:
+                st.success(f"已处理品牌列，保留Top {top_n_brands}品牌，其余归为'其他品牌'")
+            if computed_cube is not None:
+                st.session_state.flow_cache.put(cube_key, computed_cube)
+                st.success(f"已预计算{len(computed_cube.pairs)}个期间组合的流向数据")
+            if not out_of_core:
+                st.success("流向数据计算完成")
+            check = flow_df.reconciliation
+            if check is not None:
+                st.caption(f"流量核对通过：期初 {check.start_total:,.2f} = 流出 {check.outflow:,.2f}，"
+                           f"期末 {check.end_total:,.2f} = 流入 {check.inflow:,.2f}"
+                           f"（清理零流量链接 {check.dropped:,} 条）")
+            st.session_state.flow_cache.put(flow_key, flow_df)
+        else:
+            st.success("已使用缓存的流向数据")
+        
+        st.session_state.flow_params = flow_params
+        st.session_state.flow_df = flow_df
+        
+        # 保存节点信息
+        st.session_state.source_nodes = flow_df.flows['source'].unique().tolist()
+        st.session_state.target_nodes = flow_df.flows['target'].unique().tolist()
+        
+        # 初始化选择
+        st.session_state.selected_sources = st.session_state.source_nodes
+        st.session_state.selected_targets = st.session_state.target_nodes
     
-    # 只有当有数据时才显示筛选和图表
-    if st.session_state.flow_df is not None and not st.session_state.flow_df.empty:
+    # 节点筛选及以下的展示部分是独立的局部片段：调整筛选时只重跑这一段，
+    # 读取、品牌处理和流向计算都不会重跑
+    @st.fragment
+    def render_flow_view():
+        # 流向表只保存节点编号，标签通过节点字典生成
+        flow_table = st.session_state.flow_df
+        nodes = flow_table.nodes
+        
         # 验证必要的列是否存在
-        required_flow_columns = ['起始点', '目标点', '流量']
-        missing_flow_cols = [col for col in required_flow_columns if col not in st.session_state.flow_df.columns]
+        required_flow_columns = ['source', 'target', '流量']
+        missing_flow_cols = [col for col in required_flow_columns if col not in flow_table.flows.columns]
         if missing_flow_cols:
             st.error(f"流向数据缺少必要的列: {', '.join(missing_flow_cols)}")
             st.stop()
@@ -274,201 +565,70 @@ if uploaded_file is not None:
             selected_sources = st.multiselect(
                 "选择要显示的期初节点",
                 st.session_state.source_nodes,
-                default=st.session_state.selected_sources
+                default=st.session_state.selected_sources,
+                format_func=lambda node: nodes.label(node, SOURCE)
             )
             st.session_state.selected_sources = selected_sources
         with filter_col2:
             selected_targets = st.multiselect(
                 "选择要显示的期末节点",
                 st.session_state.target_nodes,
-                default=st.session_state.selected_targets
+                default=st.session_state.selected_targets,
+                format_func=lambda node: nodes.label(node, TARGET)
             )
             st.session_state.selected_targets = selected_targets
         
-        # 应用筛选
-        filtered_flow_df = st.session_state.flow_df[
-            st.session_state.flow_df['起始点'].isin(st.session_state.selected_sources) & 
-            st.session_state.flow_df['目标点'].isin(st.session_state.selected_targets)
-        ]
+        # 应用筛选：全量流向只汇总一次为链接索引，筛选时只对链接做掩码
+        link_index = st.session_state.flow_cache.get((st.session_state.flow_params, 'links'))
+        if link_index is None:
+            with profiler.stage("建立链接索引") as stage:
+                link_index = LinkIndex(flow_table.flows, len(nodes))
+                stage.rows = len(link_index.links)
+            st.session_state.flow_cache.put((st.session_state.flow_params, 'links'), link_index)
+        filtered_sources = list(st.session_state.selected_sources)
+        filtered_targets = list(st.session_state.selected_targets)
+        filtered_flow_df = link_index.select(filtered_sources, filtered_targets)
         
         # 如果筛选后没有数据
         if filtered_flow_df.empty:
             st.warning("筛选后没有数据，请调整筛选条件")
         else:
             # 生成桑基图（基于筛选后的数据）
-            with st.spinner("正在生成桑基图..."):
-                # 确保聚合时使用正确的列名
-                aggregated_df = filtered_flow_df.groupby(['起始点', '目标点'], as_index=False)['流量'].sum()
-                
-                # 分离源节点和目标节点
-                source_nodes_unique = aggregated_df['起始点'].unique().tolist()
-                target_nodes_unique = aggregated_df['目标点'].unique().tolist()
-                
-                # 分别按流量排序
-                # 源节点按流出流量排序（降序）
-                source_flow = aggregated_df.groupby('起始点')['流量'].sum().reset_index()
-                source_flow.columns = ['节点', '总流量']
-                source_flow_sorted = source_flow.sort_values('总流量', ascending=False).reset_index(drop=True)
-                sorted_source_nodes = source_flow_sorted['节点'].tolist()
-                
-                # 目标节点按流入流量排序（降序）
-                target_flow = aggregated_df.groupby('目标点')['流量'].sum().reset_index()
-                target_flow.columns = ['节点', '总流量']
-                target_flow_sorted = target_flow.sort_values('总流量', ascending=False).reset_index(drop=True)
-                sorted_target_nodes = target_flow_sorted['节点'].tolist()
-                
-                # 合并节点列表（左侧源节点 + 右侧目标节点）
-                all_nodes = sorted_source_nodes + sorted_target_nodes
-                
-                # 提取所有品牌节点
-                all_brands = []
-                for node in all_nodes:
-                    node_type, brand = get_node_info(node)
-                    if node_type == "brand" and brand is not None and brand not in all_brands:
-                        all_brands.append(brand)
-                
-                # 生成品牌颜色映射
-                brand_color_map = generate_brand_colors(all_brands)
-                
-                # 创建节点索引映射
-                node_indices = {node: idx for idx, node in enumerate(all_nodes)}
-                
-                # 准备链接数据
-                links = {
-                    'source': [node_indices[src] for src in aggregated_df['起始点']],
-                    'target': [node_indices[tar] for tar in aggregated_df['目标点']],
-                    'value': aggregated_df['流量'].tolist()
-                }
-                
-                # 定义类型颜色方案
-                type_color_scheme = {
-                    "highlight": "rgb(255, 215, 0)",       # 高亮节点（金色）
-                    "new_store": "rgb(255, 182, 193)",    # 新增门店（浅粉色）
-                    "store_loss": "rgb(255, 182, 193)",   # 门店流失（浅粉色，与新增门店相同）
-                    "new_category": "rgb(144, 238, 144)", # 新增品类（浅绿色）
-                    "category_loss": "rgb(144, 238, 144)",# 品类流失（浅绿色，与新增品类相同）
-                    "other_brand": "rgb(221, 160, 221)",  # 其他品牌（淡紫色）
-                    "other": "rgb(220, 220, 220)"         # 其他节点（浅灰色）
-                }
-                
-                # 节点颜色设置：品牌用独特颜色，其他类型用统一颜色
-                node_colors = []
-                for node in all_nodes:
-                    # 优先检查是否为高亮节点
-                    if st.session_state.highlight_keyword.lower() in str(node).lower():
-                        node_colors.append(type_color_scheme["highlight"])
-                    else:
-                        node_type, brand = get_node_info(node)
-                        # 品牌节点使用其专属颜色
-                        if node_type == "brand" and brand in brand_color_map:
-                            node_colors.append(brand_color_map[brand])
-                        # 其他类型节点使用类型颜色
-                        else:
-                            node_colors.append(type_color_scheme.get(node_type, type_color_scheme["other"]))
-                
-                # 链接颜色设置：使用源节点颜色，轻微透明
-                link_colors = []
-                for src in aggregated_df['起始点']:
-                    src_idx = node_indices[src]
-                    # 使用源节点的颜色并设置透明度
-                    src_color = node_colors[src_idx]
-                    link_color = src_color.replace("rgb", "rgba").replace(")", ", 0.7)")
-                    link_colors.append(link_color)
-                
-                # 优化节点位置计算，避免重叠
-                source_count = len(sorted_source_nodes)
-                target_count = len(sorted_target_nodes)
-                total_nodes = len(all_nodes)
-                
-                # 动态调整节点间距，节点越多间距越大
-                min_spacing = 0.05  # 最小间距
-                source_spacing = max(0.8 / max(source_count - 1, 1), min_spacing) if source_count > 1 else 0
-                target_spacing = max(0.8 / max(target_count - 1, 1), min_spacing) if target_count > 1 else 0
-                
-                # 水平位置控制（源节点在左，目标节点在右，增加间距）
-                node_x = [0.15 for _ in range(source_count)] + [0.85 for _ in range(target_count)]
-                
-                # 垂直位置控制（更均匀的分布算法）
-                node_y = []
-                # 源节点垂直分布
-                for i in range(source_count):
-                    if source_count == 1:
-                        node_y.append(0.5)  # 单个节点居中
-                    else:
-                        node_y.append(0.1 + i * source_spacing)
-                
-                # 目标节点垂直分布
-                for i in range(target_count):
-                    if target_count == 1:
-                        node_y.append(0.5)  # 单个节点居中
-                    else:
-                        node_y.append(0.1 + i * target_spacing)
-                
-                # 动态调整字体大小，避免文字拥挤
-                base_font_size = 12
-                font_size = max(8, base_font_size - (total_nodes // 10))  # 节点越多字体越小
-                
-                # 节点标签（精简标签内容，避免过长）
-                node_labels = []
-                # 源节点标签（转换为万单位）
-                for i, node in enumerate(sorted_source_nodes):
-                    flow = source_flow_sorted[source_flow_sorted['节点'] == node]['总流量'].values[0] / 10000
-                    if st.session_state.show_rank_value:
-                        # 精简标签，只保留关键信息
-                        node_name = node.replace("期初_", "")
-                        node_labels.append(f"S{i+1}. {node_name} ({flow:.1f}万)")
-                    else:
-                        node_labels.append(f"{node.replace('期初_', '')}")
-                
-                # 目标节点标签
-                for i, node in enumerate(sorted_target_nodes):
-                    flow = target_flow_sorted[target_flow_sorted['节点'] == node]['总流量'].values[0] / 10000
-                    if st.session_state.show_rank_value:
-                        node_name = node.replace("期末_", "")
-                        node_labels.append(f"T{i+1}. {node_name} ({flow:.1f}万)")
-                    else:
-                        node_labels.append(f"{node.replace('期末_', '')}")
-                
-                # 绘制桑基图，优化节点样式
-                fig = go.Figure(data=[go.Sankey(
-                    arrangement="snap",  # 禁用自动布局
-                    node=dict(
-                        pad=25,  # 增加节点间距
-                        thickness=40,  # 增加节点厚度
-                        line=dict(color="rgba(100, 150, 255, 0.5)", width=1),  # 浅色边框
-                        label=node_labels,
-                        color=node_colors,
-                        x=node_x,
-                        y=node_y
-                    ),
-                    link=dict(
-                        source=links['source'],
-                        target=links['target'],
-                        value=links['value'],
-                        color=link_colors
+            # 筛选结果的聚合和占比表只依赖流向和筛选条件，按此缓存（外观参数变化时直接复用）
+            view_key = (st.session_state.flow_params,
+                        tuple(st.session_state.selected_sources), tuple(st.session_state.selected_targets))
+            with st.spinner("正在生成桑基图..."), profiler.stage("生成桑基图") as stage:
+                aggregate_stage = st.session_state.flow_cache.get(view_key + ('aggregate',))
+                if aggregate_stage is None:
+                    with profiler.stage("汇总筛选结果") as aggregate_record:
+                        aggregate_stage = aggregate_flows(filtered_flow_df)
+                        aggregate_record.rows = len(aggregate_stage[0])
+                    st.session_state.flow_cache.put(view_key + ('aggregate',), aggregate_stage)
+                aggregated_df, source_flow_sorted, target_flow_sorted = aggregate_stage
+                # 图形按筛选结果和外观参数缓存，未变化时不重新生成和校验
+                figure_key = view_key + ('figure', st.session_state.highlight_keyword,
+                                         st.session_state.show_rank_value, min_link_share, max_links)
+                chart = st.session_state.flow_cache.get(figure_key)
+                if chart is None:
+                    spec, all_brands, brand_color_map = sankey_spec(
+                        aggregated_df, source_flow_sorted, target_flow_sorted, nodes,
+                        highlight_keyword=st.session_state.highlight_keyword,
+                        show_rank_value=st.session_state.show_rank_value,
+                        title=f"品牌流量桑基图（{start_period} → {end_period}）- 筛选后",
+                        min_link_share=min_link_share,
+                        max_links=max_links,
                     )
-                )])
-                
-                # 优化布局和字体渲染
-                fig.update_layout(
-                    title_text=f"品牌流量桑基图（{start_period} → {end_period}）- 筛选后",
-                    font=dict(
-                        family="Microsoft YaHei",  # 使用微软雅黑字体
-                        size=font_size,
-                        color="rgb(30, 30, 30)"  # 深灰色文字提高清晰度
-                    ),
-                    width=1400,
-                    height=max(source_count, target_count) * 50 + 200,
-                    margin=dict(l=120, r=120, t=80, b=80),
-                    paper_bgcolor="rgba(0,0,0,0)",  # 完全透明背景
-                    plot_bgcolor="rgba(0,0,0,0)"    # 图表区域透明
-                )
+                    chart = (SankeyChart(spec), all_brands, brand_color_map)
+                    st.session_state.flow_cache.put(figure_key, chart)
+                chart, all_brands, brand_color_map = chart
+                stage.rows = chart.n_links
                 
                 st.success("桑基图生成完成")
             
             # 显示桑基图
             st.subheader(f"品牌流量桑基图（{st.session_state.start_period} → {st.session_state.end_period}）")
-            st.plotly_chart(fig, use_container_width=True)
+            with profiler.stage("渲染桑基图（序列化）"):
+                st.plotly_chart(chart.figure, width="stretch")
             
             # 显示颜色说明图例
             st.subheader("颜色说明")
@@ -484,242 +644,75 @@ if uploaded_file is not None:
             
             with legend_cols[1]:
                 st.markdown("<strong>类型节点</strong>", unsafe_allow_html=True)
-                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {type_color_scheme['new_store']}; margin-right: 10px; border: 1px solid #ddd;'></div>新增门店/门店流失</div>", unsafe_allow_html=True)
-                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {type_color_scheme['new_category']}; margin-right: 10px; border: 1px solid #ddd;'></div>新增品类/品类流失</div>", unsafe_allow_html=True)
-                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {type_color_scheme['other_brand']}; margin-right: 10px; border: 1px solid #ddd;'></div>其他品牌</div>", unsafe_allow_html=True)
+                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {TYPE_COLOR_SCHEME['new_store']}; margin-right: 10px; border: 1px solid #ddd;'></div>新增门店/门店流失</div>", unsafe_allow_html=True)
+                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {TYPE_COLOR_SCHEME['new_category']}; margin-right: 10px; border: 1px solid #ddd;'></div>新增品类/品类流失</div>", unsafe_allow_html=True)
+                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {TYPE_COLOR_SCHEME['other_brand']}; margin-right: 10px; border: 1px solid #ddd;'></div>其他品牌</div>", unsafe_allow_html=True)
             
             with legend_cols[2]:
                 st.markdown("<strong>特殊节点</strong>", unsafe_allow_html=True)
-                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {type_color_scheme['highlight']}; margin-right: 10px; border: 1px solid #ddd;'></div>高亮节点（'{highlight_keyword}'）</div>", unsafe_allow_html=True)
+                st.markdown(f"<div style='display: flex; align-items: center; margin: 5px 0;'><div style='width: 20px; height: 20px; background-color: {TYPE_COLOR_SCHEME['highlight']}; margin-right: 10px; border: 1px solid #ddd;'></div>高亮节点（'{highlight_keyword}'）</div>", unsafe_allow_html=True)
             
             # 计算并显示流量占比数据（基于筛选后的数据）
-            with st.spinner("正在计算流量占比数据..."):
-                # 创建字典用于快速查找每个源节点和目标节点的总流量
-                source_total_flow = dict(zip(source_flow['节点'], source_flow['总流量']))
-                target_total_flow = dict(zip(target_flow['节点'], target_flow['总流量']))
-                
-                # 按源节点分组，计算每个目标节点的流量占比
-                result = []
-                
-                # 遍历每个源节点
-                for source in sorted_source_nodes:
-                    # 筛选出该源节点的所有流出数据
-                    source_data = aggregated_df[aggregated_df['起始点'] == source]
-                    
-                    # 计算总流量
-                    total_source = source_total_flow[source]
-                    
-                    # 存储该源节点的所有流向信息
-                    flow_info = {
-                        '源节点': source,
-                        '源节点总流量': total_source / 10000,  # 转换为万单位
-                        '流向分布': []
-                    }
-                    
-                    # 遍历每个目标节点，计算占比
-                    for _, row in source_data.iterrows():
-                        # 确保使用正确的列名
-                        target = row['目标点']
-                        flow = row['流量']
-                        total_target = target_total_flow[target]
-                        
-                        # 计算占比（保留两位小数）
-                        pct_source = round((flow / total_source) * 100, 2)  # 占期初比
-                        pct_target = round((flow / total_target) * 100, 2)  # 占期末比
-                        
-                        flow_info['流向分布'].append({
-                            '目标节点': target,
-                            '流量': flow / 10000,  # 转换为万单位
-                            '占期初比(%)': pct_source,
-                            '占期末比(%)': pct_target
-                        })
-                    
-                    # 按占比降序排序
-                    flow_info['流向分布'].sort(key=lambda x: x['占期初比(%)'], reverse=True)
-                    result.append(flow_info)
-                
-                # 转换为DataFrame以便更好地查看
-                rows = []
-                for item in result:
-                    for flow in item['流向分布']:
-                        rows.append({
-                            '源节点': item['源节点'],
-                            '源节点总流量(万)': item['源节点总流量'],
-                            '目标节点': flow['目标节点'],
-                            '流量(万)': flow['流量'],
-                            '占期初比(%)': flow['占期初比(%)'],
-                            '占期末比(%)': flow['占期末比(%)']
-                        })
-                
-                percentage_df = pd.DataFrame(rows)
+            with st.spinner("正在计算流量占比数据..."), profiler.stage("计算流量占比数据") as stage:
+                percentage_df = st.session_state.flow_cache.get(view_key + ('percentage',))
+                if percentage_df is None:
+                    percentage_df = percentage_table(aggregated_df, source_flow_sorted, target_flow_sorted, nodes)
+                    st.session_state.flow_cache.put(view_key + ('percentage',), percentage_df)
+                # 展示和下载时不包含节点编号列
+                percentage_view = percentage_df.drop(columns=['source', 'target'])
+                stage.rows = len(percentage_view)
                 st.success("流量占比数据计算完成")
             
             # 显示流量占比数据（主要输出）
             st.subheader("流量占比详细数据（筛选后）")
-            st.dataframe(percentage_df)
+            st.dataframe(percentage_view)
             
             # 生成品牌分析报告
             st.subheader("品牌流量分析报告")
             
-            # 提取筛选后的品牌（仅包含选中的节点）
-            filtered_brands = []
-            
-            # 从筛选的源节点中提取品牌
-            for node in st.session_state.selected_sources:
-                node_type, brand = get_node_info(node)
-                if node_type == "brand" and brand is not None:
-                    if brand not in ["新增门店", "新增品类", "门店流失", "品类流失", "其他品牌"]:
-                        filtered_brands.append(brand)
+            # 只包含筛选后出现的品牌（源节点顺序优先）
+            with profiler.stage("生成品牌分析报告") as stage:
+                report_lines = brand_report(percentage_df, source_flow_sorted, target_flow_sorted, nodes)
+                stage.rows = len(report_lines)
+            for line in report_lines:
+                st.write(line)
             
-            # 从筛选的目标节点中提取品牌
-            for node in st.session_state.selected_targets:
-                node_type, brand = get_node_info(node)
-                if node_type == "brand" and brand is not None:
-                    if brand not in ["新增门店", "新增品类", "门店流失", "品类流失", "其他品牌"] and brand not in filtered_brands:
-                        filtered_brands.append(brand)
-            
-            # 确保按节点顺序排序（源节点顺序优先）
-            sorted_brands = []
-            # 首先添加源节点中的品牌（按源节点顺序）
-            for node in sorted_source_nodes:
-                node_type, brand = get_node_info(node)
-                if node_type == "brand" and brand is not None:
-                    if brand in filtered_brands and brand not in sorted_brands:
-                        sorted_brands.append(brand)
-            
-            # 然后添加仅在目标节点中的品牌（按目标节点顺序）
-            for node in sorted_target_nodes:
-                node_type, brand = get_node_info(node)
-                if node_type == "brand" and brand is not None:
-                    if brand in filtered_brands and brand not in sorted_brands:
-                        sorted_brands.append(brand)
-            
-            # 为每个筛选后的品牌生成分析报告（按排序后的顺序）
-            for brand in sorted_brands:
-                # 1. 品牌A的期初分析
-                start_node = f"期初_{brand}"
-                if start_node in source_total_flow and start_node in st.session_state.selected_sources:
-                    start_total = source_total_flow[start_node] / 10000  # 转换为万单位
-                    st.write(f"**{brand} 期初分析**")
-                    
-                    # 筛选该品牌的所有流向
-                    brand_flows = percentage_df[percentage_df['源节点'] == start_node]
-                    
-                    # 保留的数据
-                    retain_flow = 0
-                    retain_pct = 0
-                    # 转换到其他品牌的数据
-                    convert_flows = []
-                    # 流失数据（细分门店流失和品类流失）
-                    store_loss_flow = 0  # 门店流失
-                    store_loss_pct = 0
-                    category_loss_flow = 0  # 品类流失
-                    category_loss_pct = 0
-                    
-                    for _, row in brand_flows.iterrows():
-                        target = row['目标节点']
-                        if f"期末_{brand}" == target and target in st.session_state.selected_targets:
-                            retain_flow = row['流量(万)']
-                            retain_pct = row['占期初比(%)']
-                        elif "期末_门店流失" == target and target in st.session_state.selected_targets:
-                            store_loss_flow = row['流量(万)']
-                            store_loss_pct = row['占期初比(%)']
-                        elif "期末_品类流失" == target and target in st.session_state.selected_targets:
-                            category_loss_flow = row['流量(万)']
-                            category_loss_pct = row['占期初比(%)']
-                        elif "期末_" in target and target in st.session_state.selected_targets:
-                            _, target_brand = get_node_info(target)
-                            if target_brand is not None and target_brand != brand:
-                                convert_flows.append({
-                                    'brand': target_brand,
-                                    'flow': row['流量(万)'],
-                                    'pct': row['占期初比(%)']
-                                })
-                    
-                    # 生成期初分析文本
-                    report_text = f"{brand}，期初金额{start_total:.1f}万，"
-                    report_text += f"期末仍旧使用{brand}的金额{retain_flow:.1f}万，占比{retain_pct}%；"
-                    
-                    # 添加转换到其他品牌的信息
-                    for cf in convert_flows[:3]:  # 只显示前3个主要转换
-                        report_text += f"转换为{cf['brand']}的金额{cf['flow']:.1f}万，占比{cf['pct']}%；"
-                    
-                    # 明确区分门店流失和品类流失
-                    report_text += f"门店流失金额{store_loss_flow:.1f}万，占比{store_loss_pct}%；"
-                    report_text += f"品类流失金额{category_loss_flow:.1f}万，占比{category_loss_pct}%；"
-                    
-                    st.write(report_text)
-                
-                # 2. 品牌A的期末分析
-                end_node = f"期末_{brand}"
-                target_total = target_flow_sorted[target_flow_sorted['节点'] == end_node]['总流量'].values[0] / 10000 if (end_node in target_flow_sorted['节点'].values and end_node in st.session_state.selected_targets) else 0
-                
-                if target_total > 0:
-                    st.write(f"**{brand} 期末分析**")
-                    
-                    # 筛选流向该品牌的所有来源
-                    brand_inflows = percentage_df[percentage_df['目标节点'] == end_node]
-                    
-                    # 保留的数据（来自同一品牌）
-                    retain_flow = 0
-                    retain_pct = 0
-                    # 从其他品牌转换来的数据
-                    convert_flows = []
-                    # 新增数据（细分新增门店和新增品类）
-                    new_store_flow = 0  # 新增门店
-                    new_store_pct = 0
-                    new_category_flow = 0  # 新增品类
-                    new_category_pct = 0
-                    
-                    # 计算总流入量
-                    total_inflow = brand_inflows['流量(万)'].sum()
-                    
-                    for _, row in brand_inflows.iterrows():
-                        source = row['源节点']
-                        if f"期初_{brand}" == source and source in st.session_state.selected_sources:
-                            retain_flow = row['流量(万)']
-                            retain_pct = row['占期末比(%)']
-                        elif "期初_新增门店" == source and source in st.session_state.selected_sources:
-                            new_store_flow = row['流量(万)']
-                            new_store_pct = row['占期末比(%)']
-                        elif "期初_新增品类" == source and source in st.session_state.selected_sources:
-                            new_category_flow = row['流量(万)']
-                            new_category_pct = row['占期末比(%)']
-                        elif "期初_" in source and source in st.session_state.selected_sources:
-                            _, source_brand = get_node_info(source)
-                            if source_brand is not None and source_brand != brand:
-                                convert_flows.append({
-                                    'brand': source_brand,
-                                    'flow': row['流量(万)'],
-                                    'pct': row['占期末比(%)']
-                                })
-                    
-                    # 生成期末分析文本
-                    report_text = f"{brand}，期末金额{target_total:.1f}万，"
-                    report_text += f"来自期初{brand}的金额{retain_flow:.1f}万，占比{retain_pct:.2f}%；"
-                    
-                    # 添加从其他品牌转换来的信息
-                    for cf in convert_flows[:3]:  # 只显示前3个主要来源
-                        report_text += f"从{cf['brand']}转换来的金额{cf['flow']:.1f}万，占比{cf['pct']:.2f}%；"
-                    
-                    # 明确区分新增门店和新增品类
-                    report_text += f"新增门店金额{new_store_flow:.1f}万，占比{new_store_pct:.2f}%；"
-                    report_text += f"新增品类金额{new_category_flow:.1f}万，占比{new_category_pct:.2f}%；"
-                    
-                    st.write(report_text)
-                
-                st.write("---")  # 分隔线
+            # 链接下钻：从门店贡献索引直接查出链接的贡献门店，不重新计算
+            contributions = flow_table.contributions
+            if contributions is not None:
+                st.subheader("链接下钻：贡献门店（筛选后）")
+                drill_links = aggregated_df.sort_values('流量', ascending=False, kind='stable')
+                drill_source = drill_links['source'].to_numpy()
+                drill_target = drill_links['target'].to_numpy()
+                drill_labels = nodes.labels(drill_source, SOURCE) + " → " + nodes.labels(drill_target, TARGET)
+                drill_counts = contributions.link_counts(drill_source, drill_target)
+                drill_col1, drill_col2 = st.columns([3, 1])
+                with drill_col1:
+                    link_position = st.selectbox("选择链接", range(len(drill_links)),
+                                                 format_func=lambda i: f"{drill_labels[i]}（{drill_counts[i]:,}家门店）")
+                with drill_col2:
+                    top_stores = int(st.number_input("显示门店数", min_value=1, value=20, step=10))
+                link_source, link_target = int(drill_source[link_position]), int(drill_target[link_position])
+                with profiler.stage("链接下钻") as stage:
+                    store_df = contributions.link_stores(link_source, link_target, limit=top_stores)
+                    stage.rows = len(store_df)
+                st.dataframe(store_df)
+                st.download_button(
+                    label="下载该链接的全部贡献门店",
+                    data=lambda: contributions.link_stores(link_source, link_target).to_csv(index=False),
+                    file_name=f"链接贡献门店_{drill_labels[link_position]}.csv",
+                    mime="text/csv",
+                )
             
             # 提供数据下载功能
             st.subheader("数据下载（筛选后）")
             download_col1, download_col2 = st.columns(2)
             
             with download_col1:
-                # 流向数据下载（转换为万单位）
-                flow_for_download = filtered_flow_df.copy()
-                flow_for_download['流量'] = flow_for_download['流量'] / 10000
-                flow_for_download = flow_for_download.rename(columns={'流量': '流量(万)'})
-                flow_csv = flow_for_download.to_csv(index=False)
+                # 流向数据下载（转换为万单位，明细在点击下载时才生成）
+                def flow_csv():
+                    flows = link_index.filter_flows(flow_table.flows, filtered_sources, filtered_targets)
+                    return flow_download_table(flow_table, flows).to_csv(index=False)
                 st.download_button(
                     label="下载筛选后的流向数据",
                     data=flow_csv,
@@ -729,12 +722,20 @@ if uploaded_file is not None:
             
             with download_col2:
                 # 流量占比数据下载
-                percentage_csv = percentage_df.to_csv(index=False)
+                percentage_csv = percentage_view.to_csv(index=False)
                 st.download_button(
                     label="下载筛选后的流量占比数据",
                     data=percentage_csv,
                     file_name=f"筛选后_桑基图流量占比数据_{st.session_state.start_period}_to_{st.session_state.end_period}.csv",
                     mime="text/csv",
                 )
+        
+        render_diagnostics()
+    
+    # 只有当有数据时才显示筛选和图表
+    if st.session_state.flow_df is not None and not st.session_state.flow_df.empty:
+        render_flow_view()
+    else:
+        render_diagnostics()
 else:
-    st.info("请上传数据文件以开始分析（支持Excel格式）")
+    st.info("请上传数据文件以开始分析（支持Excel、CSV、Parquet格式）")
@@ -0,0 +1,55 @@
+"""合成面板数据：按门店数、品牌数、期间数和流失率生成 brand/Value U/Passport_id/Q 数据
+
+结果只由参数和seed决定，用于基准测试和对比各计算引擎。
+"""
+import numpy as np
+import pandas as pd
+
+# Value U的小数位数（以分为单位的金额）
+VALUE_DECIMALS = 2
+
+
+def synthetic_panel(n_stores=10_000, n_brands=30, n_quarters=4, brands_per_store=3,
+                    brand_churn=0.1, store_churn=0.05, rows_per_brand=1, seed=0):
+    """生成合成面板数据
+
+    - 每个门店经营brands_per_store个品牌（按Zipf分布的品牌热度抽取，可能重复）；
+      每期每个品牌以brand_churn的概率被替换为新抽取的品牌
+    - 门店第一期以1-store_churn的概率营业，之后每期营业门店以store_churn的概率关店、
+      未营业门店以同样的概率开店
+    - 每个（门店，品牌，期间）拆分为rows_per_brand行（模拟SKU明细）
+    返回列为 brand、Value U、Passport_id、Q 的DataFrame（brand/Passport_id/Q为分类类型）。
+    """
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, n_brands + 1)
+    popularity /= popularity.sum()
+
+    portfolio = rng.choice(n_brands, size=(n_stores, brands_per_store), p=popularity)
+    open_now = rng.random(n_stores) >= store_churn
+    # 门店规模和品牌在门店内的份额
+    store_scale = rng.lognormal(mean=8.0, sigma=1.0, size=n_stores)
+    brand_weight = rng.dirichlet(np.ones(brands_per_store), size=n_stores)
+
+    parts = []
+    for quarter in range(n_quarters):
+        if quarter:
+            toggle = rng.random(n_stores) < store_churn
+            open_now = open_now ^ toggle
+            churned = rng.random((n_stores, brands_per_store)) < brand_churn
+            portfolio = np.where(churned, rng.choice(n_brands, size=portfolio.shape, p=popularity), portfolio)
+        stores = np.flatnonzero(open_now)
+        store_idx = np.repeat(stores, brands_per_store * rows_per_brand)
+        brand_idx = np.repeat(portfolio[stores], rows_per_brand, axis=1).ravel()
+        share = np.repeat(brand_weight[stores], rows_per_brand, axis=1).ravel() / rows_per_brand
+        noise = rng.lognormal(mean=0.0, sigma=0.2, size=len(store_idx))
+        value = np.round(store_scale[store_idx] * share * noise, VALUE_DECIMALS)
+        parts.append((store_idx, brand_idx, np.full(len(store_idx), quarter), value))
+
+    store_idx, brand_idx, quarter_idx, value = (np.concatenate(column) for column in zip(*parts))
+    width = len(str(max(n_stores - 1, 0)))
+    return pd.DataFrame({
+        'brand': pd.Categorical.from_codes(brand_idx, [f"brand{i:03d}" for i in range(n_brands)]),
+        'Value U': value,
+        'Passport_id': pd.Categorical.from_codes(store_idx, [f"P{i:0{width}d}" for i in range(n_stores)]),
+        'Q': pd.Categorical.from_codes(quarter_idx, [f"Q{i + 1}" for i in range(n_quarters)]),
+    })
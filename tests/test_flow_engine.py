@@ -0,0 +1,145 @@
+"""向量化流向引擎与逐门店循环（原始规则）的对照测试"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from flow_engine import FLOW_DECIMALS, FLOW_RTOL, compute_flows, flow_decimals
+from ingest import load_periods, write_columnar
+
+BRANDS = ['A', 'B', 'C', 'D', 'E']
+
+
+def loop_flows(df, start_period, end_period):
+    """逐门店循环（sequential）：相同品牌优先保留，剩余量按列表顺序配对，浮点计算不取整"""
+    rows = []
+    for _, group in df.groupby('Passport_id', observed=True):
+        start = group[group['Q'] == start_period].groupby('brand_processed', observed=True)['Value U'].sum()
+        end = group[group['Q'] == end_period].groupby('brand_processed', observed=True)['Value U'].sum()
+        if start.empty and end.empty:
+            continue
+        if start.empty:
+            rows += [("期初_新增门店", f"期末_{brand}", value) for brand, value in end.items()]
+            continue
+        if end.empty:
+            rows += [(f"期初_{brand}", "期末_门店流失", value) for brand, value in start.items()]
+            continue
+
+        remaining_start, remaining_end = start.to_dict(), end.to_dict()
+        for brand in set(remaining_start) & set(remaining_end):
+            flow = min(remaining_start[brand], remaining_end[brand])
+            rows.append((f"期初_{brand}", f"期末_{brand}", flow))
+            remaining_start[brand] -= flow
+            remaining_end[brand] -= flow
+        start_left = [(b, v) for b, v in remaining_start.items() if v != 0]
+        end_left = [(b, v) for b, v in remaining_end.items() if v != 0]
+        while start_left and end_left:
+            (brand1, val1), (brand2, val2) = start_left[0], end_left[0]
+            flow = min(val1, val2)
+            rows.append((f"期初_{brand1}", f"期末_{brand2}", flow))
+            if val1 == flow:
+                start_left.pop(0)
+            else:
+                start_left[0] = (brand1, val1 - flow)
+            if val2 == flow:
+                end_left.pop(0)
+            else:
+                end_left[0] = (brand2, val2 - flow)
+        rows += [(f"期初_{brand}", "期末_品类流失", value) for brand, value in start_left]
+        rows += [("期初_新增品类", f"期末_{brand}", value) for brand, value in end_left]
+    return pd.DataFrame(rows, columns=['起始点', '目标点', '流量'])
+
+
+def link_totals(labeled):
+    totals = labeled.groupby(['起始点', '目标点'])['流量'].sum()
+    return totals[totals.abs() > 1e-9].sort_index()
+
+
+def assert_same_links(expected, actual):
+    expected, actual = link_totals(expected).align(link_totals(actual), fill_value=0.0)
+    scale = max(float(expected.abs().max()), 1.0)
+    assert float((expected - actual).abs().max()) <= FLOW_RTOL * scale
+
+
+def assert_same_node_totals(expected, actual):
+    for column in ['起始点', '目标点']:
+        left, right = (expected.groupby(column)['流量'].sum().align(
+            actual.groupby(column)['流量'].sum(), fill_value=0.0))
+        assert np.allclose(left, right, rtol=FLOW_RTOL, atol=1e-9)
+
+
+def make_panel(periods=('Q1', 'Q2'), n_stores=80, negative_share=0.0, seed=0):
+    """小规模面板：有门店新增/流失、品牌增减，Value U为两位小数"""
+    rng = np.random.default_rng(seed)
+    records = []
+    for store in range(n_stores):
+        present = [period for period in periods if rng.random() > 0.15] or [periods[0]]
+        for period in present:
+            for brand in rng.choice(BRANDS, size=rng.integers(1, 4), replace=False):
+                value = round(float(rng.uniform(0.5, 500.0)), 2)
+                if rng.random() < negative_share:
+                    value = -value
+                records.append((brand, value, f"S{store:03d}", period))
+    df = pd.DataFrame(records, columns=['brand_processed', 'Value U', 'Passport_id', 'Q'])
+    df['brand_processed'] = pd.Categorical(df['brand_processed'], categories=BRANDS)
+    return df
+
+
+def test_sequential_matches_loop():
+    df = make_panel()
+    flows = compute_flows(df, 'Q1', 'Q2', strategy='sequential')
+    assert flows.reconciliation.ok
+    assert_same_links(loop_flows(df, 'Q1', 'Q2'), flows.labeled())
+
+
+def test_negative_remainders_match_loop():
+    df = make_panel(negative_share=0.2, seed=1)
+    assert (df['Value U'] < 0).any()
+    flows = compute_flows(df, 'Q1', 'Q2', strategy='sequential')
+    assert flows.reconciliation.ok
+    expected = loop_flows(df, 'Q1', 'Q2')
+    assert_same_links(expected, flows.labeled())
+    assert_same_node_totals(expected, flows.labeled())
+
+
+def test_cent_values_use_two_decimals(tmp_path):
+    panel = make_panel(seed=5).rename(columns={'brand_processed': 'brand'})
+    path = str(tmp_path / "panel.feather")
+    write_columnar(panel, path)
+    df = load_periods(path, ['Q1', 'Q2'])
+    assert flow_decimals(df['Value U'].to_numpy()) == max(FLOW_DECIMALS, 2)
+    df['brand_processed'] = pd.Categorical(df['brand'].astype(str), categories=BRANDS)
+    flows = compute_flows(df, 'Q1', 'Q2', strategy='sequential')
+    assert flows.reconciliation.ok
+    assert_same_links(loop_flows(df, 'Q1', 'Q2'), flows.labeled())
+
+
+def test_integer_periods():
+    df = make_panel(periods=(20231, 20232), seed=2)
+    flows = compute_flows(df, 20231, 20232, strategy='sequential')
+    assert flows.reconciliation.ok
+    assert_same_links(loop_flows(df, 20231, 20232), flows.labeled())
+
+
+def test_integer_periods_from_command_line():
+    from types import SimpleNamespace
+
+    from cli import _available_pairs, parse_pair
+
+    dataset = SimpleNamespace(name="panel", periods=[20231, 20232, 20233])
+    pairs = [parse_pair("20231:20232"), parse_pair("20232:20234")]
+    assert _available_pairs(dataset, pairs) == [(20231, 20232)]
+
+
+@pytest.mark.parametrize('strategy', ['random', 'proportional', 'greedy'])
+def test_strategies_keep_node_totals(strategy):
+    df = make_panel(seed=3)
+    flows = compute_flows(df, 'Q1', 'Q2', strategy=strategy, seed=7)
+    assert flows.reconciliation.ok
+    assert_same_node_totals(loop_flows(df, 'Q1', 'Q2'), flows.labeled())
+
+
+def test_random_seed_reproducible():
+    df = make_panel(seed=4)
+    first = compute_flows(df, 'Q1', 'Q2', strategy='random', seed=42).labeled()
+    second = compute_flows(df, 'Q1', 'Q2', strategy='random', seed=42).labeled()
+    pd.testing.assert_frame_equal(first, second)